@@ -5,26 +5,90 @@
 #   
 #  NAME:  xcatha.py
 #
-#  SYNTAX: xcatha.py -s|--setup -p <shared-data directory path> -i <nic> -v <virtual ip> -n <virtual ip hostname> [-m <netmask>] [-t <database type>] [--dryrun] 
+#  SYNTAX: xcatha.py -s|--setup -p <shared-data directory path> -i <nic> -v <virtual ip> -n <virtual ip hostname> [-m <netmask>] [-t <database type>] [--switch-mode symlink|bind] [--cache-dir <directory>] [--xcat-url <url>] [--resume | --from-stage <stage>] [--copy-workers <number>] [--verify] [--profile [--trace-file <file>]] [--metrics-file <file>] [--dryrun] 
 #
-#  SYNTAX: xcatha.py -a|--activate -p <shared-data directory path> -i <nic> -v <virtual ip> [-m <netmask>] [-t <database type>] [--dryrun]
+#  SYNTAX: xcatha.py -a|--activate -p <shared-data directory path> -i <nic> -v <virtual ip> [-m <netmask>] [-t <database type>] [--step-timeout <seconds>] [--ready-timeout <seconds>] [--verify] [--lease-ttl <seconds>] [--profile [--trace-file <file>]] [--metrics-file <file>] [--dryrun]
 #
-#  SYNTAX: xcatha.py -d|--deactivate -i <nic> -v <virtual ip> [--dryrun]
+#  SYNTAX: xcatha.py -d|--deactivate -i <nic> -v <virtual ip> [-p <shared-data directory path> [--resync [--bwlimit <KB/s>]] [--verify]] [--stop-timeout <seconds>] [--profile [--trace-file <file>]] [--metrics-file <file>] [--dryrun]
 #
-#  DESCRIPTION:  Setup/Activate/Deactivate this node be the shared data based xCAT MN
+#  SYNTAX: xcatha.py --monitor -p <shared-data directory path> [-i <nic> -v <virtual ip> [-m <netmask>] [--auto-activate]] [--role auto|active|standby] [--beat-interval <seconds>] [--miss-threshold <number>] [--lease-ttl <seconds>]
+#
+#  SYNTAX: xcatha.py -s|-a|-d|--failover --fleet <inventory file> [--fleet-workers <number>] [--dryrun]
+#
+#  DESCRIPTION:  Setup/Activate/Deactivate this node be the shared data based xCAT MN,
+#                or monitor the heartbeat of the primary MN from the standby MN,
+#                or run them on the nodes of many HA pairs
 #
 #  FLAGS:
 #               -p       the shared data directory path
+#                        with -d, its manifest is updated after services are stopped
 #               -i       the nic that the virtual ip address attaches to,
 #                        for Linux, it could be eth0:1 or eth1:2 or ...
-#               -v       virtual ip address
+#               -v       virtual ip address, -v, -i and -m can be repeated for a virtual ip on
+#                        each network, the first one is the virtual ip of the management node,
+#                        all of them are configured and removed together
 #               -n       virtual ip hostname
 #               -m       netmask for the virtual ip address,
-#                        default is 255.255.255.0
+#                        default is 255.255.255.0, a single -m applies to all virtual ips
 #               -t       target database type, it can be postgresql, mariadb or sqlite, default is sqlite
 #               --dryrun display steps without execution
+#               --profile print time spent per stage and the slowest commands at the end,
+#                        and write a JSON timing trace
+#               --trace-file timing trace file written by --profile,
+#                        default is xcatha-trace.json in current directory
+#               --metrics-file write durations of the stages, command counts and retries, virtual ip
+#                        probe time, service results and copied bytes of the run into this file,
+#                        in node_exporter textfile format
+#               --copy-workers number of threads copying data into the shared data directory
+#                        during setup, default is 8
+#               --command-timeout seconds a command may run before it is killed, default is 600,
+#                        package installation may take up to 3600 seconds
+#               --vip-probe-timeout seconds to wait for an ARP reply when checking if the
+#                        virtual ip is already in use, default is 0.5
+#               --garp-count gratuitous ARPs, or unsolicited neighbor advertisements for IPv6,
+#                        sent after the virtual ip is configured, default is 3
+#               --step-timeout seconds each service startup step may take before it is
+#                        considered failed, default is 600
+#               --switch-mode symlink replaces the local directories by symlinks into the shared
+#                        data directory, bind keeps them and mounts the shared data directories
+#                        over them during activation, default is symlink
+#               --cache-dir directory where go-xcat and the installed xCAT and database packages
+#                        are cached, with their checksums, so the other node installs from
+#                        there, default is .xcatha/cache in the shared data directory
+#               --xcat-url URL go-xcat is downloaded from, such as file:///root/go-xcat,
+#                        default is the go-xcat of the xcat-core repository on GitHub
+#               --resume skip setup stages which a previous, failed, setup completed with the
+#                        same options, and which are still in effect
+#               --from-stage skip setup stages before the given one, the stages are configure_vip,
+#                        save_original_host_and_ip, change_hostname, install_xcat,
+#                        check_database_type, configure_shared_data, restart_xcat_services,
+#                        change_xcat_policy_attribute, deactivate_management_node and update_manifest
+#               --resync bring the local copies of the shared directories up to date from the shared
+#                        data directory after deactivation, copying only changed blocks with rsync
+#               --bwlimit KB per second a resync may transfer, default is no limit
+#               --verify check before activation that the files of the shared data directory match
+#                        the manifest written by setup or deactivate given --verify, only files
+#                        whose size or mtime changed are read again
+#               --ready-timeout seconds a started database, xcatd, named or dhcpd may take to
+#                        accept connections before it is considered failed, default is 300
+#               --stop-timeout seconds a service may take to stop at deactivation before
+#                        all processes of its unit are killed, default is 60
+#               --role   role of this node for --monitor, the active node writes heartbeats into
+#                        the shared data directory, the standby node watches them, default is auto,
+#                        which is active when the virtual ip is configured on this node
+#               --beat-interval seconds between two heartbeats, default is 5
+#               --miss-threshold missed heartbeats after which the active node is declared dead,
+#                        default is 3
+#               --auto-activate activate the standby node once the active node is declared dead
+#               --lease-ttl seconds a lease on the shared data stays valid without renewal, default is 30
+#               --fleet  JSON inventory of HA pairs, -s, -a, -d or --failover run xcatha.py on
+#                        their nodes over ssh instead of on this node, deactivating the primary
+#                        before activating the standby of a pair
+#               --failover deactivate the primary and activate the standby node of each pair
+#               --fleet-workers HA pairs --fleet works on at once, default is 4
 import argparse
 import os
+import sys
 import time
 import platform
 import shutil
@@ -35,6 +99,35 @@ import grp
 import socket
 import pdb
 import re
+import threading
+import errno
+import stat
+import Queue
+import json
+import functools
+import contextlib
+import tempfile
+import shlex
+import pipes
+import random
+import signal
+import select
+import struct
+import binascii
+import math
+import ssl
+import hashlib
+import fcntl
+import urllib2
+import urlparse
+import urllib
+import glob
+try:
+    import ctypes
+    import ctypes.util
+    libc=ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+except (ImportError, OSError):
+    libc=None
 
 etc_hosts="/etc/hosts"
 dryrun=0
@@ -52,7 +145,72 @@ xcat_profile="/etc/profile.d/xcat.sh"
 pg_hba_conf="/var/lib/pgsql/data/pg_hba.conf"
 postgresql_conf="/var/lib/pgsql/data/postgresql.conf"
 hostfile="/etc/hosts"
+resolv_conf="/etc/resolv.conf"
+# Physical ip and hostname of this node, saved during setup
+ha_mn_tmp="/tmp/ha_mn"
+etc_ha_mn="/etc/xcat/ha_mn"
+# Console service that was running, recorded when services are stopped
+console_lock="/etc/xcat/console.lock"
+server_cert="/etc/xcat/cert/server-cert.pem"
+# Completed setup stages, on local disk as the shared data directory is set up by them
+journal_file="/var/lib/xcatha/journal.json"
+# Stages of setup recorded in the journal, in the order they run
+setup_stages=["configure_vip", "save_original_host_and_ip", "change_hostname", "install_xcat", "check_database_type",
+              "configure_shared_data", "restart_xcat_services", "change_xcat_policy_attribute",
+              "deactivate_management_node", "update_manifest"]
+# Downloaded go-xcat and packages, in the shared data directory unless --cache-dir is given
+cache_dir=None
+# How the directories of shared_fs are switched to the shared data directory, symlink or bind
+switch_mode="symlink"
+# Directories bind mounted from the shared data directory, recorded at setup with --switch-mode bind
+bind_file="/var/lib/xcatha/bind_mounts"
+# Process renewing the lease while this node is active
+lease_renewer_file="/var/lib/xcatha/lease_renewer.pid"
 xcat_env="/opt/xcat/bin:/opt/xcat/sbin:/opt/xcat/share/xcat/tools:"
+# Seconds a single step of the service startup graph may run before it is considered failed
+service_step_timeout=600
+# Seconds a started service may take to be ready, and a single readiness probe may take
+ready_timeout=300
+probe_timeout=2
+# Seconds a service may take to stop before all processes of its unit are killed
+stop_timeout=60
+# Seconds a command may run before it is killed, and the initial and maximum delay
+#     between two attempts of a failed command
+command_timeout=600
+retry_delay=0.5
+retry_delay_max=5
+# Seconds the check for a virtual ip already in use waits for an answer, and number of
+#     ARP probes sent during that time
+vip_probe_timeout=0.5
+vip_probe_count=3
+# Gratuitous ARPs (unsolicited neighbor advertisements for IPv6) sent once the virtual ip
+#     is configured, and seconds between them
+garp_count=3
+garp_interval=0.2
+# Seconds a virtual ip may take to be usable after it was added
+vip_ready_timeout=5
+# (vip, nic, netmask) of the virtual ips given after the first -v
+extra_vips=[]
+# Seconds between two heartbeats of the active management node, and number of missed
+#     heartbeats after which the standby management node declares it dead
+beat_interval=5
+miss_threshold=3
+# Seconds the lease of the active management node is valid without being renewed, and
+#     seconds to wait for the lock of the lease file
+lease_ttl=30
+lease_lock_timeout=5
+# Installing packages may take much longer than other commands
+install_timeout=3600
+# Worker threads and size of the pieces large files are split into when populating shared data
+copy_workers=8
+# Seconds between two progress messages of a resync
+progress_interval=10
+# KB per second a resync may read, None for no limit
+resync_bwlimit=None
+# HA pairs a fleet operation works on at once, and seconds xcatha.py may run on one node
+fleet_workers=4
+fleet_timeout=7200
+copy_chunk_size=64*1024*1024
 
 #configure logger
 LOG_FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
@@ -67,39 +225,497 @@ logger.addHandler(console_handler)
 user_input_yn  = "Continue? [[Y]es/[N]o]:"
 user_input_ynd = "Continue? [[Y]es/[N]o/[D]ryrun]:"
 
-def run_command(cmd, retry, ignore_fail=None):
-    """execute and retry execute command"""
+class Tracer(object):
+    """record stages and external commands as timed spans
+
+       Spans nest: a span opened while another one is open in the same thread becomes
+       its child. Threads started for concurrent steps pass their parent explicitly.
+    """
+    def __init__(self):
+        self.lock=threading.Lock()
+        self.local=threading.local()
+        self.spans=[]
+        self.start=time.time()
+
+    def stack(self):
+        """open spans of the calling thread"""
+        if not hasattr(self.local, "stack"):
+            self.local.stack=[]
+        return self.local.stack
+
+    def current(self):
+        """innermost open span of the calling thread"""
+        stack=self.stack()
+        if stack:
+            return stack[-1]
+        return None
+
+    @contextlib.contextmanager
+    def span(self, name, kind, parent=None):
+        """time the enclosed block"""
+        if parent is None:
+            parent=self.current()
+        span={'name':name, 'kind':kind, 'thread':threading.current_thread().name,
+              'start':time.time()-self.start, 'duration':None, 'status':'ok'}
+        if parent:
+            span['parent']=parent['id']
+        else:
+            span['parent']=None
+        with self.lock:
+            span['id']=len(self.spans)+1
+            self.spans.append(span)
+        stack=self.stack()
+        stack.append(span)
+        try:
+            yield span
+        except:
+            span['status']='error'
+            raise
+        finally:
+            span['duration']=time.time()-self.start-span['start']
+            stack.pop()
+
+    def label(self, message):
+        """name the innermost open span after the stage it runs"""
+        span=self.current()
+        if span is not None and 'stage' not in span:
+            span['stage']=message
+
+    def write(self, filename):
+        """write all spans as JSON"""
+        trace={'start':self.start, 'spans':self.spans}
+        with open(filename, 'w') as f:
+            json.dump(trace, f, indent=1, sort_keys=True)
+        logger.info("Timing trace is written to "+filename)
+
+    def summary(self, top=10):
+        """lines describing where the wall-clock time went"""
+        lines=[]
+        spans=[span for span in self.spans if span['duration'] is not None]
+        roots=[span for span in spans if span['parent'] is None and span['kind'] != "command"]
+        total=sum([span['duration'] for span in roots]) or 0.000001
+        children={}
+        for span in spans:
+            children.setdefault(span['parent'], []).append(span)
+
+        def add(span, depth):
+            if span['kind'] not in ("operation", "stage", "step"):
+                return
+            commands=[c for c in children.get(span['id'], []) if c['kind'] in ("command", "run_command")]
+            name=span.get('stage', span['name'])
+            if span['kind'] != "operation" and span['name'] not in name:
+                name=span['name']+": "+name
+            lines.append("%8.2fs %5.1f%% %s%s%s%s" %(span['duration'], 100*span['duration']/total, "  "*depth, name,
+                         " (%d commands)" %len(commands) if commands else "", " [Failed]" if span['status'] != "ok" else ""))
+            for child in children.get(span['id'], []):
+                add(child, depth+1)
+
+        lines.append("Time spent per stage:")
+        for span in roots:
+            add(span, 0)
+        commands=sorted([span for span in spans if span['kind'] == "command"], key=lambda span: -span['duration'])
+        if commands:
+            lines.append("Slowest commands:")
+            for span in commands[:top]:
+                lines.append("%8.2fs %5.1f%% %s" %(span['duration'], 100*span['duration']/total, span['name']))
+        return lines
+
+tracer=Tracer()
+
+def traced(function):
+    """record each call of the decorated method as a stage span"""
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with tracer.span(function.__name__, "stage"):
+            return function(*args, **kwargs)
+    return wrapper
+
+# Metrics written by --metrics-file, in the order they are written: name, type, help
+metric_families=[
+    ("xcatha_last_run_timestamp_seconds", "gauge", "Time the last run of the operation finished"),
+    ("xcatha_last_run_success", "gauge", "1 if the last run of the operation succeeded, 0 if it failed"),
+    ("xcatha_operation_duration_seconds", "gauge", "Duration of the last run of the operation"),
+    ("xcatha_stage_duration_seconds", "gauge", "Time spent in each stage by the last run of the operation"),
+    ("xcatha_stage_failed", "gauge", "1 if the stage failed in the last run of the operation"),
+    ("xcatha_commands", "gauge", "External commands run by the last run of the operation"),
+    ("xcatha_command_failures", "gauge", "External commands which exited with an error or timed out"),
+    ("xcatha_command_retries", "gauge", "Commands run again after a failure"),
+    ("xcatha_vip_probe_seconds", "gauge", "Time spent checking that the virtual ip is not in use"),
+    ("xcatha_service_ready_seconds", "gauge", "Time each service took to be ready after it was started"),
+    ("xcatha_services", "gauge", "Services started or stopped, by result"),
+    ("xcatha_service_failed", "gauge", "1 if the service failed to start or to stop"),
+    ("xcatha_copied_bytes", "gauge", "Bytes copied into the shared data directory"),
+    ("xcatha_copied_files", "gauge", "Files copied into the shared data directory"),
+    ("xcatha_resync_bytes", "gauge", "Bytes written into the local directories by a resync"),
+]
+
+def metric_line(name, labels, value):
+    """one sample in Prometheus text format"""
+    pairs=[]
+    for key, label in sorted(labels.items()):
+        label=str(label).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        pairs.append('%s="%s"' %(key, label))
+    return "%s{%s} %s" %(name, ",".join(pairs), repr(float(value)))
+
+def operation_metrics(operation, rc):
+    """samples describing the finished operation, as a dict of metric name to lines"""
+    spans=[span for span in tracer.spans if span['duration'] is not None]
+    samples={}
+
+    def add(name, value, **labels):
+        labels['operation']=operation
+        samples.setdefault(name, []).append(metric_line(name, labels, value))
+
+    add("xcatha_last_run_timestamp_seconds", time.time())
+    add("xcatha_last_run_success", 0 if rc else 1)
+    add("xcatha_operation_duration_seconds", sum([span['duration'] for span in spans if span['kind'] == "operation"]))
+    stages={}
+    failed=set()
+    for span in spans:
+        if span['kind'] == "stage":
+            stages[span['name']]=stages.get(span['name'], 0)+span['duration']
+            if span['status'] != 'ok':
+                failed.add(span['name'])
+    for stage in sorted(stages):
+        add("xcatha_stage_duration_seconds", stages[stage], stage=stage)
+        add("xcatha_stage_failed", 1 if stage in failed else 0, stage=stage)
+    commands=[span for span in spans if span['kind'] == "command"]
+    add("xcatha_commands", len(commands))
+    add("xcatha_command_failures", len([span for span in commands if span.get('rc') or span['status'] != 'ok']))
+    add("xcatha_command_retries", sum([span.get('attempts', 1)-1 for span in spans if span['kind'] == "run_command"]))
+    add("xcatha_vip_probe_seconds", sum([span['duration'] for span in spans if span['kind'] == "vip_probe"]))
+    for service in sorted(ready_times):
+        add("xcatha_service_ready_seconds", ready_times[service], service=service)
+    for action in ("start", "stop"):
+        results=[(service, rc) for (a, service), rc in service_results.items() if a == action]
+        if not results:
+            continue
+        add("xcatha_services", len([r for r in results if not r[1]]), action=action, result="ok")
+        add("xcatha_services", len([r for r in results if r[1]]), action=action, result="failed")
+        for service, rc in sorted(results):
+            add("xcatha_service_failed", 1 if rc else 0, action=action, service=service)
+    add("xcatha_copied_bytes", sum([span.get('copied_bytes', 0) for span in spans]))
+    add("xcatha_copied_files", sum([span.get('copied_files', 0) for span in spans]))
+    add("xcatha_resync_bytes", sum([span.get('resync_bytes', 0) for span in spans]))
+    return samples
+
+def write_metrics(filename, operation, rc):
+    """write the metrics of the operation in node_exporter textfile format
+
+       Samples of the other operations already in the file are kept, so setup,
+       activate and deactivate can share one file.
+    """
+    samples=operation_metrics(operation, rc)
+    own='operation="%s"' %operation
+    try:
+        with open(filename) as f:
+            for line in f:
+                line=line.rstrip("\n")
+                if not line or line.startswith("#") or own in line:
+                    continue
+                samples.setdefault(re.split(r"[{ ]", line, 1)[0], []).append(line)
+    except IOError:
+        pass
+    lines=[]
+    for name, kind, text in metric_families:
+        if name in samples:
+            lines.append("# HELP %s %s" %(name, text))
+            lines.append("# TYPE %s %s" %(name, kind))
+            lines.extend(sorted(samples[name]))
+    try:
+        write_file_atomic(filename, "\n".join(lines)+"\n")
+    except (IOError, OSError), e:
+        logger.error("Failed to write metrics to "+filename+": "+str(e))
+        return 1
+    logger.debug("Metrics are written to "+filename)
+    return 0
+
+def set_stage(message):
+    """enter a new stage"""
+    global setup_process_msg
+    setup_process_msg=message
+    logger.info(setup_process_msg)
+    tracer.label(message)
+
+class Journal(object):
+    """record of completed setup stages on local disk, to resume a failed setup
+
+       Each stage is recorded with a fingerprint of its inputs, chained with the
+       fingerprint of the stage before it, so changed options invalidate a stage.
+    """
+    def __init__(self, path):
+        self.path=path
+        self.stages={}
+        self.previous=""
+        try:
+            with open(path) as f:
+                self.stages=json.load(f).get('stages', {})
+        except (IOError, ValueError, AttributeError):
+            self.stages={}
+
+    def fingerprint(self, name, inputs):
+        """fingerprint of a stage with its inputs"""
+        return hashlib.sha256(json.dumps([self.previous, name, inputs])).hexdigest()
+
+    def completed(self, name, fingerprint):
+        """record of the stage if it completed with the same fingerprint"""
+        record=self.stages.get(name)
+        if record and record.get('status') == "done" and record.get('fingerprint') == fingerprint:
+            return record
+        return None
+
+    def record(self, name, fingerprint, status, duration, message=""):
+        """record the outcome of a stage and write the journal"""
+        global dryrun
+        self.stages[name]={'fingerprint':fingerprint, 'status':status, 'time':time.time(),
+                           'duration':duration, 'message':message}
+        if dryrun:
+            return
+        directory=os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        write_file_atomic(self.path, json.dumps({'stages':self.stages}, indent=1, sort_keys=True))
+
+    def run(self, stages, resume=False, from_stage=None):
+        """run (name, inputs, function, valid) stages in order
+
+           With resume, a stage completed with the same inputs is skipped if valid,
+           a function checking it still holds, is None or returns True. With
+           from_stage, the stages before it are skipped.
+        """
+        names=[stage[0] for stage in stages]
+        if from_stage and from_stage not in names:
+            logger.error("Unknown stage "+from_stage+", stages are "+", ".join(names))
+            raise HaException(setup_process_msg)
+        skipping=bool(from_stage)
+        for name, inputs, function, valid in stages:
+            fingerprint=self.fingerprint(name, inputs)
+            self.previous=fingerprint
+            if name == from_stage:
+                skipping=False
+            if skipping:
+                logger.info("Skip stage "+name+", starting from stage "+from_stage)
+                continue
+            record=self.completed(name, fingerprint) if resume else None
+            if record and (valid is None or valid()):
+                logger.info("Skip stage %s, completed %s [Passed]" %(name, time.strftime("%x %X", time.localtime(record['time']))))
+                continue
+            start=time.time()
+            try:
+                function()
+            except:
+                self.record(name, fingerprint, "failed", time.time()-start, setup_process_msg)
+                logger.error("Stage "+name+" failed, run again with --resume to continue from it")
+                raise
+            self.record(name, fingerprint, "done", time.time()-start)
+        # Nothing is left to resume
+        self.clear()
+
+    def clear(self):
+        """remove the journal"""
+        global dryrun
+        self.stages={}
+        if not dryrun and os.path.exists(self.path):
+            os.unlink(self.path)
+
+class CommandResult(object):
+    """outcome of one command execution"""
+    def __init__(self, cmd, rc, out, err, duration, timed_out=False):
+        self.cmd=cmd
+        self.rc=rc
+        self.out=out
+        self.err=err
+        self.duration=duration
+        self.timed_out=timed_out
+
+def command_string(cmd):
+    """printable form of a command given as string or argv list"""
+    if isinstance(cmd, (list, tuple)):
+        return " ".join([pipes.quote(arg) for arg in cmd])
+    return cmd
+
+def command_argv(cmd):
+    """argv list of cmd, or None when cmd needs a shell for pipes, redirections or expansions"""
+    if isinstance(cmd, (list, tuple)):
+        return list(cmd)
+    if re.search(r'[|&;<>()$`\\*?\[\]{}~\n]', cmd):
+        return None
+    return shlex.split(cmd)
+
+def execute(cmd, timeout=None, deadline=None):
+    """run cmd once and capture its output
+
+       cmd is an argv list, or a string which is split into argv and only given to a
+       shell when it contains pipes, redirections or expansions. The command and its
+       children are killed when it runs for timeout seconds or past the absolute deadline.
+    """
+    if timeout is None:
+        timeout=command_timeout
+    name=command_string(cmd)
+    start=time.time()
+    limit=start+timeout
+    if deadline is not None:
+        limit=min(limit, deadline)
+    with tracer.span(name, "command") as span:
+        out=tempfile.TemporaryFile()
+        err=tempfile.TemporaryFile()
+        devnull=open(os.devnull)
+        try:
+            argv=command_argv(cmd)
+            timed_out=False
+            try:
+                # Own process group, so a timeout kills the whole pipeline
+                proc=Popen(argv or cmd, shell=argv is None, stdin=devnull, stdout=out, stderr=err,
+                           close_fds=True, preexec_fn=os.setsid)
+            except OSError, e:
+                err.write(str(e))
+                rc=127
+            else:
+                delay=0.01
+                while proc.poll() is None:
+                    now=time.time()
+                    if now >= limit:
+                        timed_out=True
+                        kill_process_group(proc)
+                        break
+                    time.sleep(min(delay, limit-now))
+                    delay=min(delay*2, 0.2)
+                rc=proc.wait()
+            out.seek(0)
+            err.seek(0)
+            result=CommandResult(name, rc, out.read(), err.read(), time.time()-start, timed_out)
+        finally:
+            out.close()
+            err.close()
+            devnull.close()
+        span['rc']=rc
+        if timed_out:
+            span['status']='timeout'
+            logger.error("%s did not finish in %.1fs, killed" %(name, limit-start))
+    return result
+
+def kill_process_group(proc, grace=5):
+    """terminate the process group of proc, kill it if it is still running after grace seconds"""
+    try:
+        os.killpg(proc.pid, signal.SIGTERM)
+        end=time.time()+grace
+        while proc.poll() is None and time.time() < end:
+            time.sleep(0.1)
+        if proc.poll() is None:
+            os.killpg(proc.pid, signal.SIGKILL)
+    except OSError:
+        pass
+
+def run_command(cmd, retry, ignore_fail=None, timeout=None, deadline=None):
+    """execute command, try it up to retry times with a growing, jittered delay between attempts
+
+       timeout bounds each attempt and deadline, in seconds, bounds all attempts together.
+       Returns 0 on success and 1 on failure.
+    """
     global dryrun
-    if dryrun:
-        loginfo=cmd+" [Dryrun]"
-        logger.debug(loginfo)
-        return 0
-    a=0
-    while True:
-        res=os.system(cmd)
-        if res is 0:
-            loginfo=cmd+" [Passed]"
+    name=command_string(cmd)
+    with tracer.span(name, "run_command") as span:
+        if dryrun:
+            loginfo=name+" [Dryrun]"
             logger.debug(loginfo)
             return 0
-        else:
-            # Command failed, but do we care ?
-            if ignore_fail:
-                loginfo=cmd+" [Failed, OK to ignore]"
+        end=None
+        if deadline is not None:
+            end=time.time()+deadline
+        a=0
+        while True:
+            a += 1
+            span['attempts']=a
+            res=execute(cmd, timeout, end)
+            if res.rc is 0:
+                loginfo=name+" [Passed]"
                 logger.debug(loginfo)
                 return 0
-            if retry is 0:
-                loginfo=cmd+" [Failed]"
-                logger.error(loginfo)
-                return 1
-            a += 1
-            if a < retry:
-                time.sleep(3)
-                loginfo="Retry "+bytes(a)+" ... ..."+cmd
+            else:
+                # Command failed, but do we care ?
+                if ignore_fail:
+                    loginfo=name+" [Failed, OK to ignore]"
+                    logger.debug(loginfo)
+                    return 0
+                output=(res.err or res.out).strip()
+                if output:
+                    logger.debug(name+": "+output[-2000:])
+                delay=min(retry_delay*(2**(a-1)), retry_delay_max)*random.uniform(0.5, 1)
+                if a >= retry or (end is not None and time.time()+delay >= end):
+                    loginfo=name+" [Failed]"
+                    logger.error(loginfo)
+                    return 1
+                time.sleep(delay)
+                loginfo="Retry "+bytes(a)+" ... ..."+name
                 logger.debug(loginfo)
-            if a==3:
-                loginfo=cmd+" [Failed]"
-                logger.error(loginfo)
-                return 1
+
+def run_step_graph(steps, timeout=None):
+    """run steps concurrently, a step starts as soon as every step it depends on has passed
+
+       steps is a list of (name, depends, function) tuples, function returns 0 on success.
+       Returns a dict of step name to return code, a step that failed, timed out or
+       whose dependency did not pass is reported as 1.
+    """
+    if timeout is None:
+        timeout=service_step_timeout
+    names=[step[0] for step in steps]
+    pending=[(name, [d for d in depends if d in names], function) for name, depends, function in steps]
+    result={}
+    started={}
+    cond=threading.Condition()
+
+    parent=tracer.current()
+
+    def worker(name, function):
+        try:
+            with tracer.span(name, "step", parent):
+                res=function()
+        except Exception, e:
+            logger.error("Step "+name+" raised: "+str(e))
+            res=1
+        with cond:
+            if name not in result:
+                result[name]=1 if res else 0
+                logger.debug("Step %s finished in %.1fs [%s]" %(name, time.time()-started[name], "Failed" if res else "Passed"))
+            cond.notify_all()
+
+    with cond:
+        while len(result) < len(steps):
+            progress=True
+            while progress:
+                progress=False
+                for step in list(pending):
+                    name, depends, function=step
+                    failed=[d for d in depends if result.get(d)]
+                    if failed:
+                        logger.error("Step "+name+" skipped, it depends on failed step "+",".join(failed))
+                        result[name]=1
+                        pending.remove(step)
+                        progress=True
+                    elif not [d for d in depends if d not in result]:
+                        started[name]=time.time()
+                        thread=threading.Thread(target=worker, args=(name, function))
+                        # a hung step must not keep the process alive after its timeout
+                        thread.daemon=True
+                        thread.start()
+                        pending.remove(step)
+                        progress=True
+            if len(result) == len(steps):
+                break
+            now=time.time()
+            wait=timeout
+            for name in started:
+                if name in result:
+                    continue
+                remaining=started[name]+timeout-now
+                if remaining <= 0:
+                    logger.error("Step %s did not finish in %ss [Failed]" %(name, timeout))
+                    result[name]=1
+                else:
+                    wait=min(wait, remaining)
+            if len(result) < len(steps):
+                cond.wait(wait)
+    return result
 
 class HaException(Exception):
     """customize exception"""
@@ -107,6 +723,1871 @@ class HaException(Exception):
         Exception.__init__(self)
         self.message=message
 
+SEEK_DATA=3
+SEEK_HOLE=4
+
+class TreeCopier(object):
+    """copy a directory tree with a pool of worker threads
+
+       The tree is walked once, directories and symlinks are created while walking and
+       regular files are queued to the workers. Files bigger than chunk_size are split
+       into chunk_size pieces so a few huge ISOs are copied by several workers at once.
+       Owner, mode, timestamps and extended attributes are preserved and holes of
+       sparse files are kept.
+    """
+    # copy methods which turned out not to work on this system
+    broken=set()
+
+    def __init__(self, workers=None, chunk_size=None):
+        self.workers=workers or copy_workers
+        self.chunk_size=chunk_size or copy_chunk_size
+        self.tasks=Queue.Queue(self.workers*64)
+        self.lock=threading.Lock()
+        self.pending={}
+        self.errors=[]
+        self.files=0
+        self.dirs=0
+        self.links=0
+        self.bytes=0
+
+    def copy(self, source, target):
+        """copy source tree to target, which must not exist, return 0 on success"""
+        start=time.time()
+        threads=[]
+        for i in range(self.workers):
+            thread=threading.Thread(target=self.worker)
+            thread.daemon=True
+            thread.start()
+            threads.append(thread)
+        dirs=[]
+        try:
+            self.walk(source, target, dirs)
+        finally:
+            for thread in threads:
+                self.tasks.put(None)
+            for thread in threads:
+                thread.join()
+        # Directory attributes are set once their content is in place, deepest first
+        for src, dst, st in reversed(dirs):
+            self.attempt(self.set_attributes, src, dst, st)
+        duration=time.time()-start
+        span=tracer.current()
+        if span is not None:
+            span['copied_bytes']=span.get('copied_bytes', 0)+self.bytes
+            span['copied_files']=span.get('copied_files', 0)+self.files
+        mbytes=self.bytes/1048576.0
+        logger.info("Copied %s to %s: %d files, %d directories, %d symlinks, %.1f MB in %.1fs (%.1f MB/s)"
+                    %(source, target, self.files, self.dirs, self.links, mbytes, duration, mbytes/max(duration, 0.001)))
+        if self.errors:
+            for error in self.errors:
+                logger.error(error)
+            return 1
+        return 0
+
+    def walk(self, source, target, dirs):
+        """create directories and symlinks, queue regular files"""
+        st=os.lstat(source)
+        os.makedirs(target)
+        dirs.append((source, target, st))
+        self.dirs += 1
+        stack=[(source, target)]
+        while stack:
+            src_dir, dst_dir=stack.pop()
+            try:
+                names=os.listdir(src_dir)
+            except OSError, e:
+                self.error(src_dir, e)
+                continue
+            for name in names:
+                src=os.path.join(src_dir, name)
+                dst=os.path.join(dst_dir, name)
+                try:
+                    st=os.lstat(src)
+                    if stat.S_ISDIR(st.st_mode):
+                        os.mkdir(dst, stat.S_IRWXU)
+                        dirs.append((src, dst, st))
+                        self.dirs += 1
+                        stack.append((src, dst))
+                    elif stat.S_ISLNK(st.st_mode):
+                        os.symlink(os.readlink(src), dst)
+                        os.lchown(dst, st.st_uid, st.st_gid)
+                        self.copy_xattrs(src, dst)
+                        self.links += 1
+                    elif stat.S_ISREG(st.st_mode):
+                        self.queue_file(src, dst, st)
+                    else:
+                        logger.warning("Skip special file "+src)
+                except (IOError, OSError), e:
+                    self.error(src, e)
+
+    def queue_file(self, src, dst, st):
+        """split a regular file into chunks and queue them"""
+        fd=os.open(dst, os.O_WRONLY|os.O_CREAT|os.O_TRUNC, stat.S_IRUSR|stat.S_IWUSR)
+        try:
+            # Extending the file up front leaves a hole wherever the source has one
+            os.ftruncate(fd, st.st_size)
+        finally:
+            os.close(fd)
+        chunks=range(0, st.st_size, self.chunk_size) or [0]
+        with self.lock:
+            self.pending[dst]=len(chunks)
+        for offset in chunks:
+            self.tasks.put((src, dst, st, offset, min(self.chunk_size, st.st_size-offset)))
+
+    def worker(self):
+        """copy queued chunks until a None task is received"""
+        while True:
+            task=self.tasks.get()
+            if task is None:
+                return
+            src, dst, st, offset, length=task
+            if length > 0 and not self.attempt(self.copy_chunk, src, dst, offset, length):
+                with self.lock:
+                    self.bytes += length
+            with self.lock:
+                self.pending[dst] -= 1
+                done=self.pending[dst] == 0
+                if done:
+                    del self.pending[dst]
+                    self.files += 1
+            if done:
+                self.attempt(self.set_attributes, src, dst, st)
+
+    def attempt(self, function, src, *args):
+        """call function and record the failure, return 1 if it failed"""
+        try:
+            function(src, *args)
+            return 0
+        except (IOError, OSError), e:
+            self.error(src, e)
+            return 1
+
+    def error(self, src, e):
+        """record a failed entry"""
+        with self.lock:
+            self.errors.append("Copy "+src+" [Failed]: "+str(e))
+
+    def copy_chunk(self, src, dst, offset, length):
+        """copy length bytes at offset of src to dst, skipping holes"""
+        src_fd=os.open(src, os.O_RDONLY)
+        try:
+            dst_fd=os.open(dst, os.O_WRONLY)
+            try:
+                end=offset+length
+                pos=offset
+                while pos < end:
+                    try:
+                        data=os.lseek(src_fd, pos, SEEK_DATA)
+                        hole=min(os.lseek(src_fd, data, SEEK_HOLE), end)
+                    except OSError, e:
+                        if e.errno == errno.ENXIO:
+                            # Only a hole is left
+                            break
+                        if e.errno != errno.EINVAL:
+                            raise
+                        # File system does not report holes
+                        data, hole=pos, end
+                    if data >= end:
+                        break
+                    self.copy_data(src_fd, dst_fd, data, hole-data)
+                    pos=hole
+            finally:
+                os.close(dst_fd)
+        finally:
+            os.close(src_fd)
+
+    def copy_data(self, src_fd, dst_fd, offset, length):
+        """copy a data range in kernel if possible, falling back to read/write"""
+        while length > 0:
+            count=0
+            for method in (self.copy_file_range, self.sendfile):
+                if method.__name__ in TreeCopier.broken:
+                    continue
+                try:
+                    count=method(src_fd, dst_fd, offset, length)
+                    break
+                except OSError, e:
+                    if e.errno not in (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP):
+                        raise
+                    TreeCopier.broken.add(method.__name__)
+            else:
+                count=self.read_write(src_fd, dst_fd, offset, min(length, 1048576))
+            if count <= 0:
+                raise IOError(errno.EIO, "unexpected end of file at offset %d" %offset)
+            offset += count
+            length -= count
+
+    def copy_file_range(self, src_fd, dst_fd, offset, length):
+        """copy_file_range(2), lets the file system share or offload the copy"""
+        function=getattr(os, "copy_file_range", None)
+        if function:
+            return function(src_fd, dst_fd, length, offset, offset)
+        if libc is None or not hasattr(libc, "copy_file_range"):
+            raise OSError(errno.ENOSYS, "copy_file_range is not available")
+        off_in=ctypes.c_int64(offset)
+        off_out=ctypes.c_int64(offset)
+        libc.copy_file_range.restype=ctypes.c_ssize_t
+        count=libc.copy_file_range(src_fd, ctypes.byref(off_in), dst_fd, ctypes.byref(off_out), ctypes.c_size_t(length), 0)
+        if count < 0:
+            e=ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        return count
+
+    def sendfile(self, src_fd, dst_fd, offset, length):
+        """sendfile(2), copies in kernel without going through user space"""
+        os.lseek(dst_fd, offset, os.SEEK_SET)
+        function=getattr(os, "sendfile", None)
+        if function:
+            return function(dst_fd, src_fd, offset, length)
+        if libc is None or not hasattr(libc, "sendfile64"):
+            raise OSError(errno.ENOSYS, "sendfile is not available")
+        off_in=ctypes.c_int64(offset)
+        libc.sendfile64.restype=ctypes.c_ssize_t
+        count=libc.sendfile64(dst_fd, src_fd, ctypes.byref(off_in), ctypes.c_size_t(length))
+        if count < 0:
+            e=ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        return count
+
+    def read_write(self, src_fd, dst_fd, offset, length):
+        """plain read and write, all zero blocks are skipped to keep the file sparse"""
+        os.lseek(src_fd, offset, os.SEEK_SET)
+        data=os.read(src_fd, length)
+        if data.count("\0") != len(data):
+            os.lseek(dst_fd, offset, os.SEEK_SET)
+            view=buffer(data)
+            while view:
+                view=view[os.write(dst_fd, view):]
+        return len(data)
+
+    def set_attributes(self, src, dst, st):
+        """preserve owner, mode, timestamps and extended attributes"""
+        os.lchown(dst, st.st_uid, st.st_gid)
+        self.copy_xattrs(src, dst)
+        # chown clears setuid/setgid bits, so the mode is set afterwards
+        os.chmod(dst, stat.S_IMODE(st.st_mode))
+        os.utime(dst, (st.st_atime, st.st_mtime))
+
+    def copy_xattrs(self, src, dst):
+        """copy extended attributes, such as SELinux labels, without following symlinks
+
+           Attributes which can not be set, like trusted.* without CAP_SYS_ADMIN or
+           security.* on symlinks, are skipped instead of failing the copy.
+        """
+        if hasattr(os, "listxattr"):
+            for name in os.listxattr(src, follow_symlinks=False):
+                try:
+                    os.setxattr(dst, name, os.getxattr(src, name, follow_symlinks=False), follow_symlinks=False)
+                except OSError, e:
+                    if e.errno not in (errno.ENOTSUP, errno.EOPNOTSUPP, errno.EPERM, errno.EACCES):
+                        raise
+                    logger.debug("Skip attribute %s of %s: %s" %(name, dst, os.strerror(e.errno)))
+            return
+        if libc is None or not hasattr(libc, "llistxattr"):
+            return
+        size=libc.llistxattr(src, None, 0)
+        if size <= 0:
+            return
+        names=ctypes.create_string_buffer(size)
+        size=libc.llistxattr(src, names, size)
+        for name in names.raw[:max(size, 0)].split("\0"):
+            if not name:
+                continue
+            length=libc.lgetxattr(src, name, None, 0)
+            if length < 0:
+                continue
+            value=ctypes.create_string_buffer(max(length, 1))
+            length=libc.lgetxattr(src, name, value, length)
+            if length >= 0 and libc.lsetxattr(dst, name, value, length, 0) != 0:
+                e=ctypes.get_errno()
+                if e not in (errno.ENOTSUP, errno.EOPNOTSUPP, errno.EPERM, errno.EACCES):
+                    raise OSError(e, "setxattr "+name+": "+os.strerror(e))
+                logger.debug("Skip attribute %s of %s: %s" %(name, dst, os.strerror(e)))
+
+class ConfigFile(object):
+    """in-memory model of a line based file like /etc/hosts, /etc/resolv.conf or ha_mn
+
+       Lines are indexed by their fields once, so lookups do not rescan the file.
+       The first field is the address of /etc/hosts style lines and the others are
+       names. Appended lines are kept pending until save() writes the whole file
+       at once with an atomic rename.
+    """
+    def __init__(self, path):
+        self.path=path
+        self.lines=[]
+        self.pending=[]
+        self.by_field={}
+        self.by_address={}
+        self.by_name={}
+        self.by_short_name={}
+        self.by_entry={}
+        self.signature=file_signature(path)
+        if self.signature:
+            with open(path) as f:
+                for line in f:
+                    self.index(line)
+
+    def index(self, line):
+        """add a line to the indexes"""
+        number=len(self.lines)
+        self.lines.append(line)
+        fields=line.split("#", 1)[0].split()
+        if not fields:
+            return
+        self.by_entry.setdefault(" ".join(fields), number)
+        self.by_address.setdefault(fields[0], number)
+        for field in fields:
+            self.by_field.setdefault(field, number)
+            if "/" in field:
+                # address/prefix as in pg_hba.conf
+                self.by_field.setdefault(field.split("/", 1)[0], number)
+        for name in fields[1:]:
+            self.by_name.setdefault(name, number)
+            if "." in name:
+                self.by_short_name.setdefault(name.split(".", 1)[0], number)
+
+    def has_field(self, value):
+        """True if a line has value as one of its fields"""
+        return value.strip() in self.by_field
+
+    def has_address(self, address):
+        """True if a line starts with address"""
+        return address.strip() in self.by_address
+
+    def has_name(self, name):
+        """True if a line lists name after its address"""
+        return name.strip() in self.by_name
+
+    def has_long_name(self, short_name):
+        """True if a line lists a long name, short_name.domain, after its address"""
+        return short_name.strip() in self.by_short_name
+
+    def has_entry(self, text):
+        """True if a line consists of the fields of text"""
+        return " ".join(text.split()) in self.by_entry
+
+    def append(self, line):
+        """add a line, written by the next save()"""
+        line=line.rstrip("\n")+"\n"
+        if self.lines and not self.lines[-1].endswith("\n"):
+            self.lines[-1] += "\n"
+        self.pending.append(line)
+        self.index(line)
+
+    def save(self):
+        """write pending changes with a single atomic rename, return 0 on success"""
+        global dryrun
+        if not self.pending:
+            return 0
+        if dryrun:
+            for line in self.pending:
+                logger.debug("Write "+line.strip()+" into "+self.path+" [Dryrun]")
+            self.pending=[]
+            return 0
+        if file_signature(self.path) != self.signature:
+            logger.error(self.path+" changed while it was being edited [Failed]")
+            return 1
+        write_file_atomic(self.path, "".join(self.lines))
+        for line in self.pending:
+            logger.debug("Write "+line.strip()+" into "+self.path)
+        self.pending=[]
+        self.signature=file_signature(self.path)
+        config_files[self.path]=self
+        return 0
+
+config_files={}
+
+def file_signature(path):
+    """identity of the current content of a file, None if it does not exist"""
+    try:
+        st=os.stat(path)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_size, st.st_mtime)
+
+def load_config_file(path):
+    """ConfigFile model of path, parsed again only if the file changed on disk"""
+    model=config_files.get(path)
+    if model is None or model.signature != file_signature(path):
+        model=ConfigFile(path)
+        config_files[path]=model
+    return model
+
+def write_file_atomic(path, content):
+    """replace the content of path through a temporary file and a rename
+
+       The target of a symlink, such as a managed /etc/resolv.conf, is replaced
+       instead of the link. Owner and mode of the previous file are kept.
+    """
+    target=os.path.realpath(path)
+    directory=os.path.dirname(target)
+    fd, tmp=tempfile.mkstemp(prefix="."+os.path.basename(target)+".", dir=directory)
+    try:
+        try:
+            st=os.stat(target)
+            os.fchown(fd, st.st_uid, st.st_gid)
+            os.fchmod(fd, stat.S_IMODE(st.st_mode))
+        except OSError:
+            os.fchmod(fd, 0644)
+        with os.fdopen(fd, "w") as f:
+            fd=None
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, target)
+    except:
+        if fd is not None:
+            os.close(fd)
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+    dirfd=os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(dirfd)
+    finally:
+        os.close(dirfd)
+
+# Nesting depth of include directives PostgreSQL accepts
+pg_include_depth=10
+
+def pg_include_files(directive, target, directory):
+    """files named by an include, include_if_exists or include_dir directive"""
+    if not os.path.isabs(target):
+        target=os.path.join(directory, target)
+    if directive == "include_dir":
+        if not os.path.isdir(target):
+            return []
+        return [os.path.join(target, name) for name in sorted(os.listdir(target))
+                if name.endswith(".conf") and not name.startswith(".")]
+    if directive == "include_if_exists" and not os.path.exists(target):
+        return []
+    return [target]
+
+def ip_in_network(ip, network):
+    """True if ip is the address or falls in the address/prefix network"""
+    address, _, prefix=network.partition("/")
+    if ":" in ip or ":" in address:
+        family, bits=socket.AF_INET6, 128
+    else:
+        family, bits=socket.AF_INET, 32
+    try:
+        value=int(binascii.hexlify(socket.inet_pton(family, ip)), 16)
+        base=int(binascii.hexlify(socket.inet_pton(family, address)), 16)
+        length=int(prefix) if prefix else bits
+    except (socket.error, ValueError):
+        return False
+    shift=bits-length
+    return value >> shift == base >> shift
+
+class PgHbaFile(ConfigFile):
+    """model of pg_hba.conf, with double quoted fields, comments and include directives
+
+       Host records of included files count when looking for an address, lines
+       are only added to the file itself.
+    """
+    def __init__(self, path, depth=0):
+        self.depth=depth
+        self.networks=[]
+        ConfigFile.__init__(self, path)
+
+    def tokens(self, line):
+        """fields of a line, without quotes and comment"""
+        tokens=[]
+        token=None
+        quoted=False
+        for c in line:
+            if quoted:
+                if c == '"':
+                    quoted=False
+                else:
+                    token+=c
+            elif c == '"':
+                quoted=True
+                token=token or ""
+            elif c == '#':
+                break
+            elif c.isspace():
+                if token is not None:
+                    tokens.append(token)
+                    token=None
+            else:
+                token=(token or "")+c
+        if token is not None:
+            tokens.append(token)
+        return tokens
+
+    def index(self, line):
+        """add a line to the indexes"""
+        ConfigFile.index(self, line)
+        fields=self.tokens(line)
+        if len(fields) < 2:
+            return
+        if fields[0] in ("include", "include_if_exists", "include_dir"):
+            if self.depth >= pg_include_depth:
+                logger.warning("Too deeply nested include "+fields[1]+" in "+self.path)
+                return
+            for path in pg_include_files(fields[0], fields[1], os.path.dirname(self.path)):
+                self.networks.extend(PgHbaFile(path, self.depth+1).networks)
+        elif fields[0] == "host" and len(fields) >= 5:
+            # Only records xcatd connects with, hostssl and hostnossl depend on the connection
+            if not set(fields[1].split(",")) & set(["all", "xcatdb"]):
+                return
+            if not set(fields[2].split(",")) & set(["all", "xcatadm"]):
+                return
+            address=fields[3]
+            method=fields[4]
+            if "/" not in address and len(fields) >= 6 and re.match(r'^[\d.]+$', fields[4]):
+                # address and netmask in two fields
+                method=fields[5]
+                try:
+                    mask=int(binascii.hexlify(socket.inet_aton(fields[4])), 16)
+                    address+="/%d" %bin(mask).count("1")
+                except socket.error:
+                    pass
+            # Options such as clientcert=1 may follow the method
+            if method != "reject":
+                self.networks.append(address)
+
+    def allows(self, ip):
+        """True if a host record covers ip"""
+        for network in self.networks:
+            if network == "all" or ip_in_network(ip, network):
+                return True
+        return False
+
+class PostgresqlConf(ConfigFile):
+    """model of postgresql.conf, with quoted values, comments and include directives
+
+       The effective value of a parameter is the last one set, following includes.
+    """
+    setting=re.compile(r"""^\s*([A-Za-z_][\w.-]*)\s*=?\s*('(?:[^'\\]|\\.|'')*'|[^\s#']*)\s*(#.*)?$""")
+
+    def __init__(self, path, depth=0):
+        self.depth=depth
+        self.settings={}
+        ConfigFile.__init__(self, path)
+
+    def index(self, line):
+        """add a line to the indexes"""
+        number=len(self.lines)
+        ConfigFile.index(self, line)
+        match=self.setting.match(line)
+        if not match or not match.group(2):
+            return
+        name=match.group(1).lower()
+        value=match.group(2)
+        if value.startswith("'"):
+            value=re.sub(r"''|\\(.)", lambda m: m.group(1) or "'", value[1:-1])
+        if name in ("include", "include_if_exists", "include_dir"):
+            if self.depth >= pg_include_depth:
+                logger.warning("Too deeply nested include "+value+" in "+self.path)
+                return
+            for path in pg_include_files(name, value, os.path.dirname(self.path)):
+                self.settings.update(PostgresqlConf(path, self.depth+1).settings)
+        else:
+            self.settings[name]=(self.path, number, value, match.group(3))
+
+    def get(self, name):
+        """effective value of a parameter, None if it is not set"""
+        entry=self.settings.get(name.lower())
+        return entry[2] if entry else None
+
+    def set(self, name, value):
+        """set a parameter, in place if this file sets it last, written by the next save()"""
+        entry=self.settings.get(name.lower())
+        line="%s = '%s'" %(name, value.replace("'", "''"))
+        if entry and entry[0] == self.path:
+            if entry[3]:
+                line+="    "+entry[3]
+            self.lines[entry[1]]=line+"\n"
+            self.pending.append(line)
+            self.settings[name.lower()]=(self.path, entry[1], value, entry[3])
+        else:
+            # Lines after all includes of this file take effect last
+            self.append(line)
+
+def ha_state_dir(path):
+    """directory in the shared data holding the state both management nodes look at"""
+    directory=os.path.join(path, ".xcatha")
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    return directory
+
+class Heartbeat(object):
+    """heartbeat record of the active management node in the shared data directory"""
+    def __init__(self, path):
+        self.filename=os.path.join(ha_state_dir(path), "heartbeat")
+        # Unique per process, so a second monitor on the same host is told apart
+        self.owner="%s:%d" %(socket.gethostname(), os.getpid())
+        self.seq=0
+
+    def read(self):
+        """last heartbeat written, or None"""
+        try:
+            with open(self.filename) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def beat(self, interval):
+        """write the next heartbeat"""
+        self.seq += 1
+        write_file_atomic(self.filename, json.dumps({'owner':self.owner, 'host':socket.gethostname(),
+                          'seq':self.seq, 'time':time.time(), 'interval':interval}))
+
+def node_id():
+    """identity of this node, which does not change with the hostname at activation"""
+    try:
+        with open("/etc/machine-id") as f:
+            machine_id=f.read().strip()
+    except IOError:
+        machine_id=""
+    return machine_id or platform.node()
+
+class Lease(object):
+    """exclusive, time-bounded right to be the active management node, in the shared data directory
+
+       The lease file holds the owner, a generation incremented by every acquisition and
+       the expiry time. It is only read and written under a POSIX lock, which NFS supports,
+       so two nodes never both take it. Expiry is compared with the clock of each node,
+       the clocks of the management nodes must be synchronized.
+    """
+    def __init__(self, path, ttl=None):
+        directory=ha_state_dir(path)
+        self.filename=os.path.join(directory, "lease")
+        self.lockname=os.path.join(directory, "lease.lock")
+        self.ttl=ttl or lease_ttl
+        self.owner=node_id()
+        self.generation=None
+
+    @contextlib.contextmanager
+    def locked(self):
+        """hold the lock of the lease file"""
+        fd=os.open(self.lockname, os.O_RDWR|os.O_CREAT, 0644)
+        try:
+            end=time.time()+lease_lock_timeout
+            while True:
+                try:
+                    fcntl.lockf(fd, fcntl.LOCK_EX|fcntl.LOCK_NB)
+                    break
+                except IOError, e:
+                    if e.errno not in (errno.EACCES, errno.EAGAIN) or time.time() >= end:
+                        raise
+                    time.sleep(0.1)
+            yield
+        finally:
+            # Closing the file releases the lock
+            os.close(fd)
+
+    def read(self):
+        """lease record, or None"""
+        try:
+            with open(self.filename) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def write(self, generation, expires):
+        """write the lease record of this node"""
+        write_file_atomic(self.filename, json.dumps({'owner':self.owner, 'host':platform.node(), 'generation':generation,
+                                                     'time':time.time(), 'expires':expires, 'ttl':self.ttl}))
+
+    def holder(self):
+        """record of the lease if another node holds it, None if it is free or held by this node"""
+        with self.locked():
+            record=self.read()
+        if record and record.get('owner') != self.owner and record.get('expires', 0) > time.time():
+            return record
+        return None
+
+    def acquire(self):
+        """take the lease unless another node holds it, return None or the record of the holder"""
+        with self.locked():
+            record=self.read()
+            now=time.time()
+            if record and record.get('owner') != self.owner and record.get('expires', 0) > now:
+                return record
+            generation=(record or {}).get('generation', 0)+1
+            if dryrun:
+                logger.debug("Acquire lease generation %d [Dryrun]" %generation)
+                return None
+            self.write(generation, now+self.ttl)
+            self.generation=generation
+        return None
+
+    def renew(self):
+        """extend the lease, False if another node took it since
+
+           A lease taken by this node in another process, such as the activation before
+           the monitor, is renewed as it is, a missing lease is created and a released one
+           is not renewed.
+        """
+        with self.locked():
+            record=self.read()
+            if record is None:
+                # Activated before leases were used
+                record={'owner':self.owner, 'generation':self.generation or 1}
+            if record.get('owner') != self.owner or record.get('expires', 1) == 0:
+                # Taken by another node, or released
+                return False
+            if self.generation is not None and record.get('generation') != self.generation:
+                return False
+            self.generation=record['generation']
+            if not dryrun:
+                self.write(self.generation, time.time()+self.ttl)
+        return True
+
+    def release(self):
+        """give up the lease if this node holds it"""
+        with self.locked():
+            record=self.read()
+            if record and record.get('owner') == self.owner and not dryrun:
+                self.write(record['generation'], 0)
+
+def start_lease_renewer(lease):
+    """renew lease in a detached process, so it is held for as long as this node is active,
+       until stop_lease_renewer() or until the lease is lost"""
+    global dryrun
+    if dryrun:
+        logger.debug("Start lease renewer [Dryrun]")
+        return
+    stop_lease_renewer()
+    directory=os.path.dirname(lease_renewer_file)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    pid=os.fork()
+    if pid:
+        os.waitpid(pid, 0)
+        return
+    try:
+        # A session of its own, so it outlives the command and its terminal
+        os.setsid()
+        pid=os.fork()
+        if pid:
+            write_file_atomic(lease_renewer_file, "%d\n" %pid)
+            os._exit(0)
+        # Locks held by other threads at fork time would never be released in this process
+        for handler in logging.getLogger().handlers+logger.handlers:
+            handler.createLock()
+        devnull=os.open(os.devnull, os.O_RDWR)
+        for fd in (0, 1, 2):
+            os.dup2(devnull, fd)
+        keep_lease_renewed(lease)
+    except Exception, e:
+        logger.error("Lease renewer stopped: "+str(e))
+    finally:
+        os._exit(0)
+
+def keep_lease_renewed(lease):
+    """renew lease every third of its ttl until it is lost, released or its directory is removed"""
+    logger.info("Renewing lease generation %s every %.1fs in process %d" %(lease.generation, lease.ttl/3.0, os.getpid()))
+    while True:
+        time.sleep(lease.ttl/3.0)
+        try:
+            if not lease.renew():
+                logger.error("The lease was taken by another node or released, renewal stops")
+                return
+        except (IOError, OSError), e:
+            if e.errno == errno.ENOENT:
+                logger.error("The lease directory is gone, renewal stops")
+                return
+            logger.warning("Renew lease [Failed]: "+str(e))
+
+def stop_lease_renewer():
+    """stop the process renewing the lease, if it runs"""
+    global dryrun
+    if dryrun:
+        logger.debug("Stop lease renewer [Dryrun]")
+        return
+    try:
+        with open(lease_renewer_file) as f:
+            pid=int(f.read())
+    except (IOError, ValueError):
+        return
+    try:
+        # The pid may have been reused by an unrelated process
+        with open("/proc/%d/cmdline" %pid) as f:
+            if "xcatha" in f.read():
+                os.kill(pid, signal.SIGTERM)
+                logger.debug("Stopped lease renewer %d" %pid)
+    except (IOError, OSError):
+        pass
+    try:
+        os.remove(lease_renewer_file)
+    except OSError:
+        pass
+
+def mount_points():
+    """mount points of this node, from /proc/self/mountinfo"""
+    points=set()
+    try:
+        with open("/proc/self/mountinfo") as f:
+            for line in f:
+                fields=line.split()
+                # Spaces and other special characters are escaped as octal
+                points.add(re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), fields[4]))
+    except IOError:
+        pass
+    return points
+
+def same_directory(a, b):
+    """True if a and b are the same directory, such as a bind mount and its source"""
+    try:
+        sa=os.stat(a)
+        sb=os.stat(b)
+    except OSError:
+        return False
+    return (sa.st_dev, sa.st_ino) == (sb.st_dev, sb.st_ino)
+
+def defer_remove(path):
+    """move path out of the way and remove it in the background at idle I/O priority"""
+    global dryrun
+    if dryrun:
+        logger.debug("Remove "+path+" in background [Dryrun]")
+        return
+    # A rename within the same directory is a single operation, whatever the size of path
+    stale="%s.stale.%d" %(path, time.time())
+    os.rename(path, stale)
+    cmd=["rm", "-rf", stale]
+    if os.path.exists("/usr/bin/ionice") or os.path.exists("/bin/ionice"):
+        cmd=["ionice", "-c3"]+cmd
+    cmd=["nice", "-n", "19"]+cmd
+    with open(os.devnull, "w") as devnull:
+        # Not waited for, the reaper is left running when xcatha.py exits
+        Popen(cmd, stdout=devnull, stderr=devnull, close_fds=True, preexec_fn=os.setsid)
+    logger.debug("Removing "+stale+" in background")
+
+def rsync_stats(output):
+    """numbers of the --stats summary of rsync, as {name: int}"""
+    stats={}
+    for line in output.splitlines():
+        match=re.match(r"^([A-Za-z][A-Za-z ]+?): ([\d,.]+)", line.strip())
+        if match:
+            stats[match.group(1)]=int(float(match.group(2).replace(",", "")))
+    return stats
+
+def rsync_directory(source, target, bwlimit=None):
+    """bring target up to date with source, transferring only changed blocks
+
+       Runs rsync with its rolling checksum delta transfer, which rsync otherwise skips
+       between local directories, and writes changed blocks in place. Progress is
+       logged every progress_interval seconds. Returns the --stats numbers, or None.
+    """
+    cmd=["rsync", "-aHAX", "--delete", "--inplace", "--no-whole-file", "--stats", "--info=progress2"]
+    if bwlimit:
+        cmd.append("--bwlimit=%d" %bwlimit)
+    cmd += [source.rstrip("/")+"/", target.rstrip("/")+"/"]
+    name=command_string(cmd)
+    if dryrun:
+        logger.info(name+" [Dryrun]")
+        return {}
+    start=time.time()
+    with tracer.span(name, "command") as span:
+        err=tempfile.TemporaryFile()
+        devnull=open(os.devnull)
+        try:
+            try:
+                proc=Popen(cmd, stdin=devnull, stdout=PIPE, stderr=err, close_fds=True)
+            except OSError, e:
+                span['rc']=127
+                logger.error(name+": "+str(e))
+                return None
+            output=[]
+            logged=start
+            for block in iter(lambda: os.read(proc.stdout.fileno(), 4096), ""):
+                output.append(block)
+                if time.time()-logged >= progress_interval:
+                    logged=time.time()
+                    # progress2 lines end with a carriage return: bytes, percent, rate, ...
+                    progress=[line.split() for line in re.split(r"[\r\n]", "".join(output[-2:])) if "%" in line]
+                    if progress:
+                        logger.info("Resync %s: %s" %(target, " ".join(progress[-1][:3])))
+            rc=proc.wait()
+            err.seek(0)
+            error=err.read().strip()
+            proc.stdout.close()
+        finally:
+            err.close()
+            devnull.close()
+        span['rc']=rc
+    duration=time.time()-start
+    if rc is not 0:
+        logger.error("%s [Failed] %s" %(name, error[-2000:]))
+        return None
+    stats=rsync_stats("".join(output))
+    transferred=stats.get("Total transferred file size", 0)
+    literal=stats.get("Literal data", 0)
+    span['resync_bytes']=literal
+    logger.info("Resync %s from %s: %d of %d files, %.1f MB changed, %.1f MB written, %.1f MB matched in %.1fs (%.1f MB/s)"
+                %(target, source, stats.get("Number of regular files transferred", 0), stats.get("Number of files", 0),
+                  transferred/1048576.0, literal/1048576.0, stats.get("Matched data", 0)/1048576.0, duration,
+                  transferred/1048576.0/max(duration, 0.001)))
+    return stats
+
+def sha256_file(path):
+    """sha256 hex digest of a file"""
+    digest=hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024*1024), ""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def installed_rpms():
+    """name-version-release.arch of every installed package"""
+    result=execute(["rpm", "-qa", "--qf", "%{NAME}-%{VERSION}-%{RELEASE}.%{ARCH}\\n"])
+    return set(line.strip() for line in result.out.splitlines() if line.strip() and "gpg-pubkey" not in line)
+
+def package_closure(packages):
+    """packages and every package they require, recursively, as name.arch, None on failure"""
+    result=execute(["repoquery", "--requires", "--resolve", "--recursive", "--qf", "%{NAME}.%{ARCH}"]+packages,
+                   install_timeout)
+    if result.rc:
+        logger.error("repoquery --requires --resolve --recursive [Failed]: "+result.err.strip()[-2000:])
+        return None
+    return set(packages)|set(line.strip() for line in result.out.splitlines() if line.strip())
+
+class ArtifactCache(object):
+    """downloaded files and packages, kept with their checksums so that the other
+       management node and later runs install from them instead of remote repositories
+
+       Each entry is a directory with a SHA256SUMS file, written once the entry is complete.
+    """
+    def __init__(self, directory):
+        self.directory=directory
+
+    def verified(self, name):
+        """files of an entry if it is complete and every checksum matches, None otherwise"""
+        entry=os.path.join(self.directory, name)
+        try:
+            with open(os.path.join(entry, "SHA256SUMS")) as f:
+                sums=[line.split(None, 1) for line in f if line.strip()]
+        except IOError:
+            return None
+        files=[]
+        for checksum, filename in sums:
+            path=os.path.join(entry, filename.strip())
+            if not os.path.isfile(path) or sha256_file(path) != checksum:
+                logger.warning("Checksum of cached %s does not match, it is downloaded again" %path)
+                return None
+            files.append(path)
+        return files
+
+    def add(self, name, populate):
+        """create an entry, populate(directory) fills it and returns 0 on success"""
+        global dryrun
+        if dryrun:
+            logger.debug("Cache "+name+" in "+self.directory+" [Dryrun]")
+            return 0
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        work=tempfile.mkdtemp(prefix="."+name+".", dir=self.directory)
+        try:
+            if populate(work):
+                return 1
+            sums=["%s  %s\n" %(sha256_file(os.path.join(work, filename)), filename)
+                  for filename in sorted(os.listdir(work))]
+            if not sums:
+                return 1
+            write_file_atomic(os.path.join(work, "SHA256SUMS"), "".join(sums))
+            entry=os.path.join(self.directory, name)
+            if os.path.exists(entry):
+                shutil.rmtree(entry)
+            os.rename(work, entry)
+            logger.info("Cached %d files of %s in %s" %(len(sums), name, entry))
+            return 0
+        finally:
+            if os.path.exists(work):
+                shutil.rmtree(work)
+
+    def prune(self, prefix, keep):
+        """remove all but the keep most recently added or used entries whose name starts with prefix"""
+        global dryrun
+        try:
+            entries=[os.path.join(self.directory, entry) for entry in os.listdir(self.directory)
+                     if entry.startswith(prefix)]
+            entries.sort(key=os.path.getmtime, reverse=True)
+        except OSError, e:
+            logger.debug("Prune "+prefix+"* in "+self.directory+": "+str(e))
+            return
+        for entry in entries[keep:]:
+            if dryrun:
+                logger.debug("Remove "+entry+" [Dryrun]")
+                continue
+            shutil.rmtree(entry, ignore_errors=True)
+            logger.debug("Removed "+entry)
+
+    def fetch(self, url, name):
+        """local copy of url, downloaded into the cache unless it is there already, None on failure"""
+        files=self.verified(name)
+        if files:
+            logger.debug("Use cached "+files[0])
+            return files[0]
+        filename=os.path.basename(urlparse.urlparse(url).path) or name
+        def download(directory):
+            try:
+                source=urllib2.urlopen(url, timeout=command_timeout)
+                try:
+                    with open(os.path.join(directory, filename), 'wb') as f:
+                        shutil.copyfileobj(source, f)
+                finally:
+                    source.close()
+            except (urllib2.URLError, IOError, socket.error), e:
+                logger.error("Download "+url+" [Failed]: "+str(e))
+                return 1
+            logger.debug("Download "+url+" [Passed]")
+            return 0
+        if self.add(name, download):
+            return None
+        return os.path.join(self.directory, name, filename)
+
+    def install(self, name, install):
+        """install the packages cached as name, or run install() and cache the packages it added"""
+        global dryrun
+        rpms=self.verified(name)
+        if rpms:
+            logger.info("Install %s from %d cached packages" %(name, len(rpms)))
+            # The cache holds every dependency, it is enough without network access
+            if run_command(["yum", "-y", "--disablerepo=*", "localinstall"]+rpms, 0, timeout=install_timeout) is 0:
+                return 0
+            logger.warning("Cached packages of %s are not enough, install them with the remote repositories" %name)
+            return run_command(["yum", "-y", "localinstall"]+rpms, 0, timeout=install_timeout)
+        before=installed_rpms()
+        res=install()
+        if res is not 0 or dryrun:
+            return res
+        added=sorted(installed_rpms()-before)
+        if added:
+            def download(directory):
+                # Dependencies already installed on this node may be missing on the other one,
+                #     which yumdownloader --resolve would skip
+                closure=package_closure(added)
+                if closure is None:
+                    return 1
+                return run_command(["yumdownloader", "--destdir", directory]+sorted(closure), 0, timeout=install_timeout)
+            if self.add(name, download):
+                logger.warning("Packages of %s could not be cached" %name)
+        return res
+
+# Files written by the xCAT commands generating service configuration, and the tables
+#     they are generated from. The node entries "makedhcp -a" adds to dhcpd are not kept,
+#     they are always added from the current tables
+generated_files={
+    'makedns':["/etc/named.conf", "/var/named/db.*"],
+    'makedhcp':["/etc/dhcp/dhcpd.conf", "/etc/dhcp/dhcpd6.conf"],
+    'makeconservercf':["/etc/conserver.cf"],
+    'makegocons':["/var/lib/goconserver/*"],
+}
+generated_from_tables=["site", "networks", "hosts", "nodelist", "noderes", "nodehm", "mac"]
+# Kept configurations of each command, enough for both management nodes and a change of the tables
+generated_keep=4
+
+def table_fingerprint():
+    """sha256 of the tables the service configuration is generated from and of the
+       networks, /etc/hosts and /etc/resolv.conf of this node, None if one can not be read
+
+       The lines of /etc/hosts and /etc/resolv.conf naming a physical address of this
+       node are left out, so that both management nodes get the same fingerprint.
+    """
+    dumps={}
+    def dump(table):
+        result=execute(["tabdump", table])
+        dumps[table]=result.out
+        return result.rc
+    result=run_step_graph([(table, [], lambda table=table: dump(table)) for table in generated_from_tables],
+                          command_timeout)
+    if [table for table in result if result[table]]:
+        return None
+    digest=hashlib.sha256()
+    for table in generated_from_tables:
+        digest.update("%s\0%s\0" %(table, dumps[table]))
+    addresses=address_table().addresses
+    # makedns reads the names of /etc/hosts, the own name of each management node differs
+    physical=set([address['ip'] for address in addresses
+                  if address['label'] == address['device'] and not address['flags'] & IFA_F_SECONDARY])
+    for filename in [etc_hosts, resolv_conf]:
+        try:
+            with open(filename) as f:
+                lines=[line.split("#")[0].split() for line in f]
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                return None
+            lines=[]
+        kept=[" ".join(fields) for fields in lines
+              if fields and not [field for field in fields if canonical_ip(field) in physical]]
+        digest.update("%s\0%s\0" %(os.path.basename(filename), "\n".join(kept)))
+    # The generated configuration names the interfaces and subnets of the node
+    networks=set()
+    for address in addresses:
+        raw=bytearray(socket.inet_pton(address['family'], address['ip']))
+        for i in range(len(raw)):
+            raw[i] &= (0xff << max(8-max(address['prefixlen']-8*i, 0), 0)) & 0xff
+        networks.add("%s %s/%d" %(address['device'], socket.inet_ntop(address['family'], str(raw)), address['prefixlen']))
+    digest.update("\n".join(sorted(networks)))
+    return digest.hexdigest()
+
+class GeneratedConfig(object):
+    """service configuration generated by makedns, makedhcp, makeconservercf and makegocons,
+       kept in the shared data directory with the fingerprint of the tables it came from
+
+       When the fingerprint is unchanged at activation, the kept files are put in place
+       instead of generating them again for every node of the cluster. Entries are named
+       after the fingerprint, so the configuration of both management nodes is kept.
+    """
+    def __init__(self, path):
+        self.cache=None
+        if path:
+            self.cache=ArtifactCache(os.path.join(path, ".xcatha", "generated"))
+        self.fingerprint=None
+
+    def compute(self):
+        """fingerprint the tables, once xcatd is up"""
+        if self.cache is not None and not dryrun:
+            start=time.time()
+            self.fingerprint=table_fingerprint()
+            logger.debug("Fingerprint of tables %s is %s (%.1fs)" %(",".join(generated_from_tables), self.fingerprint, time.time()-start))
+        return 0
+
+    def entry(self, name):
+        """cache entry of the files generated by name from the tables of the fingerprint"""
+        return "%s.%s" %(name, self.fingerprint[:16])
+
+    def reuse(self, name):
+        """put the files kept for name in place if they came from the same tables, True if they were"""
+        if not self.fingerprint:
+            return False
+        files=self.cache.verified(self.entry(name))
+        if not files:
+            logger.info("No configuration generated by %s is kept for these tables" %name)
+            return False
+        kept=dict((os.path.basename(f), f) for f in files)
+        try:
+            with open(kept.pop("fingerprint")) as f:
+                if f.read().strip() != self.fingerprint:
+                    logger.info("Tables changed since the configuration of %s was generated" %name)
+                    return False
+        except (KeyError, IOError):
+            return False
+        try:
+            for filename, cached in kept.items():
+                target=urllib.unquote(filename)
+                st=os.stat(cached)
+                directory=os.path.dirname(target)
+                if not os.path.isdir(directory):
+                    os.makedirs(directory)
+                fd, tmp=tempfile.mkstemp(prefix="."+os.path.basename(target)+".", dir=directory)
+                os.close(fd)
+                shutil.copy2(cached, tmp)
+                os.chown(tmp, st.st_uid, st.st_gid)
+                os.rename(tmp, target)
+            # Most recently used entries are the ones kept by prune
+            os.utime(os.path.dirname(files[0]), None)
+        except (IOError, OSError), e:
+            logger.warning("Configuration kept for %s can not be put in place, it is generated again: %s" %(name, e))
+            return False
+        logger.info("Reuse %d files generated by %s, tables are unchanged" %(len(kept), name))
+        return True
+
+    def store(self, name):
+        """keep the files generated by name with the fingerprint of the tables"""
+        if not self.fingerprint:
+            return
+        def populate(directory):
+            files=[f for pattern in generated_files[name] for f in sorted(glob.glob(pattern)) if os.path.isfile(f)]
+            if not files:
+                return 1
+            try:
+                for f in files:
+                    kept=os.path.join(directory, urllib.quote(f, safe=""))
+                    shutil.copy2(f, kept)
+                    st=os.stat(f)
+                    os.chown(kept, st.st_uid, st.st_gid)
+                with open(os.path.join(directory, "fingerprint"), "w") as f:
+                    f.write(self.fingerprint+"\n")
+            except (IOError, OSError), e:
+                logger.debug("Keep configuration of "+name+": "+str(e))
+                return 1
+            return 0
+        if self.cache.add(self.entry(name), populate):
+            logger.debug("Configuration generated by "+name+" is not kept")
+            return
+        self.cache.prune(name+".", generated_keep)
+
+def artifact_cache():
+    """cache of downloads and packages, None if there is no place for it"""
+    if not cache_dir:
+        return None
+    return ArtifactCache(cache_dir)
+
+# Shared directories left out of the manifest, databases check their own files
+manifest_excludes=["/var/lib/pgsql", "/var/lib/mysql"]
+
+class Manifest(object):
+    """size, mtime and sha256 of every file in the shared data directory
+
+       Kept in .xcatha/manifest.json of the shared data directory. Updating it hashes
+       only files whose size or mtime changed since the last update, verifying it
+       hashes only files whose size or mtime differ from it, with a pool of worker threads.
+    """
+    def __init__(self, path, workers=None):
+        self.path=path
+        self.file=os.path.join(path, ".xcatha", "manifest.json")
+        self.workers=workers or copy_workers
+        self.files={}
+        self.links={}
+        self.time=None
+        try:
+            with open(self.file) as f:
+                manifest=json.load(f)
+            self.files=manifest['files']
+            self.links=manifest['links']
+            self.time=manifest['time']
+        except (IOError, ValueError, KeyError, TypeError):
+            pass
+
+    def scan(self):
+        """files as {name: (size, mtime)} and symlinks as {name: target} under the shared directories"""
+        files={}
+        links={}
+        for sharedfs in shared_fs:
+            top=self.path+sharedfs
+            if sharedfs in manifest_excludes or not os.path.isdir(top):
+                continue
+            for root, dirs, names in os.walk(top):
+                for name in dirs+names:
+                    full=os.path.join(root, name)
+                    relative=full[len(self.path):]
+                    st=os.lstat(full)
+                    if stat.S_ISLNK(st.st_mode):
+                        links[relative]=os.readlink(full)
+                    elif stat.S_ISREG(st.st_mode):
+                        files[relative]=(st.st_size, st.st_mtime)
+        return files, links
+
+    def hash(self, names):
+        """sha256 of the named files, concurrently, as {name: digest}, None for an unreadable file"""
+        digests={}
+        tasks=Queue.Queue()
+        for name in names:
+            tasks.put(name)
+        def worker():
+            while True:
+                try:
+                    name=tasks.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    digests[name]=sha256_file(self.path+name)
+                except (IOError, OSError), e:
+                    logger.debug("Can not hash "+self.path+name+": "+str(e))
+                    digests[name]=None
+        threads=[threading.Thread(target=worker) for i in range(min(self.workers, len(names)))]
+        for thread in threads:
+            thread.daemon=True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return digests
+
+    def update(self):
+        """bring the manifest up to date with the shared directories and write it, return 0 on success"""
+        start=time.time()
+        files, links=self.scan()
+        changed=[name for name, (size, mtime) in files.items()
+                 if name not in self.files or self.files[name][:2] != [size, mtime]]
+        digests=self.hash(changed)
+        unreadable=[name for name in changed if digests[name] is None]
+        if unreadable:
+            logger.error("Can not hash %d files for the manifest, first is %s" %(len(unreadable), self.path+unreadable[0]))
+            return 1
+        self.files=dict((name, [size, mtime, digests[name] if name in digests else self.files[name][2]])
+                        for name, (size, mtime) in files.items())
+        self.links=links
+        self.time=time.time()
+        hashed=sum([files[name][0] for name in changed])/1048576.0
+        if dryrun:
+            logger.debug("Write manifest "+self.file+" [Dryrun]")
+        else:
+            write_file_atomic(os.path.join(ha_state_dir(self.path), "manifest.json"),
+                              json.dumps({'time':self.time, 'files':self.files, 'links':self.links}))
+        logger.info("Manifest of %s: %d files, %d hashed (%.1f MB) in %.1fs"
+                    %(self.path, len(files), len(changed), hashed, time.time()-start))
+        return 0
+
+    def verify(self):
+        """differences between the shared directories and the manifest, as a list of messages
+
+           Files with the size and mtime of the manifest are taken as unchanged, the others
+           are hashed. Files which are not in the manifest are not reported.
+        """
+        start=time.time()
+        files, links=self.scan()
+        problems=[]
+        suspect=[]
+        for name, (size, mtime, digest) in sorted(self.files.items()):
+            if name not in files:
+                problems.append(name+" is missing")
+            elif list(files[name]) != [size, mtime]:
+                suspect.append(name)
+        digests=self.hash(suspect)
+        for name in suspect:
+            if digests[name] != self.files[name][2]:
+                problems.append(name+" has changed")
+        for name, target in sorted(self.links.items()):
+            if links.get(name) != target:
+                problems.append(name+" is not a symlink to "+target)
+        logger.info("Verified %d files of %s against the manifest, %d hashed, in %.1fs"
+                    %(len(self.files), self.path, len(suspect), time.time()-start))
+        return problems
+
+ETH_P_ARP=0x0806
+ETH_P_IP=0x0800
+ARP_REQUEST=1
+ARP_REPLY=2
+ETH_BROADCAST="\xff"*6
+
+def nic_device(nic):
+    """network device of a nic, eth0 for the eth0:1 alias"""
+    return nic.split(":")[0]
+
+def nic_hwaddr(nic):
+    """MAC address of a nic as 6 bytes"""
+    with open("/sys/class/net/"+nic_device(nic)+"/address") as f:
+        return binascii.unhexlify(f.read().strip().replace(":", ""))
+
+def arp_frame(op, src_mac, src_ip, dst_mac, dst_ip, eth_dst=ETH_BROADCAST):
+    """ethernet frame carrying an ARP request or reply"""
+    return (eth_dst+src_mac+struct.pack("!H", ETH_P_ARP)+
+            struct.pack("!HHBBH", 1, ETH_P_IP, 6, 4, op)+
+            src_mac+socket.inet_aton(src_ip)+dst_mac+socket.inet_aton(dst_ip))
+
+NETLINK_ROUTE=0
+NLMSG_ERROR=2
+NLMSG_DONE=3
+NLM_F_REQUEST=0x1
+NLM_F_ACK=0x4
+NLM_F_EXCL=0x200
+NLM_F_CREATE=0x400
+NLM_F_DUMP=0x300
+RTM_NEWADDR=20
+RTM_DELADDR=21
+RTM_GETADDR=22
+IFA_ADDRESS=1
+IFA_LOCAL=2
+IFA_LABEL=3
+IFA_BROADCAST=4
+IFA_FLAGS=8
+IFA_F_SECONDARY=0x01
+IFA_F_NODAD=0x02
+IFA_F_DADFAILED=0x08
+IFA_F_TENTATIVE=0x40
+RT_SCOPE_UNIVERSE=0
+
+# Addresses are read and changed with "netlink" requests to the kernel, or with
+#     "command", the ip command, where rtnetlink is not available
+address_backend="netlink"
+
+def rtattr(kind, value):
+    """netlink attribute, padded to 4 bytes"""
+    length=4+len(value)
+    return struct.pack("=HH", length, kind)+value+"\0"*((4-length%4)%4)
+
+def rtattrs(data):
+    """netlink attributes as {type: value}"""
+    attrs={}
+    offset=0
+    while offset+4 <= len(data):
+        length, kind=struct.unpack_from("=HH", data, offset)
+        if length < 4:
+            break
+        attrs[kind]=data[offset+4:offset+length]
+        offset += (length+3) & ~3
+    return attrs
+
+class Netlink(object):
+    """rtnetlink socket sending requests and collecting their replies"""
+    def __init__(self):
+        self.socket=socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+        self.socket.bind((0, 0))
+        self.seq=int(time.time())
+
+    def close(self):
+        self.socket.close()
+
+    def request(self, kind, flags, payload):
+        """send a request, return the (type, payload) replies, an error reply raises OSError"""
+        self.seq += 1
+        self.socket.send(struct.pack("=IHHII", 16+len(payload), kind, flags|NLM_F_REQUEST, self.seq, 0)+payload)
+        replies=[]
+        while True:
+            data=self.socket.recv(65536)
+            offset=0
+            while offset+16 <= len(data):
+                length, kind, flags, seq, pid=struct.unpack_from("=IHHII", data, offset)
+                body=data[offset+16:offset+length]
+                offset += (max(length, 16)+3) & ~3
+                if seq != self.seq:
+                    continue
+                if kind == NLMSG_DONE:
+                    return replies
+                if kind == NLMSG_ERROR:
+                    error=-struct.unpack_from("=i", body)[0]
+                    if error:
+                        raise OSError(error, os.strerror(error))
+                    # acknowledgement
+                    return replies
+                replies.append((kind, body))
+
+def canonical_ip(ip):
+    """ip in the form the kernel reports it, so "fd00::0:1" and "fd00::1" compare equal"""
+    family=socket.AF_INET6 if ":" in ip else socket.AF_INET
+    try:
+        return socket.inet_ntop(family, socket.inet_pton(family, ip))
+    except (socket.error, ValueError):
+        return ip
+
+def netmask_prefix(mask):
+    """prefix length of a netmask given as 255.255.255.0 or as 24"""
+    if str(mask).isdigit():
+        return int(mask)
+    return sum([bin(ord(byte)).count("1") for byte in socket.inet_aton(mask)])
+
+def interface_names():
+    """network device names by interface index"""
+    names={}
+    for device in os.listdir("/sys/class/net"):
+        try:
+            with open("/sys/class/net/"+device+"/ifindex") as f:
+                names[int(f.read())]=device
+        except (IOError, ValueError):
+            pass
+    return names
+
+class AddressTable(object):
+    """addresses of this node from a single dump, indexed by ip and by interface
+
+       Each address is a dict with ip, prefixlen, family, device, label and flags.
+    """
+    def __init__(self, addresses):
+        self.addresses=addresses
+        self.by_ip={}
+        self.by_interface={}
+        for address in addresses:
+            self.by_ip.setdefault(address['ip'], address)
+            self.by_interface.setdefault(address['device'], []).append(address)
+
+    def local(self, ip):
+        """True if ip is configured on this node"""
+        return canonical_ip(ip) in self.by_ip
+
+    def primary(self, device, family=socket.AF_INET):
+        """primary address of device, the one not added as an alias, or None"""
+        candidates=[address for address in self.by_interface.get(device, [])
+                    if address['family'] == family and not address['flags'] & IFA_F_SECONDARY]
+        for address in candidates:
+            if address['label'] == device:
+                return address
+        if candidates:
+            return candidates[0]
+        return None
+
+def dump_addresses_netlink():
+    """addresses of all interfaces from one RTM_GETADDR dump"""
+    netlink=Netlink()
+    try:
+        replies=netlink.request(RTM_GETADDR, NLM_F_DUMP, struct.pack("=BBBBI", socket.AF_UNSPEC, 0, 0, 0, 0))
+    finally:
+        netlink.close()
+    names=interface_names()
+    addresses=[]
+    for kind, body in replies:
+        if kind != RTM_NEWADDR:
+            continue
+        family, prefixlen, flags, scope, index=struct.unpack_from("=BBBBI", body)
+        attrs=rtattrs(body[8:])
+        # IFA_ADDRESS is the peer of a point-to-point IPv4 address, IFA_LOCAL the address itself
+        raw=attrs.get(IFA_LOCAL) or attrs.get(IFA_ADDRESS)
+        if raw is None or family not in (socket.AF_INET, socket.AF_INET6):
+            continue
+        if IFA_FLAGS in attrs:
+            flags=struct.unpack("=I", attrs[IFA_FLAGS][:4])[0]
+        device=names.get(index, str(index))
+        addresses.append({'ip':socket.inet_ntop(family, raw), 'prefixlen':prefixlen, 'family':family,
+                          'device':device, 'label':attrs.get(IFA_LABEL, device).rstrip("\0"), 'flags':flags})
+    return addresses
+
+def dump_addresses_command():
+    """addresses of all interfaces from one "ip -o addr show" """
+    addresses=[]
+    for line in execute(["ip", "-o", "addr", "show"]).out.splitlines():
+        fields=line.split("\\")[0].split()
+        if len(fields) < 4 or fields[2] not in ("inet", "inet6"):
+            continue
+        device=fields[1].split("@")[0]
+        ip, prefixlen=fields[3].split("/")
+        label=fields[-1] if fields[2] == "inet" and fields[-1].startswith(device) else device
+        flags=IFA_F_SECONDARY if "secondary" in fields else 0
+        addresses.append({'ip':canonical_ip(ip), 'prefixlen':int(prefixlen),
+                          'family':socket.AF_INET6 if fields[2] == "inet6" else socket.AF_INET,
+                          'device':device, 'label':label, 'flags':flags})
+    return addresses
+
+def address_table():
+    """addresses of this node"""
+    if address_backend == "netlink":
+        try:
+            return AddressTable(dump_addresses_netlink())
+        except (socket.error, OSError), e:
+            logger.debug("rtnetlink address dump is not possible, using ip: "+str(e))
+    return AddressTable(dump_addresses_command())
+
+def change_address(action, ip, prefixlen, nic):
+    """add or del ip with prefixlen on nic, return 0 on success
+
+       An IPv4 address gets nic as label, so eth0:0 shows up as an alias, and its
+       broadcast address. An IPv6 address is added without duplicate address
+       detection, the preflight check has probed it already.
+    """
+    device=nic_device(nic)
+    family=socket.AF_INET6 if ":" in ip else socket.AF_INET
+    if address_backend != "netlink":
+        cmd=["ip", "addr", action, "%s/%d" %(ip, prefixlen), "dev", device]
+        if family == socket.AF_INET:
+            cmd += ["label", nic]
+        elif action == "add":
+            cmd.append("nodad")
+        return run_command(cmd, 0)
+    name="rtnetlink %s %s/%d dev %s" %(action, ip, prefixlen, device)
+    if family == socket.AF_INET:
+        name += " label "+nic
+    if dryrun:
+        logger.debug(name+" [Dryrun]")
+        return 0
+    with tracer.span(name, "command") as span:
+        raw=socket.inet_pton(family, ip)
+        flags=0
+        attrs=rtattr(IFA_LOCAL, raw)+rtattr(IFA_ADDRESS, raw)
+        if family == socket.AF_INET:
+            if action == "add":
+                host=(1 << (32-prefixlen))-1
+                broadcast=struct.unpack("!I", raw)[0] | host
+                attrs += rtattr(IFA_BROADCAST, struct.pack("!I", broadcast))
+            attrs += rtattr(IFA_LABEL, nic+"\0")
+        elif action == "add":
+            flags=IFA_F_NODAD
+        try:
+            with open("/sys/class/net/"+device+"/ifindex") as f:
+                index=int(f.read())
+            netlink=Netlink()
+            try:
+                payload=struct.pack("=BBBBI", family, prefixlen, flags, RT_SCOPE_UNIVERSE, index)+attrs
+                if action == "add":
+                    netlink.request(RTM_NEWADDR, NLM_F_CREATE|NLM_F_EXCL|NLM_F_ACK, payload)
+                else:
+                    netlink.request(RTM_DELADDR, NLM_F_ACK, payload)
+            finally:
+                netlink.close()
+        except (IOError, OSError, socket.error, ValueError), e:
+            span['rc']=1
+            logger.error("%s [Failed]: %s" %(name, e))
+            return 1
+        span['rc']=0
+        logger.debug(name+" [Passed]")
+        return 0
+
+def vip_bindings(vip, nic, mask):
+    """(vip, nic, mask) of the virtual ip followed by those of extra_vips"""
+    return [(vip, nic, mask)]+[tuple(binding) for binding in extra_vips]
+
+def is_local_ip(ip):
+    """True if ip is configured on this node"""
+    return address_table().local(ip)
+
+def arp_probe(ip, nic, timeout=None, count=None):
+    """ask for the owner of ip on the link of nic
+
+       Sends count ARP probes spread over timeout seconds and returns as soon as a reply
+       arrives. Returns the MAC address that answered as "aa:bb:..", or None.
+    """
+    if timeout is None:
+        timeout=vip_probe_timeout
+    if count is None:
+        count=vip_probe_count
+    device=nic_device(nic)
+    own_mac=nic_hwaddr(device)
+    # RFC 5227 probe: sender address 0.0.0.0, so no neighbor updates its ARP cache
+    probe=arp_frame(ARP_REQUEST, own_mac, "0.0.0.0", "\0"*6, ip)
+    target=socket.inet_aton(ip)
+    s=socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.htons(ETH_P_ARP))
+    try:
+        s.bind((device, ETH_P_ARP))
+        start=time.time()
+        end=start+timeout
+        interval=float(timeout)/max(count, 1)
+        next_send=start
+        sent=0
+        while True:
+            now=time.time()
+            if now >= end:
+                return None
+            if sent < count and now >= next_send:
+                s.send(probe)
+                sent += 1
+                next_send=start+sent*interval
+            wait=end-now
+            if sent < count:
+                wait=min(wait, next_send-now)
+            readable=select.select([s], [], [], max(wait, 0))[0]
+            if not readable:
+                continue
+            frame=s.recv(2048)
+            if len(frame) < 42 or frame[12:14] != struct.pack("!H", ETH_P_ARP):
+                continue
+            op=struct.unpack("!H", frame[20:22])[0]
+            sender_mac=frame[22:28]
+            # A reply, or a request sent by the owner of ip, means ip is taken
+            if op in (ARP_REQUEST, ARP_REPLY) and frame[28:32] == target and sender_mac != own_mac:
+                return ":".join(["%02x" %ord(c) for c in sender_mac])
+    finally:
+        s.close()
+
+def vip_owner(vip, nic=None):
+    """who already answers for the virtual ip, None if nobody does"""
+    with tracer.span(vip, "vip_probe") as span:
+        span['owner']=probe_vip_owner(vip, nic)
+        return span['owner']
+
+def probe_vip_owner(vip, nic):
+    """probe the virtual ip on this node, with ARP on nic or with ping"""
+    start=time.time()
+    owner=None
+    method="local addresses"
+    probed=False
+    if is_local_ip(vip):
+        owner="this node"
+    elif nic and ":" not in vip:
+        method="ARP on "+nic_device(nic)
+        try:
+            owner=arp_probe(vip, nic)
+            probed=True
+        except (IOError, OSError, socket.error), e:
+            logger.debug("ARP probe on "+nic+" is not possible, using ping: "+str(e))
+    if owner is None and not probed:
+        # IPv6 or no raw socket, fall back to an ICMP echo bounded by the probe timeout
+        cmd=["ping", "-c", "1", "-w", str(int(math.ceil(vip_probe_timeout))), vip]
+        if ":" in vip:
+            cmd.insert(1, "-6")
+        method=command_string(cmd)
+        if execute(cmd).rc is 0:
+            owner="a node answering ping"
+    logger.debug("Probe virtual ip %s with %s took %.3fs" %(vip, method, time.time()-start))
+    return owner
+
+def missing_packages(packages):
+    """packages of the list which are not installed, from a single rpm query"""
+    if not packages:
+        return []
+    result=execute(["rpm", "-q"]+list(packages))
+    if result.rc is 127:
+        return list(packages)
+    return [package for package in packages
+            if re.search(r'^package %s is not installed' %re.escape(package), result.out, re.M)]
+
+def connect(addresses, timeout):
+    """socket connected to the first reachable of a list of unix socket paths and (host, port) tuples"""
+    error=None
+    for address in addresses:
+        if isinstance(address, tuple):
+            s=socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        elif os.path.exists(address):
+            s=socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            continue
+        s.settimeout(timeout)
+        try:
+            s.connect(address)
+            return s
+        except socket.error, e:
+            s.close()
+            error=e
+    raise error or socket.error(errno.ENOENT, "no socket to connect to")
+
+def recv_exactly(s, size):
+    """read size bytes from a socket"""
+    data=""
+    while len(data) < size:
+        chunk=s.recv(size-len(data))
+        if not chunk:
+            raise socket.error(errno.ECONNRESET, "connection closed")
+        data+=chunk
+    return data
+
+def probe_postgresql(timeout):
+    """True if PostgreSQL accepts connections, it refuses them with 57P03 while starting or recovering"""
+    s=connect(["/var/run/postgresql/.s.PGSQL.5432", "/tmp/.s.PGSQL.5432", ("127.0.0.1", 5432)], timeout)
+    try:
+        # StartupMessage of protocol 3.0, the answer comes before any authentication
+        body=struct.pack("!I", 196608)+"user\0xcatadm\0database\0xcatdb\0\0"
+        s.sendall(struct.pack("!I", len(body)+4)+body)
+        kind, length=struct.unpack("!cI", recv_exactly(s, 5))
+        if kind != "E":
+            # Authentication request, the server is accepting connections
+            return True
+        fields=recv_exactly(s, min(length-4, 4096)).split("\0")
+        # Any other error, such as a failed authentication, comes from a running server
+        return "C57P03" not in fields
+    finally:
+        s.close()
+
+def probe_mariadb(timeout):
+    """True if MariaDB sends its handshake packet"""
+    s=connect(["/var/lib/mysql/mysql.sock", ("127.0.0.1", 3306)], timeout)
+    try:
+        header=recv_exactly(s, 5)
+        # Protocol 10 handshake, or an error packet such as "host is not allowed to connect"
+        return header[4] in ("\x0a", "\xff")
+    finally:
+        s.close()
+
+def probe_xcatd(timeout):
+    """True if xcatd completes an SSL handshake on its port"""
+    s=connect([("127.0.0.1", 3001)], timeout)
+    try:
+        tls=ssl.wrap_socket(s, cert_reqs=ssl.CERT_NONE, do_handshake_on_connect=False)
+        try:
+            tls.do_handshake()
+        except ssl.SSLError, e:
+            # A handshake refused by xcatd, e.g. for the missing client certificate, still
+            #     comes from a listening xcatd, a closed connection does not
+            if "eof" in str(e).lower():
+                return False
+        return True
+    finally:
+        s.close()
+
+def listening(protocol, port):
+    """True if a socket of this node listens on port, protocol is tcp or udp"""
+    for table in ["/proc/net/"+protocol, "/proc/net/"+protocol+"6"]:
+        try:
+            with open(table) as f:
+                lines=f.readlines()[1:]
+        except IOError:
+            continue
+        for line in lines:
+            fields=line.split()
+            # TCP sockets in LISTEN state, UDP sockets are bound without a state of interest
+            if int(fields[1].split(":")[1], 16) == port and (protocol == "udp" or fields[3] == "0A"):
+                return True
+    return False
+
+# Seconds each service took to be ready after it was started
+ready_times={}
+
+# Result of starting or stopping each service, by ("start"|"stop", service), 0 on success
+service_results={}
+
+readiness_probes={
+    'postgresql':probe_postgresql,
+    'mariadb':probe_mariadb,
+    'xcatd':probe_xcatd,
+    'named':lambda timeout: listening("tcp", 53),
+    'dhcpd':lambda timeout: listening("udp", 67),
+}
+
+def wait_ready(service, timeout=None):
+    """poll the readiness probe of service with a growing delay, return seconds it took to be ready or None"""
+    if timeout is None:
+        timeout=ready_timeout
+    probe=readiness_probes[service]
+    start=time.time()
+    end=start+timeout
+    with tracer.span(service, "probe") as span:
+        a=0
+        while True:
+            a += 1
+            span['attempts']=a
+            try:
+                if probe(min(probe_timeout, max(end-time.time(), 0.1))):
+                    return time.time()-start
+                reason="not ready"
+            except (socket.error, ssl.SSLError, struct.error), e:
+                reason=str(e)
+            delay=min(retry_delay*(2**(a-1)), retry_delay_max)*random.uniform(0.5, 1)
+            if time.time()+delay >= end:
+                logger.debug(service+" readiness probe: "+reason)
+                span['status']='timeout'
+                return None
+            time.sleep(delay)
+
+def nic_index(nic):
+    """interface index of a nic"""
+    with open("/sys/class/net/"+nic_device(nic)+"/ifindex") as f:
+        return int(f.read())
+
+def neighbor_advertisement(ip, mac):
+    """unsolicited ICMPv6 neighbor advertisement for ip at mac, the kernel fills in the checksum"""
+    # type 136, code 0, checksum, flags with only Override set, target, target link-layer address option
+    return (struct.pack("!BBHI", 136, 0, 0, 0x20000000)+socket.inet_pton(socket.AF_INET6, ip)+
+            struct.pack("!BB", 2, 1)+mac)
+
+def announce_ip(ip, nic, count=None, interval=None):
+    """tell switches and neighbors that ip now lives on nic
+
+       Sends count gratuitous ARP requests and replies, or unsolicited neighbor
+       advertisements for an IPv6 address, interval seconds apart.
+       Returns the time the last announcement was sent.
+    """
+    if count is None:
+        count=garp_count
+    if interval is None:
+        interval=garp_interval
+    mac=nic_hwaddr(nic)
+    if ":" in ip:
+        s=socket.socket(socket.AF_INET6, socket.SOCK_RAW, socket.IPPROTO_ICMPV6)
+        index=nic_index(nic)
+        # Neighbor discovery messages are only accepted with hop limit 255
+        s.setsockopt(socket.IPPROTO_IPV6, getattr(socket, "IPV6_MULTICAST_HOPS", 18), 255)
+        s.setsockopt(socket.IPPROTO_IPV6, getattr(socket, "IPV6_MULTICAST_IF", 17), index)
+        packet=neighbor_advertisement(ip, mac)
+        send=lambda: s.sendto(packet, ("ff02::1", 0, 0, index))
+    else:
+        s=socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.htons(ETH_P_ARP))
+        s.bind((nic_device(nic), ETH_P_ARP))
+        # Some switches and hosts only learn from requests, others only from replies
+        request=arp_frame(ARP_REQUEST, mac, ip, "\0"*6, ip)
+        reply=arp_frame(ARP_REPLY, mac, ip, ETH_BROADCAST, ip)
+        send=lambda: (s.send(request), s.send(reply))
+    try:
+        for i in range(count):
+            if i:
+                time.sleep(interval)
+            send()
+        return time.time()
+    finally:
+        s.close()
+
+def xcat_objects(obj_type, attributes=None):
+    """definitions of all objects of an xCAT table from a single lsdef call,
+       as {object name: {attribute: value}}, or None if lsdef failed"""
+    cmd=["lsdef", "-t", obj_type]
+    if attributes:
+        cmd+=["-i", ",".join(attributes)]
+    result=execute(cmd)
+    if result.rc:
+        # lsdef fails on a table without any object
+        if "Could not find any object definitions" in result.out+result.err:
+            return {}
+        return None
+    objects={}
+    attrs=None
+    for line in result.out.splitlines():
+        match=re.match(r'^Object name:\s*(\S+)', line)
+        if match:
+            attrs=objects.setdefault(match.group(1), {})
+        elif attrs is not None and "=" in line:
+            key, value=line.strip().split("=", 1)
+            attrs[key]=value
+    return objects
+
 class xcat_ha_utils:
     """"""
     def log_info(self, message):
@@ -114,56 +2595,89 @@ class xcat_ha_utils:
         print "============================================================================================"
         logger.info(message)
 
-    def vip_check(self, vip):
-        """check if virtual ip can ping"""
-        global setup_process_msg
-        global dryrun
-        setup_process_msg="===> Check virtual ip stage <==="
-        logger.info(setup_process_msg)
-        cmd="ping -c 1 -w 10 "+vip
-        if dryrun:
-            logger.debug(cmd + " [Dryrun]")
-            return
-        logger.debug(cmd)
-        res=os.system(cmd)
-        if res is 0:
-            message="Aborted startup as virtual ip appears to be already active."
-            logger.error(message)
-            raise HaException(setup_process_msg)    
-        else:
-            message="virtual ip can be used."
-            logger.info(message)
-
+    @traced
     def stop_service(self, serviceName):
         """Stop specified service"""
-        cmd="systemctl stop "+serviceName
+        cmd=["systemctl", "stop", serviceName]
         return_code=run_command(cmd, 3)
         return return_code
 
     def start_service(self, serviceName):
         """Start specified service"""
-        cmd="systemctl start "+serviceName
+        start=time.time()
+        cmd=["systemctl", "start", serviceName]
         return_code=run_command(cmd,3)
+        if return_code is 0:
+            return_code=self.wait_service_ready(serviceName, start)
         return return_code
 
-    def restart_service(self, serviceName):
-        """restart specified service"""
-        cmd="systemctl restart "+serviceName
-        return_code=run_command(cmd,3)
+    def restart_service(self, serviceName):
+        """restart specified service"""
+        start=time.time()
+        cmd=["systemctl", "restart", serviceName]
+        return_code=run_command(cmd,3)
+        if return_code is 0:
+            return_code=self.wait_service_ready(serviceName, start)
+        return return_code
+
+    def wait_service_ready(self, serviceName, start):
+        """wait until a service started at start is ready to be used, return 0 when it is"""
+        global dryrun
+        if serviceName not in readiness_probes:
+            return 0
+        if dryrun:
+            logger.debug("Wait for "+serviceName+" to be ready [Dryrun]")
+            return 0
+        if wait_ready(serviceName) is None:
+            logger.error("%s is not ready after %ss [Failed]" %(serviceName, ready_timeout))
+            return 1
+        ready_times[serviceName]=time.time()-start
+        logger.info("%s is ready %.1fs after it was started" %(serviceName, ready_times[serviceName]))
+        return 0
+
+    def service_active(self, serviceName):
+        """True if specified service is active or still stopping"""
+        state=execute(["systemctl", "is-active", serviceName], 10).out.strip()
+        return state in ("active", "activating", "deactivating", "reloading")
+
+    def stop_service_before(self, serviceName, timeout):
+        """stop specified service, kill all processes of its unit if it does not stop within timeout seconds"""
+        start=time.time()
+        return_code=run_command(["systemctl", "stop", serviceName], 3, deadline=timeout)
+        if return_code and not dryrun and self.service_active(serviceName):
+            logger.warning("%s did not stop in %ss, killing all its processes" %(serviceName, timeout))
+            run_command(["systemctl", "kill", "--signal=SIGKILL", "--kill-who=all", serviceName], 0, timeout=10)
+            if not self.service_active(serviceName):
+                return_code=0
+        logger.info("Stop %s took %.1fs [%s]" %(serviceName, time.time()-start,
+                    "Dryrun" if dryrun else ("Failed" if return_code else "Passed")))
         return return_code
 
+    def installed_units(self, services):
+        """services which have a unit file, systemctl disable fails on the whole list if one is missing"""
+        units=[service if "." in service else service+".service" for service in services]
+        result=execute(["systemctl", "list-unit-files", "--no-legend"]+units, 10)
+        installed=set([line.split()[0] for line in result.out.splitlines() if line.split()])
+        if not installed and result.rc is not 0:
+            logger.warning("List unit files [Failed]: "+result.err.strip())
+            return services
+        for service, unit in zip(services, units):
+            if unit not in installed:
+                logger.debug("Skip disabling %s, it is not installed" %service)
+        return [service for service, unit in zip(services, units) if unit in installed]
+
     def disable_service(self, serviceName):
         """Disable specified service from starting on reboot"""
-        cmd="systemctl disable "+serviceName
+        cmd=["systemctl", "disable", serviceName]
         return_code=run_command(cmd, 3)
         return return_code
 
-    def start_all_services(self, servicelist, dbtype, host_name):
-        """start all services"""
+    @traced
+    def start_all_services(self, servicelist, dbtype, host_name, path=None):
+        """start all services, reusing the configuration kept in shared data directory path"""
         global setup_process_msg
         global etc_hosts
-        setup_process_msg="===> Start all services stage <==="
-        logger.info(setup_process_msg)
+        set_stage("===> Start all services stage <===")
         if dbtype == 'mariadb' and 'postgresql' in servicelist:
             servicelist.remove('postgresql')
         elif dbtype == 'postgresql' and 'mariadb' in servicelist:
@@ -173,83 +2687,150 @@ class xcat_ha_utils:
                 servicelist.remove('postgresql')
             if 'mariadb' in servicelist:
                 servicelist.remove('mariadb')
-        process_file="/etc/xcat/console.lock"
+        process_file=console_lock
+        # servicelist is the module's service_list, an earlier activation in this process
+        #     may have removed the console service not in use already
+        unused=['conserver', 'goconserver']
         if os.path.exists(process_file):
             with open(process_file,'rt') as handle:
                 for ln in handle:
                     if 'goconserver' in ln:
-                        servicelist.remove('conserver')
-                        break
+                        unused=['conserver']
                     else:
-                        servicelist.remove('goconserver')
-                        break
-        else:
-            servicelist.remove('conserver')
-            servicelist.remove('goconserver')
-        return_code=0
-        xcat_status=1
-        domain_in_site=0
+                        unused=['goconserver']
+                    break
+        for value in unused:
+            if value in servicelist:
+                servicelist.remove(value)
+        # Services are started as a dependency graph instead of one after another:
+        #     database => xcatd => DNS, DHCP and console regeneration
+        # Steps that do not depend on each other (e.g. ntpd, named and dhcpd) run concurrently
+        site={'domain':0}
+        generated=GeneratedConfig(path)
+        db_steps=[value for value in servicelist if value == "mariadb" or value == "postgresql"]
+        xcat_steps=[value for value in servicelist if value == "xcatd"]
+        steps=[("tables", xcat_steps, generated.compute)]
+        if "named" in servicelist or "dhcpd" in servicelist:
+            # Both need the "domain" lookup, so it is a step of its own
+            steps.append(("site", xcat_steps, lambda: self.check_site_domain(site)))
         for value in servicelist:
-            if xcat_status is 0:
-                if value == 'conserver':
-                    if run_command("makeconservercf", 0):
-                        return_code=1
-                if value == 'goconserver':
-                    if run_command("makegocons", 0):
-                        return_code=1
-                if value == 'named':
-                    # The decision to start "named" service is based on "domain" entry in "site" table
-                    # "domain" entry     in "site" table AND
-                    #      long hostname in "/etc/hosts" => run "makedns -n" which will in turn start "named"
-                    # "domain" entry not in "site" table => do not run "makedns -n" and do not start "named"
-                    cmd="lsdef -t site -i domain|grep domain"
-                    if run_command(cmd,0) is 1:
-                        # No domain in the site table, 
-                        logger.warning('"domain" entry is not in "site" table. "named" service will not be started')
-                    else:
-                        # Domain in the site table, 
-                        domain_in_site=1
-                        host_name=host_name.strip()
-                        long_name = self.find_line(etc_hosts, host_name+'.')
-                        if long_name is 1:
-                            # long hostname in /etc/hosts
-                            if run_command("makedns -n", 0):
-                                return_code=1
-                        else:
-                            # long hostname not in /etc/hosts
-                            logger.warning('Long hostname is not in "/etc/hosts". "named" service will not be started')
-                if value == "dhcpd":
-                    if domain_in_site is 0:
-                        logger.warning('"domain" entry is not in "site" table. "dhcpd" service will not be started')
-                        continue
-                    if run_command("makedhcp -n", 0):
-                        return_code=1
-                    if run_command("makedhcp -a", 0):
-                        return_code=1
-            if value == "xcatd" or value == "mariadb" or value == "postgresql":
-                if self.start_service(value):
-                    logger.error("start "+value+" failed") 
-                    raise HaException(setup_process_msg)
-                else:
-                    if value == "xcatd":
-                        self.source_xcat_profile()
-                        xcat_status=0
-               
+            if value in db_steps:
+                steps.append((value, [], lambda value=value: self.start_service(value)))
+            elif value == "xcatd":
+                steps.append((value, db_steps, self.start_xcatd))
+            elif value == "named":
+                steps.append((value, ["site", "tables"], lambda: self.start_named(site, host_name, generated)))
+            elif value == "dhcpd":
+                steps.append((value, xcat_steps+["site", "tables"], lambda: self.start_dhcpd(site, generated)))
+            elif value == "conserver":
+                steps.append((value, xcat_steps+["tables"], lambda: self.start_console("makeconservercf", "conserver", generated)))
+            elif value == "goconserver":
+                steps.append((value, xcat_steps+["tables"], lambda: self.start_console("makegocons", "goconserver", generated)))
             else:
-                if value == "named" or value == "dhcpd":
-                    # Do not start "named" service,
-                    # Either it was started by "makedns -n" command above, or
-                    # "domain" entry is not in "site" table and we should not run "named"
-                    #
-                    # Do not start "dhcpd" service,
-                    # Either it was started by "makedhcp -a" command above, or
-                    # "domain" entry is not in "site" table and we should not run "makedhcp"
-                    #
-                    continue
-                if self.start_service(value):
-                    return_code=1
+                steps.append((value, [], lambda value=value: self.start_service(value)))
+        result=run_step_graph(steps)
+        for value in servicelist:
+            if value in result:
+                service_results[("start", value)]=result[value]
+        for value in db_steps+xcat_steps:
+            if result[value]:
+                logger.error("start "+value+" failed")
+                raise HaException(setup_process_msg)
+        return_code=0
+        for value in result:
+            if result[value]:
+                return_code=1
+        return return_code
+
+    def start_xcatd(self):
+        """start xcatd and make xCAT commands available to the steps depending on it"""
+        if self.start_service("xcatd"):
+            return 1
+        self.source_xcat_profile()
+        return 0
+
+    def check_site_domain(self, site):
+        """record whether "domain" entry is in "site" table"""
+        # The decision to start "named" service is based on "domain" entry in "site" table
+        # "domain" entry     in "site" table AND
+        #      long hostname in "/etc/hosts" => run "makedns -n" which will in turn start "named"
+        # "domain" entry not in "site" table => do not run "makedns -n" and do not start "named"
+        if dryrun:
+            logger.debug("lsdef -t site -i domain [Dryrun]")
+            site['domain']=1
+            return 0
+        sites=xcat_objects("site", ["domain"])
+        if sites is None:
+            logger.error("lsdef -t site -i domain [Failed]")
+            return 1
+        if [attrs for attrs in sites.values() if attrs.get('domain')]:
+            # Domain in the site table,
+            site['domain']=1
+        else:
+            # No domain in the site table,
+            logger.warning('"domain" entry is not in "site" table. "named" service will not be started')
+        return 0
+
+    def start_named(self, site, host_name, generated=None):
+        """run "makedns -n" which will in turn start "named", or start "named" on the kept configuration"""
+        global etc_hosts
+        if not site['domain']:
+            return 0
+        host_name=host_name.strip()
+        if load_config_file(etc_hosts).has_long_name(host_name):
+            # long hostname in /etc/hosts
+            if generated and generated.reuse("makedns"):
+                return self.start_service("named")
+            start=time.time()
+            if run_command("makedns -n", 0):
+                return 1
+            if self.wait_service_ready("named", start):
+                return 1
+            if generated:
+                generated.store("makedns")
+        else:
+            # long hostname not in /etc/hosts
+            logger.warning('Long hostname is not in "/etc/hosts". "named" service will not be started')
+        return 0
+
+    def start_dhcpd(self, site, generated=None):
+        """run "makedhcp -n" and "makedhcp -a" which will in turn start "dhcpd", or start "dhcpd" on the kept configuration"""
+        if not site['domain']:
+            logger.warning('"domain" entry is not in "site" table. "dhcpd" service will not be started')
+            return 0
+        return_code=0
+        start=time.time()
+        if generated and generated.reuse("makedhcp"):
+            if self.start_service("dhcpd"):
+                return 1
+        elif run_command("makedhcp -n", 0):
+            return_code=1
+        # "makedhcp -a" adds the node entries to the running dhcpd over OMAPI, so it waits
+        #     for the dhcpd started by "makedhcp -n"
+        elif self.wait_service_ready("dhcpd", start):
+            return 1
+        elif generated:
+            generated.store("makedhcp")
+        # Node entries always come from the current tables, leases kept from an
+        #     earlier activation could hold outdated reservations
+        if run_command("makedhcp -a", 0):
+            return_code=1
+        return return_code
+
+    def start_console(self, make_cmd, service, generated=None):
+        """regenerate console configuration, unless the kept one can be used, and start console service"""
+        return_code=0
+        if generated and generated.reuse(make_cmd):
+            return self.start_service(service)
+        if run_command(make_cmd, 0):
+            return_code=1
+        elif generated:
+            generated.store(make_cmd)
+        if self.start_service(service):
+            return_code=1
         return return_code
 
+    @traced
     def stop_all_services(self, servicelist, dbtype):
         """stop all services"""
         if dbtype == 'mariadb' and 'postgresql' in servicelist:
@@ -261,23 +2842,47 @@ class xcat_ha_utils:
                 servicelist.remove('postgresql')
             if 'mariadb' in servicelist:
                 servicelist.remove('mariadb')
-        cmd="ps -ef|grep 'conserver\|goconserver'|grep -v grep"
-        output=os.popen(cmd).read()
+        output="".join([line for line in execute(["ps", "-ef"]).out.splitlines(True)
+                        if re.search(r'conserver|goconserver', line)])
         if output:
-            process="/etc/xcat/console.lock"
+            process=console_lock
             if dryrun:
                 logger.debug('Added "%s" to %s [Dryrun]' %(output, process))
             else:
-                f=open(process, 'w') 
-                f.write(output)
+                with open(process, 'w') as f:
+                    f.write(output)
                 logger.debug('Added "%s" to %s' %(output, process))
-                f.close
-        return_code=0
+        # Services are stopped in reverse order of the startup graph:
+        #     DNS, DHCP and console => xcatd => database
+        # Services that do not depend on each other are stopped concurrently
+        db_steps=[value for value in servicelist if value == "mariadb" or value == "postgresql"]
+        xcat_users=[value for value in servicelist if value in ("named", "dhcpd", "conserver", "goconserver")]
+        failed=[]
+        def stop(value):
+            # A service that failed to stop must not keep the services it depends on running,
+            #     so the step always passes and the failure is reported afterwards
+            if self.stop_service_before(value, stop_timeout):
+                failed.append(value)
+            return 0
+        steps=[]
         for value in reversed(servicelist):
-            if self.stop_service(value):
+            if value == "xcatd":
+                depends=xcat_users
+            elif value in db_steps:
+                depends=[v for v in servicelist if v == "xcatd"]
+            else:
+                depends=[]
+            steps.append((value, depends, lambda value=value: stop(value)))
+        result=run_step_graph(steps, stop_timeout*2+30)
+        return_code=0
+        for value in result:
+            service_results[("stop", value)]=1 if result[value] or value in failed else 0
+            if service_results[("stop", value)]:
+                logger.error("stop "+value+" failed")
                 return_code=1
         return return_code
 
+    @traced
     def disable_all_services(self, servicelist, dbtype):
         """disable all services from starting on reboot"""
         if dbtype == 'mariadb' and 'postgresql' in servicelist:
@@ -288,9 +2893,16 @@ class xcat_ha_utils:
             if 'mariadb' in servicelist:
                 servicelist.remove('mariadb')
             if 'postgresql' in servicelist:
-                servicelist.remove('mariadb')
+                servicelist.remove('postgresql')
+        services=self.installed_units(list(reversed(servicelist)))
+        if not services:
+            return 0
+        # One systemctl call disables every unit
+        if run_command(["systemctl", "disable"]+services, 3) is 0:
+            return 0
+        # Find out which units could not be disabled
         return_code=0
-        for value in reversed(servicelist):
+        for value in services:
             if self.disable_service(value):
                 return_code=1
         return return_code
@@ -317,17 +2929,16 @@ class xcat_ha_utils:
 
     def get_physical_ip(self, nic):
         """get physical IP"""
-        main_nic=nic.split(":")[0]
-        f=Popen(('ifconfig',main_nic), stdout=PIPE).stdout
-        data=[eachLine.strip() for eachLine in f]
-        physical_ip=filter(lambda x : 'inet ' in x, data)[0].split(" ")[1]
-        return physical_ip 
+        address=address_table().primary(nic_device(nic))
+        if address is None:
+            return ""
+        return address['ip']
 
+    @traced
     def check_database_type(self, dbtype, vip, nic, path):
         """if current xCAT DB type is different from target type, switch DB to target type"""
         global setup_process_msg
-        setup_process_msg="===> Check database type stage <==="
-        logger.info(setup_process_msg)
+        set_stage("===> Check database type stage <===")
         current_dbtype=self.current_database_type("")
         logger.debug("Current xCAT database type: "+current_dbtype)
         logger.debug("Target xCAT database type: "+dbtype)
@@ -339,18 +2950,19 @@ class xcat_ha_utils:
             if physical_ip:
                 if self.check_xcat_exist_in_shared_data(path):
                     self.install_db_package(dbtype)
-                    self.modify_db_configure_file(dbtype, path, physical_ip, vip) 
                 else:
                     self.switch_database(dbtype,vip,physical_ip)
-                    self.modify_db_configure_file(dbtype, path, physical_ip, vip)
+                changed=self.modify_db_configure_file(dbtype, path, physical_ip, vip)
+                if self.reload_database(dbtype, changed):
+                    logger.error("Reload %s configuration [Failed]" %dbtype)
         else:
             logger.debug("No need to switch database")
 
+    @traced
     def check_xcat_exist_in_shared_data(self, path):
         """check if xCAT data is in shared data directory"""
         global setup_process_msg
-        setup_process_msg="Check if xCAT data is in shared data directory"
-        logger.info(setup_process_msg)
+        set_stage("Check if xCAT data is in shared data directory")
         xcat_path=path+"/install"
         if os.path.exists(xcat_path):
             logger.debug("There is xCAT data "+xcat_path+" in shared data "+path)
@@ -359,43 +2971,28 @@ class xcat_ha_utils:
             logger.debug("There is no xCAT data "+xcat_path+" in shared data "+path)
             return 0
 
-    def check_shared_data_db_type(self, tdbtype, path):
-        """check if target dbtype is the same with shared data dbtype"""
-        global setup_process_msg
-        setup_process_msg="===> Check if target dbtype is the same with shared data dbtype stage <==="
-        logger.info(setup_process_msg)
+    def shared_data_db_type(self, path):
+        """database type of xCAT data in shared data directory"""
         cfgfile=path+xcat_cfgloc
         share_data_db=""
         if os.path.exists(cfgfile):
             with open(cfgfile,'r') as file:
                 sdbtype=file.read(2)
-            file.close()
             if sdbtype == 'my':
                 share_data_db="mariadb"
             elif sdbtype == 'Pg':
                 share_data_db="postgresql"
         else:
             share_data_db="sqlite"
-        logger.debug("Database type is '"+share_data_db+"' in shared data directory")
-        if share_data_db == tdbtype:
-            if dryrun:
-                logger.debug("Target database type is matched [Dryrun]")
-            else:
-                logger.debug("Target database type is matched [Passed]")
-        else:
-            if dryrun:
-                logger.error("target database is not matched [Dryrun]")
-            else:
-                logger.error("target database is not matched [Failed]")
-            raise HaException(setup_process_msg)
+        return share_data_db
         
+    @traced
     def switch_database(self, dbtype, vip, physical_ip):
         """switch database to target type"""
         global setup_process_msg
         res=self.install_db_package(dbtype)
         if res is 0:
-            setup_process_msg="===> Switch to target database stage <==="
-            logger.info(setup_process_msg)
+            set_stage("===> Switch to target database stage <===")
             cmd_msg=""
             for key in xcatdb_password:
                 os.environ[key]=xcatdb_password[key]
@@ -407,9 +3004,11 @@ class xcat_ha_utils:
                 cmd="pgsqlsetup -i -a "+vip+" -a "+physical_ip
                 cmd_msg="export XCATPGPW=xxxxxx;pgsqlsetup -i -a "+vip+" -a "+physical_ip
             elif dbtype == "mariadb":
-                if os.path.exists("/tmp/ha_mn"):
-                    cmd="cat /tmp/ha_mn|awk '{print $1}'|head -1 >/tmp/physical_ip"
-                    os.system(cmd)
+                if os.path.exists(ha_mn_tmp):
+                    lines=load_config_file(ha_mn_tmp).lines
+                    fields=lines[0].split() if lines else []
+                    with open("/tmp/physical_ip", "w") as ipfile:
+                        ipfile.write((fields[0] if fields else "")+"\n")
                 if os.path.exists("/tmp/physical_ip"):
                     cmd="mysqlsetup -i -f /tmp/physical_ip -V"
                     cmd_msg="mysqlsetup -i -f /tmp/physical_ip -V"
@@ -420,18 +3019,18 @@ class xcat_ha_utils:
                 logger.error("Do not support"+dbtype+" [Failed]") 
                 raise HaException(setup_process_msg)
             logger.info(cmd_msg)
-            res=os.system(cmd)
+            res=execute(cmd, install_timeout).rc
             if res is 0:
                 logger.debug("Switch to "+dbtype+" [Passed]")
             else:
                 logger.error("Switch to "+dbtype+" [Failed]")
 
+    @traced
     def install_db_package(self, dbtype):
         """install database package"""
         global setup_process_msg
         global dryrun
-        setup_process_msg="===> Install database package stage <==="
-        logger.info(setup_process_msg)
+        set_stage("===> Install database package stage <===")
         os_name=platform.platform()
         res=1
         if os_name.__contains__("redhat"):
@@ -444,8 +3043,14 @@ class xcat_ha_utils:
                 db_rpms="perl-DBD-MySQL* mariadb-server-5.* mariadb-5.* mysql-connector-odbc-*"
             else:
                 return res
-            cmd="yum -y install %s" %db_rpms
-            res=run_command(cmd,0)
+            # yum expands the wildcards, no shell is involved
+            cmd=["yum", "-y", "install"]+db_rpms.split()
+            install=lambda: run_command(cmd,0,timeout=install_timeout)
+            cache=artifact_cache()
+            if cache:
+                res=cache.install(dbtype, install)
+            else:
+                res=install()
             if res is not 0:
                 logger.error("install %s [Failed]" %db_rpms)
             else:
@@ -455,80 +3060,133 @@ class xcat_ha_utils:
                     logger.info("install %s [Passed]" %db_rpms)     
         return res
 
+    @traced
     def install_xcat(self, url):
         """install stable xCAT"""
         global setup_process_msg
-        setup_process_msg="===> Install xCAT stage <==="
-        logger.info(setup_process_msg)
+        set_stage("===> Install xCAT stage <===")
         if not self.check_software_installed("xCAT"):
             logger.debug("xCAT already installed")
             return 0
-        cmd="wget "+url+" -O - >/tmp/go-xcat"
-        res=run_command(cmd,0)
+        cache=artifact_cache()
+        if cache:
+            res=cache.install("xCAT", lambda: self.run_go_xcat(url, cache))
+        else:
+            res=self.run_go_xcat(url, None)
         if res is 0:
-            cmd="chmod +x /tmp/go-xcat"
-            res=run_command(cmd,0)
-            if res is 0:
-                cmd=xcat_install
-                res=run_command(cmd,0)
-                if res is 0:
-                    if dryrun:
-                        logger.debug("xCAT is installed [Dryrun]")
-                    else:
-                        logger.debug("xCAT is installed [Passed]")
-                        os.environ["PATH"]=xcat_env+os.environ["PATH"]
-                        cmd="lsxcatd -v"
-                        run_command(cmd,0)
-                    return 1
-                else:
-                    logger.error("xCAT is installed [Failed]")
+            if dryrun:
+                logger.debug("xCAT is installed [Dryrun]")
             else:
-                logger.error("chmod [Failed]")
+                logger.debug("xCAT is installed [Passed]")
+                os.environ["PATH"]=xcat_env+os.environ["PATH"]
+                cmd="lsxcatd -v"
+                run_command(cmd,0)
+            return 1
+        else:
+            logger.error("xCAT is installed [Failed]")
+
+    def run_go_xcat(self, url, cache):
+        """download go-xcat, through the cache if there is one, and install xCAT with it"""
+        go_xcat="/tmp/go-xcat"
+        if cache:
+            script=cache.fetch(url, "go-xcat")
+            if script is None:
+                return 1
+            if dryrun:
+                logger.debug("Copy "+script+" to "+go_xcat+" [Dryrun]")
+            else:
+                shutil.copyfile(script, go_xcat)
+                os.chmod(go_xcat, 0755)
         else:
-            logger.error("wget [Failed]")
+            cmd=["wget", url, "-O", go_xcat]
+            if run_command(cmd,3):
+                logger.error("wget [Failed]")
+                return 1
+            cmd=["chmod", "+x", go_xcat]
+            if run_command(cmd,0):
+                logger.error("chmod [Failed]")
+                return 1
+        return run_command(xcat_install,0,timeout=install_timeout)
         
             
+    @traced
     def configure_vip(self, vip, nic, mask):
-        """configure virtual ip"""
+        """configure virtual ip, and the additional virtual ips of extra_vips, concurrently"""
         global setup_process_msg
         global dryrun
-        setup_process_msg="===> Configure virtual ip as alias ip stage <==="
-        logger.info(setup_process_msg)
-        cmd="ifconfig "+nic+" "+vip+" "+" netmask "+mask
-        res=run_command(cmd,0)
-        if res is 1:
+        set_stage("===> Configure virtual ip as alias ip stage <===")
+        bindings=vip_bindings(vip, nic, mask)
+        addresses=address_table()
+        start=time.time()
+        result=run_step_graph([(binding[0], [], lambda binding=binding: self.bring_up_vip(addresses, *binding))
+                               for binding in bindings])
+        failed=[binding[0] for binding in bindings if result[binding[0]]]
+        if failed:
+            logger.error("Configure virtual ip "+", ".join(failed)+" [Failed]")
             raise HaException(setup_process_msg)
+        logger.info("Configured %d virtual ips in %.3fs" %(len(bindings), time.time()-start))
         #add virtual ip into /etc/resolve.conf
         name_server="nameserver "+vip
-        resolv_file="/etc/resolv.conf"
-        res=self.find_line(resolv_file, vip)
-        if res is 0:
-            resolvefile=open(resolv_file,'a')
+        resolv=load_config_file(resolv_conf)
+        if not resolv.has_field(vip):
             print name_server
             if dryrun:
-                logger.debug("Adding virtual ip "+vip+" into /etc/resolv.conf [Dryrun]")
-                resolvefile.close()
+                logger.debug("Adding virtual ip "+vip+" into "+resolv_conf+" [Dryrun]")
                 return
-            logger.debug("Adding virtual ip "+vip+" into /etc/resolv.conf")
-            resolvefile.write(name_server)
-
-    def find_line(self, filename, keyword, exact_match=None):
-        """find keyword from file"""
-        key=keyword.strip()
-        with open(filename,'r')as fp:
-            list1 = fp.readlines()
-            for line in list1:
-                line=line.rstrip('\n')
-                if exact_match:
-                    # Need to match line exactly, not just substring
-                    if key == line:
-                        return 1
-                else:
-                    # Substring match
-                    if re.search(r'\b%s\b' % key, line):
-                        return 1
+            logger.debug("Adding virtual ip "+vip+" into "+resolv_conf)
+            resolv.append(name_server)
+            if resolv.save():
+                raise HaException(setup_process_msg)
+
+    def bring_up_vip(self, addresses, vip, nic, mask):
+        """add vip to nic unless addresses has it there already, wait until it is usable and announce it"""
+        start=time.time()
+        address=addresses.by_ip.get(canonical_ip(vip))
+        if address and address['device'] == nic_device(nic):
+            logger.debug("Virtual ip "+vip+" is already configured on "+address['label'])
+        elif change_address("add", vip, netmask_prefix(mask or "255.255.255.0"), nic):
+            return 1
+        if not dryrun and not self.wait_vip_ready(vip, nic):
+            logger.error("Virtual ip %s is not usable on %s after %.1fs" %(vip, nic, vip_ready_timeout))
+            return 1
+        self.announce_vip(vip, nic)
+        logger.debug("Virtual ip %s is up on %s in %.3fs" %(vip, nic, time.time()-start))
         return 0
 
+    def wait_vip_ready(self, vip, nic):
+        """True once vip is on the device of nic and usable, not tentative or failed duplicate detection"""
+        end=time.time()+vip_ready_timeout
+        while True:
+            address=address_table().by_ip.get(canonical_ip(vip))
+            if address and address['device'] == nic_device(nic):
+                if address['flags'] & IFA_F_DADFAILED:
+                    return False
+                if not address['flags'] & IFA_F_TENTATIVE:
+                    return True
+            if time.time() >= end:
+                return False
+            time.sleep(0.05)
+
+    def announce_vip(self, vip, nic):
+        """announce virtual ip on the network, so clients stop using the MAC of the previous MN"""
+        global dryrun
+        if dryrun:
+            logger.debug("Announce virtual ip "+vip+" on "+nic_device(nic)+" [Dryrun]")
+            return
+        if garp_count <= 0:
+            return
+        start=time.time()
+        try:
+            self.vip_announced=announce_ip(vip, nic)
+        except (IOError, OSError, socket.error), e:
+            # Not fatal, neighbors will pick up the new MAC when their cache entries expire
+            logger.warning("Announce virtual ip "+vip+" on "+nic_device(nic)+" [Failed]: "+str(e))
+            return
+        logger.info("Announced virtual ip %s on %s %d times, completed at %s (%.3fs)"
+                    %(vip, nic_device(nic), garp_count, time.strftime("%H:%M:%S", time.localtime(self.vip_announced)),
+                      self.vip_announced-start))
+
+    @traced
     def save_original_host_and_ip(self):
         """"""
         global dryrun
@@ -537,47 +3195,36 @@ class xcat_ha_utils:
         physicalhost=self.get_hostname()
         physicalip=self.get_ip_from_hostname()
         physicalnet=physicalip+" "+physicalhost
-        res=self.find_line(etc_hosts, physicalip)
-        if res is 0:
-            if dryrun:
-                logger.info("Write "+physicalnet+" into "+etc_hosts+" [Dryrun]")
-            else:
-                hostfile=open(etc_hosts,'a')
-                hostfile.write(physicalnet+"\n")
-                hostfile.close()
-        mnfile="/tmp/ha_mn"
-        if not os.path.exists(mnfile):
-            nfile = open(mnfile,'w')
-            nfile.close()
-        res=self.find_line(mnfile, physicalnet)
-        if res is 0:
-            if dryrun is 1:
-                logger.info("Write "+physicalnet+" into "+mnfile+" [Dryrun]")
-            else:
-                mnfile=open(mnfile,'a')
-                mnfile.write(physicalnet+"\n")
-                mnfile.close() 
+        hosts=load_config_file(etc_hosts)
+        if not hosts.has_address(physicalip):
+            hosts.append(physicalnet)
+            if hosts.save():
+                raise HaException(setup_process_msg)
+        mnfile=load_config_file(ha_mn_tmp)
+        if not mnfile.has_entry(physicalnet):
+            mnfile.append(physicalnet)
+            if mnfile.save():
+                raise HaException(setup_process_msg)
                                 
+    @traced
     def change_hostname(self, host, ip):
         """change hostname"""
         global setup_process_msg
         global dryrun
         global etc_hosts
-        setup_process_msg="===> Configure hostname stage <==="
-        logger.info(setup_process_msg)
+        set_stage("===> Configure hostname stage <===")
         ip_and_host=ip+" "+host
-        res=self.find_line(etc_hosts, ip)
-        if res is 0:
+        hosts=load_config_file(etc_hosts)
+        if not hosts.has_address(ip):
             # Check if host is a long hostname.
             if '.' in host:
                 # Passed in hostname is a long format.
                 # Add short name to etc/hosts also
                 ip_and_host=ip_and_host+" "+host.split('.',1)[0]
-            hostfile=open(etc_hosts,'a')
-            if not dryrun:
-                hostfile.write(ip_and_host+"\n")
-            hostfile.close()
-        cmd="hostname "+host.strip()
+            hosts.append(ip_and_host)
+            if hosts.save():
+                raise HaException(setup_process_msg)
+        cmd=["hostname", host.strip()]
         res=run_command(cmd,0)
 
     def get_hostname(self):
@@ -591,30 +3238,36 @@ class xcat_ha_utils:
         ip=socket.gethostbyname(hostname)
         return ip
 
+    @traced
     def unconfigure_vip(self, vip, nic):
         """remove vip from nic and /etc/resolve.conf"""
         global setup_process_msg
         global dryrun
-        setup_process_msg="===> Remove virtual IP stage <==="
-        logger.info(setup_process_msg)
-        cmd="ifconfig "+nic+" 0.0.0.0 0.0.0.0 &>/dev/null"
-        res=run_command(cmd,0,1)
-        cmd="ip addr show |grep "+vip+" &>/dev/null"
-        res=run_command(cmd,0,1)
+        set_stage("===> Remove virtual IP stage <===")
+        vips=[binding[0] for binding in vip_bindings(vip, nic, None) if binding[0]]
+        addresses=address_table()
+        steps=[]
+        for ip in vips:
+            address=addresses.by_ip.get(canonical_ip(ip))
+            if address:
+                steps.append((ip, [], lambda ip=ip, address=address: change_address("del", ip, address['prefixlen'], address['label'])))
+        run_step_graph(steps)
         if dryrun is 1:
             return # For dryrun just exit, there is no passed or failed
-        if res is 0:
+        addresses=address_table()
+        remaining=[ip for ip in vips if addresses.local(ip)]
+        if not remaining:
             logger.info("Remove virtual IP [Passed]")
         else:
-            logger.errer("Remove virtual IP [Failed]")
+            logger.error("Remove virtual IP "+", ".join(remaining)+" [Failed]")
             raise HaException(setup_process_msg)
            
+    @traced
     def check_service_status(self, service_name):
         """check service status"""
         global setup_process_msg
         global dryrun
-        setup_process_msg="Check "+service_name+" service status"
-        logger.info(setup_process_msg)
+        set_stage("Check "+service_name+" service status")
         if dryrun:
             # In dryrun mode always return success.
             #     Checking for service running is not destructive, but in dryrun mode
@@ -622,19 +3275,19 @@ class xcat_ha_utils:
             #     will return failure which would prevent process from
             #     continuing
             return 0
-        cmd="systemctl status "+service_name+" > /dev/null"
-        status =os.system(cmd)
+        cmd=["systemctl", "status", service_name]
+        status =execute(cmd).rc
         return status
 
+    @traced
     def check_software_installed(self, package):
         """check if software is installed or not"""
         global setup_process_msg
         global dryrun
-        setup_process_msg="Checking if "+package+" is installed ..."
-        logger.info(setup_process_msg)
+        set_stage("Checking if "+package+" is installed ...")
         res=0
-        cmd="rpm -q "+package+" > /dev/null"
-        res=os.system(cmd)
+        cmd=["rpm", "-q", package]
+        res=execute(cmd).rc
         if dryrun:
             # In dryrun mode always return success.
             #     Checking for software being installed is not destructive, 
@@ -645,40 +3298,20 @@ class xcat_ha_utils:
         else:
             return res
 
-    def finditem(self, n, server):
-        """add item into policy table"""
-        index=bytes(n)
-        global dryrun
-        return_code=0
-        cmd="lsdef -t policy |grep 1."+index
-        if dryrun:
-            logger.debug(cmd+" [Dryrun]")
-            return return_code
-        else:
-            logger.debug(cmd) 
-        res=os.system(cmd)
-        if res is not 0:
-            cmd="chdef -t policy 1."+index+" name="+server+" rule=trusted"
-            res=run_command(cmd,0)
-            if res is 0:
-                loginfo="'"+cmd+"' [Passed]"
-                logger.debug(loginfo)
-                return 0
-            else:
-                loginfo="'"+cmd+"' [Failed]"
-                logger.error(loginfo)
-                return 1
-        else:
+    def free_policy_index(self, policies, first=3):
+        """first free 1.N policy index with N not lower than first"""
+        n=first
+        while "1."+str(n) in policies:
             n+=1
-            finditem(bytes(n),server)
+        return "1."+str(n)
 
+    @traced
     def change_xcat_policy_attribute(self, nic, vip):
         """add hostname into policy table"""
         global setup_process_msg
         global dryrun
-        setup_process_msg="===> Configure xCAT policy table stage <==="
-        logger.info(setup_process_msg)
-        filename="/etc/xcat/cert/server-cert.pem"
+        set_stage("===> Configure xCAT policy table stage <===")
+        filename=server_cert
         word="Subject: CN="
         server=""
         return_code=0
@@ -696,29 +3329,29 @@ class xcat_ha_utils:
                 logger.debug("lsdef -t policy -i name [Dryrun]")
                 return 0
             # Throw exception for not dryrun or in dryrun with xCAT installed
-            raise HaExeption(setup_process_msg)
+            raise HaException(setup_process_msg)
 
         if server:
-            cmd="lsdef -t policy -i name|grep "+server
             if dryrun:
-                logger.debug(cmd+" [Dryrun]")
+                logger.debug("lsdef -t policy -i name [Dryrun]")
                 return return_code
-            else:
-                logger.debug(cmd)
-            res=os.system(cmd)
-            if res is not 0:
-                res=self.finditem(3,server)
-                if res is 0:
-                    return 0
-            else:
+            policies=xcat_objects("policy", ["name"])
+            if policies is None:
+                logger.error("lsdef -t policy -i name [Failed]")
+                return 1
+            if server in [attrs.get('name') for attrs in policies.values()]:
                 loginfo=server+" exists in policy table."
                 logger.debug(loginfo)
                 return 0
+            cmd=["chdef", "-t", "policy", self.free_policy_index(policies), "name="+server, "rule=trusted"]
+            if run_command(cmd, 0) is 0:
+                return 0
         else:
             loginfo="Get server name "+server+" [Failed]" 
             logger.error(loginfo)
         return 1       
 
+    @traced
     def copy_files(self, sourceDir, targetDir):  
         """copy files"""
         global dryrun
@@ -727,24 +3360,19 @@ class xcat_ha_utils:
             logger.debug("Copy "+sourceDir+" to "+targetDir+" [Dryrun]")
             return return_code
         logger.debug("Copy "+sourceDir+" to "+targetDir) 
-        if shutil.copytree(sourceDir,targetDir):
-            return_code=1
-        stat_info = os.stat(sourceDir)
-        uid = stat_info.st_uid
-        gid = stat_info.st_gid
-        user = pwd.getpwuid(uid)[0]
-        group = grp.getgrgid(gid)[0]
-        cmd="chown -R "+user+":"+group+" "+targetDir
-        if run_command(cmd, 0):
+        # Owner, mode and extended attributes are preserved per file while copying,
+        #     no separate "chown -R" pass over the copied tree is needed
+        copier=TreeCopier(copy_workers, copy_chunk_size)
+        if copier.copy(sourceDir,targetDir):
             return_code=1
         return return_code              
 
+    @traced
     def configure_shared_data(self, path, sharedfs, dbtype):
         """configure shared data directory"""
         global setup_process_msg
         global dryrun
-        setup_process_msg="===> Configure shared data directory stage <==="
-        logger.info(setup_process_msg)
+        set_stage("===> Configure shared data directory stage <===")
         #check if there is xcat data in shared data directory
         if dbtype == 'postgresql' and sharedfs.__contains__("/var/lib/mysql"):
             sharedfs.remove("/var/lib/mysql")
@@ -761,8 +3389,12 @@ class xcat_ha_utils:
                     xcat_file_path=path+sharedfs[i]
                     self.copy_files(sharedfs[i],xcat_file_path)
                     i += 1  
+        if switch_mode == "bind":
+            self.bind_shared_data(path, sharedfs)
         #create symlink 
         for sharedfs_link in sharedfs:
+            if switch_mode == "bind":
+                break
             if dryrun:
                 logger.info("Creating symlink ..."+sharedfs_link+ " [Dryrun]")
                 continue
@@ -772,78 +3404,73 @@ class xcat_ha_utils:
                 if os.path.exists(sharedfs_link):
                     if os.path.exists(sharedfs_link+".xcatbak"):
                         # Remove backup if already there
-                        shutil.rmtree(sharedfs_link+".xcatbak")
+                        defer_remove(sharedfs_link+".xcatbak")
                     shutil.move(sharedfs_link, sharedfs_link+".xcatbak")
                 os.symlink(xcat_file_path, sharedfs_link)    
         #save original host and ip into /etc/xcat/ha_mn 
-        etc_ha_mn="/etc/xcat/ha_mn"
-        if not os.path.exists(etc_ha_mn):
-            cmd="touch "+etc_ha_mn
-            run_command(cmd,0)
         original_host=self.get_original_host()
         original_ip=self.get_original_ip()
         ip_and_host=original_ip+" "+original_host
         if dryrun:
             logger.debug("orignal ip and hostname:"+ip_and_host+" [Dryrun]")
         else:
-            res=self.find_line(etc_ha_mn, ip_and_host)
-            if res is 0:
-                hamnfile=open(etc_ha_mn,'a')
-                hamnfile.write(ip_and_host)
-                hamnfile.close
+            hamnfile=load_config_file(etc_ha_mn)
+            if not hamnfile.has_entry(ip_and_host):
+                hamnfile.append(ip_and_host)
+                if hamnfile.save():
+                    raise HaException(setup_process_msg)
 
+    @traced
     def modify_db_configure_file(self, dbtype, dbpath, physical_ip, vip):
-        """"""
+        """allow database connections on physical ip and virtual ip, return the changed files"""
         global dryrun
+        changed=[]
         if dbtype == 'postgresql':
             dbfile=dbpath+pg_hba_conf
             if os.path.exists(dbfile):
-                res=self.find_line(dbfile, physical_ip)
-                if res is 0:
-                    addline="host    all          all        "+physical_ip+"/32      md5\n"
-                    if dryrun:
-                        logger.debug('Added line "%s" to %s configuration file %s [Dryrun]' %(addline, dbtype, dbfile))
-                    else:
-                        dbfile1=open(dbfile,'a')
-                        dbfile1.write(addline)
-                        dbfile1.close()
-                        logger.debug('Added line "%s" to %s configuration file %s' %(addline, dbtype, dbfile))
-                res=self.find_line(dbfile, vip)
-                if res is 0:
-                    addline="host    all          all        "+vip+"/32      md5\n"
-                    if dryrun:
-                        logger.debug('Added line "%s" to %s configuration file %s [Dryrun]' %(addline, dbtype, dbfile))
-                    else:
-                        dbfile1=open(dbfile,'a')
-                        dbfile1.write(addline)
-                        dbfile1.close()
-                        logger.debug('Added line "%s" to %s configuration file %s' %(addline, dbtype, dbfile))
+                hba=PgHbaFile(dbfile)
+                for ip in [physical_ip, vip]:
+                    if not hba.allows(ip):
+                        addline="host    all          all        "+ip+"/32      md5"
+                        hba.append(addline)
+                if hba.pending:
+                    # Both lines are written at once
+                    if hba.save():
+                        raise HaException(setup_process_msg)
+                    changed.append(pg_hba_conf)
             postgre_file=dbpath+postgresql_conf
             if os.path.exists(postgre_file):
-                listen_addr_line=os.popen("cat "+postgre_file+"|grep ^listen_addresses").readline()
-                listen_addr=listen_addr_line.split("'")[1]
-                cmd="echo "+listen_addr+"|grep -w "+vip
-                res=os.system(cmd)
-                replace=0
-                if res:
-                    listen_addr=listen_addr+","+vip
-                    replace=1
-                cmd="echo "+listen_addr+"|grep -w "+physical_ip
-                res=os.system(cmd)
-                if res:
-                    listen_addr=listen_addr+","+physical_ip
-                    replace=1
-                if replace:
-                    cmd="sed -i '/^listen_addresses =/d' "+postgre_file
-                    res=run_command(cmd,0)
-                    cmd="echo \"listen_addresses = '%s'\" >> %s" % (listen_addr,postgre_file)
-                    res=run_command(cmd,0)
+                conf=PostgresqlConf(postgre_file)
+                listen_addr=conf.get("listen_addresses")
+                if listen_addr is None:
+                    listen_addr="localhost"
+                addresses=[addr.strip() for addr in listen_addr.split(",") if addr.strip()]
+                missing=[ip for ip in [vip, physical_ip] if ip not in addresses]
+                if missing and "*" not in addresses:
+                    conf.set("listen_addresses", ",".join(addresses+missing))
+                    if conf.save():
+                        raise HaException(setup_process_msg)
+                    changed.append(postgresql_conf)
+        return changed
+
+    def reload_database(self, dbtype, changed):
+        """make a running database use changed configuration files, reloading it when a restart is not needed"""
+        if dbtype != 'postgresql' or not changed or not self.service_active("postgresql"):
+            # A stopped database reads them when it starts
+            return 0
+        if postgresql_conf in changed:
+            # listen_addresses only takes effect at server start
+            return self.restart_service("postgresql")
+        # pg_hba.conf is read again on SIGHUP
+        if run_command(["systemctl", "reload", "postgresql"], 3) is 0:
+            return 0
+        return self.restart_service("postgresql")
 
+    @traced
     def unconfigure_shared_data(self, sharedfs, dbtype):
         """unconfigure shared data directory"""
         global setup_process_msg
-        setup_process_msg="===> Unconfigure shared data directory stage <==="
-        logger.info(setup_process_msg)
+        set_stage("===> Unconfigure shared data directory stage <===")
 
         if dbtype == 'postgresql' and sharedfs.__contains__("/var/lib/mysql"):
             sharedfs.remove("/var/lib/mysql")
@@ -851,6 +3478,9 @@ class xcat_ha_utils:
             sharedfs.remove("/var/lib/pgsql")
         #1.check if there is xcat data in shared data directory
         #2.unlink data in shared data directory
+        self.unbind_shared_data()
+        if not dryrun and os.path.exists(bind_file):
+            os.unlink(bind_file)
         for sharedfs_link in sharedfs:
             if dryrun:
                 logger.info("Removing symlink ..."+sharedfs_link+ " [Dryrun]")
@@ -862,28 +3492,89 @@ class xcat_ha_utils:
                 if os.path.exists(sharedfs_link+".xcatbak") and not os.path.exists(sharedfs_link):
                     shutil.move(sharedfs_link+".xcatbak", sharedfs_link)
 
+    def bound_directories(self):
+        """shared data directory of each local directory switched with a bind mount"""
+        try:
+            with open(bind_file) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def bind_shared_data(self, path, sharedfs):
+        """bind mount the shared data directories over the local ones, which stay in place"""
+        global setup_process_msg
+        global dryrun
+        points=mount_points()
+        bound=self.bound_directories()
+        for directory in sharedfs:
+            shared=path+directory
+            if os.path.islink(directory) or not os.path.isdir(shared):
+                # Switched with a symlink, or not in shared data
+                continue
+            bound[directory]=shared
+            if directory in points and same_directory(directory, shared):
+                logger.debug(shared+" is already mounted on "+directory)
+                continue
+            if dryrun:
+                logger.info("Bind mount "+shared+" on "+directory+" [Dryrun]")
+                continue
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            logger.info("Bind mount "+shared+" on "+directory)
+            if run_command(["mount", "--bind", shared, directory], 0):
+                raise HaException(setup_process_msg)
+        if bound and not dryrun:
+            if not os.path.isdir(os.path.dirname(bind_file)):
+                os.makedirs(os.path.dirname(bind_file))
+            write_file_atomic(bind_file, json.dumps(bound, indent=1, sort_keys=True))
+
+    def unbind_shared_data(self):
+        """unmount the shared data directories bind mounted over the local ones"""
+        global setup_process_msg
+        global dryrun
+        points=mount_points()
+        bound=self.bound_directories()
+        for directory in sorted(bound):
+            if directory not in points or not same_directory(directory, bound[directory]):
+                continue
+            if dryrun:
+                logger.info("Unmount "+directory+" [Dryrun]")
+                continue
+            logger.info("Unmount "+directory)
+            if run_command(["umount", directory], 3):
+                # Detach it anyway, so the local directory is used from now on
+                logger.warning(directory+" is busy, detaching it")
+                if run_command(["umount", "-l", directory], 0):
+                    raise HaException(setup_process_msg)
+
     def get_hostname_for_ip(self,ip):
         """get hostname for the passed in ip"""
-        hostname=os.popen("getent hosts "+ip+" | awk -F ' ' '{print $2}' | awk -F'.' '{print $1}'| uniq").read()
+        hostname=""
+        for line in execute(["getent", "hosts", ip]).out.splitlines():
+            fields=line.split()
+            if len(fields) > 1:
+                # short name of the first host name
+                hostname=fields[1].split('.')[0]
+                break
         return hostname
 
     def get_hostname_original_ip(self):
         """original hostname"""
         host1=""
         ha_mn=""
-        if os.path.exists("/tmp/ha_mn"):
-            ha_mn="/tmp/ha_mn" 
-        elif os.path.exists("/etc/xcat/ha_mn"):
-            ha_mn="/etc/xcat/ha_mn"
+        if os.path.exists(ha_mn_tmp):
+            ha_mn=ha_mn_tmp
+        elif os.path.exists(etc_ha_mn):
+            ha_mn=etc_ha_mn
         if ha_mn is not "":
-            ips=os.popen("cat "+ha_mn+"|awk '{print $1}'").readlines()
-            for ip in ips:
-                nip=ip.strip()
-                cmd='ifconfig|grep "inet '+nip+'  netmask" > /dev/null'
-                res=os.system(cmd)
-                if res is 0:
-                    cmd="cat "+ha_mn+"|grep "+nip+"|head -1"
-                    host1=os.popen(cmd).read().strip()
+            lines=[line.strip() for line in load_config_file(ha_mn).lines if line.strip()]
+            # One address dump answers the question for every address in ha_mn
+            addresses=address_table()
+            for line in lines:
+                nip=line.split()[0]
+                if addresses.local(nip):
+                    # The line of this address, not one of a longer address containing it
+                    host1=line
                     break
         return host1
     
@@ -904,6 +3595,7 @@ class xcat_ha_utils:
         return host
         
 
+    @traced
     def clean_env(self, vip, nic, dbtype):
 
         """clean up env when exception happen"""
@@ -926,16 +3618,102 @@ class xcat_ha_utils:
             logger.warning("Unable to restore original hostname")
         self.unconfigure_vip(vip, nic)
 
+    @traced
     def deactivate_management_node(self, nic, vip, dbtype):
         """deactivate management node"""
         global setup_process_msg
-        setup_process_msg="########## Deactivate stage ##########"
-        logger.info(setup_process_msg)
+        set_stage("########## Deactivate stage ##########")
         self.disable_all_services(service_list, dbtype)
         self.stop_all_services(service_list, dbtype)
+        self.unbind_shared_data()
         self.clean_vip_hostname(vip, nic)
         logger.info("This machine is set to standby management node successfully...")
 
+    def preflight_directory(self, path):
+        """shared data directory must exist"""
+        if not os.path.isdir(path):
+            return path+" does not exist"
+
+    def preflight_vip(self, vip, nic):
+        """virtual ip must not be in use"""
+        owner=vip_owner(vip, nic)
+        if owner:
+            return "virtual ip "+vip+" appears to be already active on "+owner
+
+    def vip_checks(self, vip, nic):
+        """preflight checks of the virtual ip and the additional virtual ips"""
+        checks=[("virtual ip", self.preflight_vip, (vip, nic))]
+        for binding in extra_vips:
+            checks.append(("virtual ip "+binding[0], self.preflight_vip, binding[:2]))
+        return checks
+
+    def preflight_database_type(self, dbtype, path):
+        """xCAT data in shared data directory must use the target database type"""
+        if not os.path.exists(path+"/install"):
+            return None
+        share_data_db=self.shared_data_db_type(path)
+        if share_data_db != dbtype:
+            return "database type is '"+share_data_db+"' in shared data directory, target is '"+dbtype+"'"
+
+    def preflight_packages(self, packages):
+        """packages must be installed"""
+        missing=missing_packages(packages)
+        if missing:
+            return ", ".join(missing)+" not installed"
+
+    @traced
+    def preflight_manifest(self, path):
+        """shared data directory must match its manifest"""
+        manifest=Manifest(path)
+        if manifest.time is None:
+            return "no manifest in "+manifest.file+", run setup or deactivate with -p to write it"
+        problems=manifest.verify()
+        for problem in problems[:20]:
+            logger.error("    "+path+problem)
+        if problems:
+            return "%d files differ from the manifest of %s" %(len(problems), time.strftime("%x %X", time.localtime(manifest.time)))
+
+    def preflight(self, checks, warnings=()):
+        """run read-only checks concurrently before anything is changed
+
+           checks is a list of (name, function, args) tuples, function returns
+           an error message or None, and must not change anything. The checks
+           named in warnings are reported, but do not stop the run.
+        """
+        global setup_process_msg
+        set_stage("===> Preflight check stage <===")
+        errors={}
+        latency={}
+        def step(name, function, args):
+            def run():
+                start=time.time()
+                try:
+                    errors[name]=function(*args)
+                finally:
+                    latency[name]=time.time()-start
+                return 0
+            return run
+        start=time.time()
+        result=run_step_graph([(name, [], step(name, function, args)) for name, function, args in checks],
+                              command_timeout)
+        failed=[]
+        logger.info("Preflight report, %d checks in %.3fs:" %(len(checks), time.time()-start))
+        for name, function, args in checks:
+            error=errors.get(name)
+            if result[name] and not error:
+                error="check did not complete"
+            took="%.3fs" %latency[name] if name in latency else "timed out"
+            if error and name in warnings:
+                logger.warning("    %-24s %-9s %s [Warning]" %(name, took, error))
+            elif error:
+                failed.append(name)
+                logger.error("    %-24s %-9s %s [%s]" %(name, took, error, "Dryrun" if dryrun else "Failed"))
+            else:
+                logger.info("    %-24s %-9s [Passed]" %(name, took))
+        if failed and not dryrun:
+            raise HaException(setup_process_msg)
+        return len(failed)
+
     def check_HA_directory(self, path):
         """check if there is HA directory exist or not"""
         if not os.path.exists(path):
@@ -946,14 +3724,27 @@ class xcat_ha_utils:
         xcat_env="/opt/xcat/bin:/opt/xcat/sbin:/opt/xcat/share/xcat/tools:"
         os.environ["PATH"]=xcat_env+os.environ["PATH"]
 
-    def activate_management_node(self, nic, vip, dbtype, path, mask):
+    @traced
+    def activate_management_node(self, nic, vip, dbtype, path, mask, verify=False):
         """activate management node"""
         try:
             global setup_process_msg
-            setup_process_msg="########## Activate stage ##########"
-            logger.info(setup_process_msg)
-            self.check_HA_directory(path)
-            self.vip_check(vip)
+            set_stage("########## Activate stage ##########")
+            checks=[("shared data directory", self.preflight_directory, (path,))]+self.vip_checks(vip, nic)
+            if verify:
+                checks.append(("shared data manifest", self.preflight_manifest, (path,)))
+            packages=["xCAT"]
+            if dbtype != "sqlite":
+                packages.append(dbtype)
+            checks.append(("packages", self.preflight_packages, (packages,)))
+            # As before the preflight checks, missing packages only fail where they are used
+            self.preflight(checks, warnings=["packages"])
+            lease=self.acquire_lease(path)
+        except:
+            raise HaException(setup_process_msg)
+        # The lease is held for as long as this node is active, not only while services start
+        start_lease_renewer(lease)
+        try:
             self.configure_vip(vip, nic, mask)
             restore_host_name=self.get_hostname_for_ip(vip)
             if restore_host_name:
@@ -961,48 +3752,503 @@ class xcat_ha_utils:
             else:
                 logger.error("Can not find the hostname to set")
             self.check_xcat_exist_in_shared_data(path)
-            self.start_all_services(service_list, dbtype, restore_host_name)
+            self.bind_shared_data(path, self.bound_directories().keys())
+            self.start_all_services(service_list, dbtype, restore_host_name, path)
             logger.info("This machine is set to primary management node successfully...")
         except:
+            stop_lease_renewer()
+            try:
+                if lease:
+                    lease.release()
+            except (IOError, OSError), e:
+                logger.warning("Release lease [Failed]: "+str(e))
+            raise HaException(setup_process_msg)
+
+    @traced
+    def acquire_lease(self, path):
+        """take the lease of the active management node, fail if another node holds it,
+           None with --dryrun"""
+        global setup_process_msg
+        global dryrun
+        set_stage("===> Acquire lease stage <===")
+        if dryrun:
+            # Building the lease creates its files in the shared data directory
+            logger.debug("Acquire lease in "+path+" [Dryrun]")
+            return None
+        lease=Lease(path)
+        holder=lease.acquire()
+        if holder:
+            logger.error("%s holds the lease of the active management node until %s (generation %d) [Failed]"
+                         %(holder.get('host'), time.strftime("%x %X", time.localtime(holder['expires'])), holder.get('generation', 0)))
             raise HaException(setup_process_msg)
+        if lease.generation:
+            logger.info("Acquired lease generation %d, valid for %ds unless renewed" %(lease.generation, lease.ttl))
+        return lease
  
+    def restart_xcat_services(self, dbtype):
+        """restart database and xcatd on the shared data"""
+        global dryrun
+        dbservice="postgresql"
+        if dbtype == 'mariadb':
+            dbservice="mariadb"
+        if dbtype == 'postgresql' or dbtype == 'mariadb':
+            res=self.restart_service(dbservice)
+            if res:
+                logger.error("%s service did not start [Failed]" %dbservice) 
+        if self.check_service_status("xcatd") is not 0:
+            res=self.restart_service("xcatd")
+            if res:
+                logger.error("xCAT service did not start [Failed]")
+                raise HaException(setup_process_msg)
+        if dryrun:
+            logger.debug("xCAT service has started [Dryrun]")
+        else:
+            logger.debug("xCAT service has started [Passed]")
+
+    def shared_data_configured(self, path, dbtype):
+        """True if every shared directory is a symlink to, or a bind mount of, the shared data directory"""
+        for sharedfs_link in shared_fs:
+            if dbtype == 'postgresql' and sharedfs_link == "/var/lib/mysql":
+                continue
+            if dbtype == 'mariadb' and sharedfs_link == "/var/lib/pgsql":
+                continue
+            if os.path.islink(sharedfs_link):
+                if os.readlink(sharedfs_link) != path+sharedfs_link:
+                    return False
+            elif not same_directory(sharedfs_link, path+sharedfs_link):
+                return False
+        return True
+
+    @traced
     def xcatha_setup_mn(self, args):
         """setup_mn process"""
         global dryrun
+        journal=Journal(journal_file)
         try:
-            self.check_HA_directory(args.path) 
-            self.vip_check(args.virtual_ip)
-            if self.check_xcat_exist_in_shared_data(args.path):
-                self.check_shared_data_db_type(args.dbtype,args.path)
-            self.configure_vip(args.virtual_ip,args.nic,args.netmask)
-            self.save_original_host_and_ip()
-            self.change_hostname(args.host_name,args.virtual_ip)
-            if self.check_service_status("xcatd") is not 0:
-                self.install_xcat(xcat_url)
-            self.check_database_type(args.dbtype,args.virtual_ip,args.nic,args.path)
-            self.configure_shared_data(args.path, shared_fs, args.dbtype)
-            dbservice="postgresql"
-            if args.dbtype == 'mariadb':
-                dbservice="mariadb"
-            if args.dbtype == 'postgresql' or args.dbtype == 'mariadb':
-                res=self.restart_service(dbservice)
-                if res:
-                    logger.error("%s service did not start [Failed]" %dbservice) 
-            if self.check_service_status("xcatd") is not 0:
-                res=self.restart_service("xcatd")
-                if res:
-                    logger.error("xCAT service did not start [Failed]")
-                    raise HaException(setup_process_msg)
-            if dryrun:
-                logger.debug("xCAT service has started [Dryrun]")
-            else:
-                logger.debug("xCAT service has started [Passed]")
-            self.source_xcat_profile()
-            self.change_xcat_policy_attribute(args.nic, args.virtual_ip)
-            self.deactivate_management_node(args.nic, args.virtual_ip, args.dbtype) 
+            self.preflight([("shared data directory", self.preflight_directory, (args.path,))]+
+                           self.vip_checks(args.virtual_ip, args.nic)+
+                           [("shared data database", self.preflight_database_type, (args.dbtype, args.path))])
+            short_name=args.host_name.split(".")[0]
+            # Stages undone by clean_env are checked against the state of this node
+            journal.run([
+                ("configure_vip", vip_bindings(args.virtual_ip, args.nic, args.netmask),
+                    lambda: self.configure_vip(args.virtual_ip,args.nic,args.netmask),
+                    lambda: not [b for b in vip_bindings(args.virtual_ip, args.nic, args.netmask) if not is_local_ip(b[0])]),
+                ("save_original_host_and_ip", [],
+                    self.save_original_host_and_ip,
+                    lambda: os.path.exists(ha_mn_tmp)),
+                ("change_hostname", [args.host_name, args.virtual_ip],
+                    lambda: self.change_hostname(args.host_name,args.virtual_ip),
+                    lambda: socket.gethostname().split(".")[0] == short_name),
+                ("install_xcat", [xcat_url],
+                    lambda: self.check_service_status("xcatd") is not 0 and self.install_xcat(xcat_url),
+                    lambda: not missing_packages(["xCAT"])),
+                ("check_database_type", [args.dbtype, args.virtual_ip, args.path],
+                    lambda: self.check_database_type(args.dbtype,args.virtual_ip,args.nic,args.path),
+                    lambda: self.current_database_type("") == args.dbtype),
+                ("configure_shared_data", [args.path, args.dbtype, list(shared_fs)],
+                    lambda: self.configure_shared_data(args.path, shared_fs, args.dbtype),
+                    lambda: self.shared_data_configured(args.path, args.dbtype)),
+                ("restart_xcat_services", [args.dbtype],
+                    lambda: self.restart_xcat_services(args.dbtype),
+                    lambda: self.check_service_status("xcatd") is 0),
+                ("change_xcat_policy_attribute", [args.nic, args.virtual_ip],
+                    lambda: self.source_xcat_profile() or self.change_xcat_policy_attribute(args.nic, args.virtual_ip),
+                    None),
+                ("deactivate_management_node", [args.nic, args.virtual_ip, args.dbtype],
+                    lambda: self.deactivate_management_node(args.nic, args.virtual_ip, args.dbtype),
+                    None),
+                # Hashing the shared data is left out of setup unless activation checks it
+                ("update_manifest", [args.path, args.verify],
+                    lambda: self.update_manifest(args.path) if args.verify else logger.info("Skip stage update_manifest, --verify is not given"),
+                    None),
+            ], args.resume, args.from_stage)
         except:
             raise HaException(setup_process_msg)
 
+    @traced
+    def resync_local_data(self, path):
+        """bring the local copy of each shared directory up to date from the shared data directory
+
+           The local copy is the directory itself when it was switched with a bind mount,
+           and the .xcatbak directory kept by setup when it was switched with a symlink.
+        """
+        global setup_process_msg
+        set_stage("===> Resync local directories stage <===")
+        bound=self.bound_directories()
+        failed=[]
+        for directory in shared_fs:
+            shared=path+directory
+            if not os.path.isdir(shared):
+                continue
+            if directory in bound:
+                target=directory
+            elif os.path.islink(directory) and os.path.isdir(directory+".xcatbak"):
+                target=directory+".xcatbak"
+            else:
+                logger.debug("There is no local copy of "+directory+" to resync")
+                continue
+            if rsync_directory(shared, target, resync_bwlimit) is None:
+                failed.append(directory)
+        if failed:
+            logger.error("Resync of "+", ".join(failed)+" failed")
+            raise HaException(setup_process_msg)
+
+    @traced
+    def update_manifest(self, path):
+        """record size, mtime and checksum of the shared data files for activate --verify"""
+        global setup_process_msg
+        set_stage("===> Update shared data manifest stage <===")
+        if Manifest(path).update():
+            raise HaException(setup_process_msg)
+
+    def monitor_management_node(self, args):
+        """write heartbeats while this node is active, take over when the active node stops writing them"""
+        global setup_process_msg
+        set_stage("########## Monitor stage ##########")
+        self.check_HA_directory(args.path)
+        if dryrun:
+            logger.debug("Monitor heartbeats and lease in "+args.path+" [Dryrun]")
+            return
+        heartbeat=Heartbeat(args.path)
+        lease=Lease(args.path)
+        renewed=time.time()
+        takeover=False
+        waiting=None
+        interval=beat_interval
+        misses=miss_threshold
+        role=args.role
+        if role == "auto":
+            if args.virtual_ip and is_local_ip(args.virtual_ip):
+                role="active"
+            else:
+                role="standby"
+        logger.info("Monitoring %s as %s management node, heartbeat every %ss, primary is dead after %d missed heartbeats"
+                    %(heartbeat.filename, role, interval, misses))
+        last_seen=None
+        last_change=time.time()
+        dead=False
+        tick=time.time()
+        try:
+            while True:
+                now=time.time()
+                beat=heartbeat.read()
+                if role == "active":
+                    if beat and beat.get('owner') not in (None, heartbeat.owner) and heartbeat.seq:
+                        # Somebody else took over since our last heartbeat
+                        logger.error("%s is writing heartbeats, this node stops acting as active management node" %beat.get('host'))
+                        role="standby"
+                        last_seen=(beat.get('owner'), beat.get('seq'))
+                        last_change=now
+                    else:
+                        try:
+                            heartbeat.beat(interval)
+                        except (IOError, OSError), e:
+                            # A missed heartbeat is retried at the next interval
+                            logger.warning("Write heartbeat [Failed]: "+str(e))
+                    if role == "active" and not self.renew_lease(lease, renewed):
+                        role="standby"
+                        last_change=now
+                        # A node deactivated by hand released its lease, it is not fenced again
+                        if args.auto_activate and args.virtual_ip and is_local_ip(args.virtual_ip):
+                            self.fence(args)
+                    elif role == "active":
+                        renewed=now
+                else:
+                    seen=None
+                    if beat:
+                        seen=(beat.get('owner'), beat.get('seq'))
+                    if seen != last_seen:
+                        if dead and seen:
+                            logger.info("Heartbeat of %s is back" %beat.get('host'))
+                        last_seen=seen
+                        last_change=now
+                        dead=False
+                        takeover=False
+                    elif not dead and now-last_change >= misses*interval:
+                        dead=True
+                        message="Primary management node missed %d heartbeats, detected %.1fs after its last heartbeat was seen" %(misses, now-last_change)
+                        if beat and beat.get('time'):
+                            message += " (%.1fs after it was written)" %(now-beat['time'])
+                        logger.error(message)
+                        takeover=args.auto_activate
+                    if takeover:
+                        # The primary may be alive but cut off, it stops once it can not renew its lease
+                        try:
+                            holder=lease.holder()
+                        except (IOError, OSError), e:
+                            logger.warning("Read lease [Failed]: "+str(e))
+                            holder={}
+                        if holder is not None:
+                            if holder and holder.get('generation') != waiting:
+                                waiting=holder.get('generation')
+                                logger.info("Waiting for the lease of %s to expire in %.1fs" %(holder.get('host'), holder['expires']-now))
+                        else:
+                            takeover=False
+                            lease.generation=None
+                            if self.takeover(args):
+                                role="active"
+                                renewed=time.time()
+                tick += interval
+                time.sleep(max(tick-time.time(), 0))
+        except KeyboardInterrupt:
+            logger.info("Monitoring stopped")
+
+    def renew_lease(self, lease, renewed):
+        """renew the lease of the active node, False once it is lost"""
+        try:
+            if lease.renew():
+                return True
+            logger.error("Another node took the lease, this node stops acting as active management node")
+        except (IOError, OSError), e:
+            if time.time()-renewed < lease.ttl:
+                logger.warning("Renew lease [Failed]: "+str(e))
+                return True
+            logger.error("The lease could not be renewed for %ds and has expired: %s" %(lease.ttl, e))
+        return False
+
+    def fence(self, args):
+        """deactivate this node after it lost the lease, so it stops using the shared data"""
+        stop_lease_renewer()
+        if not (args.nic and args.virtual_ip):
+            logger.error("Options -i and -v are required to deactivate this node [Failed]")
+            return
+        try:
+            self.deactivate_management_node(args.nic, args.virtual_ip, self.current_database_type(""))
+        except HaException, e:
+            logger.error(e.message)
+
+    def takeover(self, args):
+        """activate this node after the primary was declared dead, return 1 on success"""
+        if not (args.nic and args.virtual_ip):
+            logger.error("Options -i and -v are required to activate this node [Failed]")
+            return 0
+        start=time.time()
+        try:
+            self.activate_management_node(args.nic, args.virtual_ip, self.current_database_type(""), args.path,
+                                          args.netmask or "255.255.255.0")
+        except HaException, e:
+            logger.error(e.message)
+            logger.error("Error encountered, starting to clean up the environment")
+            self.clean_env(args.virtual_ip, args.nic, args.dbtype)
+            return 0
+        logger.info("This node took over as primary management node in %.1fs" %(time.time()-start))
+        return 1
+
+# Steps of a fleet operation on each pair, as (action, role), run in order
+fleet_steps={
+    "setup": [("setup", "primary"), ("setup", "standby")],
+    "activate": [("activate", "primary")],
+    "deactivate": [("deactivate", "primary")],
+    "failover": [("deactivate", "primary"), ("activate", "standby")],
+}
+
+class SshTransport(object):
+    """run xcatha.py on a management node over ssh"""
+    def __init__(self, inventory):
+        self.python=inventory.get('python', "python")
+        self.script=inventory.get('script', os.path.abspath(__file__))
+        self.ssh=inventory.get('ssh', ["ssh", "-o", "BatchMode=yes", "-o", "ConnectTimeout=10"])
+        if isinstance(self.ssh, basestring):
+            self.ssh=shlex.split(self.ssh)
+
+    def command(self, host, argv):
+        """argv list running xcatha.py with argv on host"""
+        # ssh hands its arguments to the remote shell as one string
+        return self.ssh+[host, " ".join([pipes.quote(arg) for arg in [self.python, self.script]+argv])]
+
+class LocalTransport(SshTransport):
+    """run a stand-in for xcatha.py, such as xcatha_standin.py, on this node in place of each
+       management node, to try an inventory on one machine
+
+       The script gets the name of the node it stands for in XCATHA_FLEET_HOST. It must be
+       given in the inventory, xcatha.py itself is only run with --dryrun, as every node of
+       the inventory would be this one.
+    """
+    def __init__(self, inventory):
+        SshTransport.__init__(self, inventory)
+        if not inventory.get('script'):
+            raise HaException("Error: the local transport needs a stand-in for xcatha.py as script in the fleet inventory, such as "
+                              +os.path.join(os.path.dirname(os.path.abspath(__file__)), "xcatha_standin.py"))
+        self.dryrun=os.path.realpath(self.script) == os.path.realpath(os.path.abspath(__file__).replace(".pyc", ".py"))
+
+    def command(self, host, argv):
+        """argv list running the script with argv on this node"""
+        if self.dryrun and "--dryrun" not in argv:
+            argv=argv+["--dryrun"]
+        return ["env", "XCATHA_FLEET_HOST="+host, self.python, self.script]+argv
+
+fleet_transports={"ssh": SshTransport, "local": LocalTransport}
+
+def as_list(value):
+    """value as a list, a single value becomes a list of one"""
+    if value is None:
+        return []
+    if isinstance(value, (list, tuple)):
+        return list(value)
+    return [value]
+
+class Fleet(object):
+    """setup, activate, deactivate or fail over many HA pairs described by an inventory
+
+       The inventory is a JSON file with a list of pairs, each with its primary and standby
+       hosts, virtual IPs, NICs, netmasks, shared data path, database type and hostname.
+       Keys in defaults apply to every pair which does not set them.
+    """
+    def __init__(self, filename, workers=None):
+        try:
+            with open(filename) as f:
+                inventory=json.load(f)
+        except (IOError, ValueError), e:
+            raise HaException("Error: can not read fleet inventory %s: %s" %(filename, e))
+        transport=inventory.get('transport', "ssh")
+        if transport not in fleet_transports:
+            raise HaException("Error: unknown transport %s in fleet inventory, use one of %s"
+                              %(transport, ", ".join(sorted(fleet_transports))))
+        self.transport=fleet_transports[transport](inventory)
+        self.timeout=inventory.get('timeout', fleet_timeout)
+        self.workers=workers or fleet_workers
+        self.pairs=[]
+        for index, entry in enumerate(inventory.get('pairs', [])):
+            pair=dict(inventory.get('defaults', {}))
+            pair.update(entry)
+            pair.setdefault('name', "pair%d" %index)
+            missing=[key for key in ('primary', 'standby', 'vip', 'nic') if not pair.get(key)]
+            if missing:
+                raise HaException("Error: pair %s of fleet inventory has no %s" %(pair['name'], ", ".join(missing)))
+            if len(as_list(pair['vip'])) != len(as_list(pair['nic'])):
+                raise HaException("Error: pair %s of fleet inventory needs one nic for each vip" %pair['name'])
+            self.pairs.append(pair)
+        if not self.pairs:
+            raise HaException("Error: fleet inventory %s has no pairs" %filename)
+
+    def arguments(self, pair, action):
+        """xcatha.py arguments of action on a node of pair"""
+        argv=[{"setup": "-s", "activate": "-a", "deactivate": "-d"}[action]]
+        for vip, nic in zip(as_list(pair['vip']), as_list(pair['nic'])):
+            argv += ["-v", vip, "-i", nic]
+        for mask in as_list(pair.get('netmask')):
+            argv += ["-m", mask]
+        if pair.get('path'):
+            argv += ["-p", pair['path']]
+        if action == "setup":
+            if pair.get('hostname'):
+                argv += ["-n", pair['hostname']]
+            if pair.get('dbtype'):
+                argv += ["-t", pair['dbtype']]
+        argv += as_list(pair.get('options'))
+        if dryrun:
+            argv.append("--dryrun")
+        return argv
+
+    def check(self, operation):
+        """raise HaException if a pair lacks what operation needs"""
+        for pair in self.pairs:
+            needed=['path']
+            if operation == "setup":
+                needed.append('hostname')
+            if operation == "deactivate":
+                needed=[]
+            missing=[key for key in needed if not pair.get(key)]
+            if missing:
+                raise HaException("Error: pair %s of fleet inventory has no %s, needed by %s"
+                                  %(pair['name'], ", ".join(missing), operation))
+
+    def run_pair(self, pair, operation, parent):
+        """run the steps of operation on pair in order, the steps after a failed one are skipped"""
+        results=[]
+        failed=False
+        for action, role in fleet_steps[operation]:
+            host=pair[role]
+            if failed:
+                logger.error("%s on %s of pair %s skipped" %(action, host, pair['name']))
+                results.append((pair['name'], host, action, None, 0))
+                continue
+            logger.info("%s %s of pair %s" %(action.capitalize(), host, pair['name']))
+            with tracer.span("%s %s" %(action, host), "step", parent):
+                result=execute(self.transport.command(host, self.arguments(pair, action)), self.timeout)
+            if result.out.strip():
+                logger.debug(result.out)
+            if result.rc:
+                failed=True
+                logger.error("%s on %s of pair %s [Failed] rc=%d after %.1fs" %(action, host, pair['name'], result.rc, result.duration))
+                for line in (result.err or result.out).strip().splitlines()[-5:]:
+                    logger.error("    "+line)
+            else:
+                logger.info("%s on %s of pair %s [Passed] in %.1fs" %(action, host, pair['name'], result.duration))
+            results.append((pair['name'], host, action, result.rc, result.duration))
+        return results
+
+    def run(self, operation):
+        """run operation on all pairs, at most workers pairs at once, return the results of all steps"""
+        results={}
+        tasks=Queue.Queue()
+        for pair in self.pairs:
+            tasks.put(pair)
+        parent=tracer.current()
+        def worker():
+            while True:
+                try:
+                    pair=tasks.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    results[pair['name']]=self.run_pair(pair, operation, parent)
+                except Exception, e:
+                    logger.error("Pair %s raised: %s" %(pair['name'], e))
+                    results[pair['name']]=[(pair['name'], pair['primary'], operation, 1, 0)]
+        threads=[threading.Thread(target=worker) for i in range(min(self.workers, len(self.pairs)))]
+        for thread in threads:
+            thread.daemon=True
+            thread.start()
+        for thread in threads:
+            # join with a timeout, so Ctrl-C is not blocked
+            while thread.is_alive():
+                thread.join(1)
+        return sum([results[pair['name']] for pair in self.pairs], [])
+
+def fleet_report(results, duration):
+    """lines of a table of the fleet steps, with a summary per pair"""
+    lines=["%-20s %-20s %-10s %8s %9s" %("pair", "host", "action", "result", "seconds")]
+    for name, host, action, rc, seconds in results:
+        if rc is None:
+            status="skipped"
+        elif rc:
+            status="rc=%d" %rc
+        else:
+            status="ok"
+        lines.append("%-20s %-20s %-10s %8s %9.1f" %(name, host, action, status, seconds))
+    pairs=[]
+    failed=set()
+    for name, host, action, rc, seconds in results:
+        if name not in pairs:
+            pairs.append(name)
+        if rc != 0:
+            failed.add(name)
+    lines.append("%d pairs, %d passed, %d failed in %.1fs" %(len(pairs), len(pairs)-len(failed), len(failed), duration))
+    return lines
+
+def run_fleet(args, operation):
+    """run operation on the pairs of the fleet inventory, return 0 if it passed on all of them"""
+    start=time.time()
+    try:
+        fleet=Fleet(args.fleet)
+        fleet.check(operation)
+    except HaException, e:
+        logger.error(e.message)
+        return 1
+    set_stage("########## Fleet %s stage ##########" %operation)
+    logger.info("Running %s on %d HA pairs, %d at once" %(operation, len(fleet.pairs), min(fleet.workers, len(fleet.pairs))))
+    results=fleet.run(operation)
+    lines=fleet_report(results, time.time()-start)
+    print "============================================================================================"
+    for line in lines[:-1]:
+        print line
+    logger.info(lines[-1])
+    if [result for result in results if result[3] != 0]:
+        return 1
+    return 0
+
 def parse_arguments():
     """parse input arguments"""
     parser = argparse.ArgumentParser(description="Setup/Activate/Deactivate shared data based xCAT HA MN node")
@@ -1010,13 +4256,41 @@ def parse_arguments():
     group.add_argument('-s', '--setup', help="setup node to be xCAT MN", action='store_true')
     group.add_argument('-a', '--activate', help="activate node to be xCAT MN", action='store_true')
     group.add_argument('-d', '--deactivate', help="deactivate node to be xCAT MN", action='store_true')
+    group.add_argument('--monitor', help="write heartbeats while active, detect failure of the active node while standby", action='store_true')
+    group.add_argument('--failover', help="deactivate the primary and activate the standby node of every pair in --fleet", action='store_true')
     parser.add_argument('-p', dest="path", help="shared data directory path")
-    parser.add_argument('-v', dest="virtual_ip", help="virtual IP")
-    parser.add_argument('-i', dest="nic", help="virtual IP network interface")
+    parser.add_argument('-v', dest="virtual_ip", action="append", help="virtual IP, can be repeated with one -i for each")
+    parser.add_argument('-i', dest="nic", action="append", help="virtual IP network interface")
     parser.add_argument('-n', dest="host_name", help="virtual IP hostname")
-    parser.add_argument('-m', dest="netmask", help="virtual IP network mask")
+    parser.add_argument('-m', dest="netmask", action="append", help="virtual IP network mask, one for each -v or one for all")
     parser.add_argument('-t', dest="dbtype", choices=['postgresql', 'sqlite', 'mariadb'], help="database type")
+    parser.add_argument('--fleet', help="JSON inventory of HA pairs, run -s, -a, -d or --failover on all of them instead of this node")
+    parser.add_argument('--fleet-workers', dest="fleet_workers", type=int, help="HA pairs --fleet works on at once, default is %d" %fleet_workers)
     parser.add_argument('--dryrun', action="store_true", help="display steps without execution")
+    parser.add_argument('--profile', action="store_true", help="print where the time went and write a JSON timing trace")
+    parser.add_argument('--metrics-file', dest="metrics_file", help="write metrics of the run in node_exporter textfile format into this file")
+    parser.add_argument('--trace-file', dest="trace_file", help="timing trace file written by --profile, default is xcatha-trace.json in current directory")
+    parser.add_argument('--copy-workers', dest="copy_workers", type=int, help="threads copying data into shared data directory during setup, default is %d" %copy_workers)
+    parser.add_argument('--command-timeout', dest="command_timeout", type=int, help="seconds a command may run before it is killed, default is %d" %command_timeout)
+    parser.add_argument('--vip-probe-timeout', dest="vip_probe_timeout", type=float, help="seconds to wait for an answer when checking if virtual IP is in use, default is %s" %vip_probe_timeout)
+    parser.add_argument('--garp-count', dest="garp_count", type=int, help="gratuitous ARPs sent after virtual IP is configured, 0 disables them, default is %d" %garp_count)
+    parser.add_argument('--role', choices=['auto', 'active', 'standby'], default="auto", help="role of this node for --monitor, auto picks active when virtual IP is on this node")
+    parser.add_argument('--beat-interval', dest="beat_interval", type=float, help="seconds between heartbeats for --monitor, default is %s" %beat_interval)
+    parser.add_argument('--lease-ttl', dest="lease_ttl", type=int, help="seconds a lease on the shared data stays valid without renewal, default is %d" %lease_ttl)
+    parser.add_argument('--miss-threshold', dest="miss_threshold", type=int, help="missed heartbeats before the active node is declared dead, default is %d" %miss_threshold)
+    parser.add_argument('--auto-activate', dest="auto_activate", action="store_true", help="activate this node when --monitor declares the active node dead")
+    parser.add_argument('--switch-mode', dest="switch_mode", choices=['symlink', 'bind'], help="how local directories are switched to the shared data directory, default is symlink")
+    parser.add_argument('--cache-dir', dest="cache_dir", help="directory caching go-xcat and packages, default is .xcatha/cache in the shared data directory")
+    parser.add_argument('--xcat-url', dest="xcat_url", help="where go-xcat is downloaded from, file:// URLs are supported")
+    parser.add_argument('--resync', action="store_true", help="update the local copies of the shared directories from the shared data directory after deactivation")
+    parser.add_argument('--bwlimit', type=int, help="KB per second a resync may transfer")
+    parser.add_argument('--verify', action="store_true", help="check the shared data directory against its manifest before activation, write the manifest at setup and after deactivation")
+    parser.add_argument('--resume', action="store_true", help="skip setup stages completed by a previous setup with the same options")
+    parser.add_argument('--from-stage', dest="from_stage", choices=setup_stages, metavar="STAGE",
+                        help="skip setup stages before this one, one of "+", ".join(setup_stages))
+    parser.add_argument('--ready-timeout', dest="ready_timeout", type=int, help="seconds a started service may take to be ready, default is %d" %ready_timeout)
+    parser.add_argument('--stop-timeout', dest="stop_timeout", type=int, help="seconds a service may take to stop before its processes are killed, default is %d" %stop_timeout)
+    parser.add_argument('--step-timeout', dest="step_timeout", type=int, help="seconds each service startup step may take, default is %d" %service_step_timeout)
     args = parser.parse_args()
     return args
 
@@ -1141,11 +4415,108 @@ def interactive_activate(obj,virtual_ip,dbtype):
      
 def main():
     global dryrun
+    global service_step_timeout
+    global copy_workers
+    global command_timeout
+    global vip_probe_timeout
+    global garp_count
+    global beat_interval
+    global miss_threshold
+    global stop_timeout
+    global ready_timeout
+    global cache_dir
+    global xcat_url
+    global switch_mode
+    global resync_bwlimit
+    global extra_vips
+    global lease_ttl
+    global fleet_workers
     args=parse_arguments()
+    vips=args.virtual_ip or []
+    nics=args.nic or []
+    masks=args.netmask or []
+    if len(vips) > 1 or len(nics) > 1 or len(masks) > 1:
+        if len(nics) != len(vips) or len(masks) not in (0, 1, len(vips)):
+            logger.error("Give one -i for each -v, and one -m for each -v or a single -m for all of them")
+            return 1
+        masks=(masks or ["255.255.255.0"])*(len(vips)/len(masks or [None]))
+        extra_vips=zip(vips, nics, masks)[1:]
+    # The first binding is the virtual ip of the management node, the others follow it
+    args.virtual_ip=(vips or [None])[0]
+    args.nic=(nics or [None])[0]
+    args.netmask=(masks or [None])[0]
     obj=xcat_ha_utils()
-    interactive=False
     if args.dryrun:
         dryrun = 1
+    if args.step_timeout:
+        service_step_timeout=args.step_timeout
+    if args.copy_workers:
+        copy_workers=args.copy_workers
+    if args.command_timeout:
+        command_timeout=args.command_timeout
+    if args.vip_probe_timeout:
+        vip_probe_timeout=args.vip_probe_timeout
+    if args.garp_count is not None:
+        garp_count=args.garp_count
+    if args.switch_mode:
+        switch_mode=args.switch_mode
+    if args.xcat_url:
+        xcat_url=args.xcat_url
+    if args.cache_dir:
+        cache_dir=args.cache_dir
+    elif args.path:
+        cache_dir=os.path.join(args.path, ".xcatha", "cache")
+    if args.ready_timeout:
+        ready_timeout=args.ready_timeout
+    if args.bwlimit:
+        resync_bwlimit=args.bwlimit
+    if args.stop_timeout:
+        stop_timeout=args.stop_timeout
+    if args.lease_ttl:
+        lease_ttl=args.lease_ttl
+    if args.fleet_workers:
+        fleet_workers=args.fleet_workers
+    if args.beat_interval:
+        beat_interval=args.beat_interval
+    if args.miss_threshold:
+        miss_threshold=args.miss_threshold
+    if args.setup:
+        operation="setup"
+    elif args.activate:
+        operation="activate"
+    elif args.monitor:
+        operation="monitor"
+    elif args.failover:
+        operation="failover"
+    else:
+        operation="deactivate"
+    if args.failover and not args.fleet:
+        logger.error("Option --fleet is required for --failover, run -d and -a on the nodes of a single pair")
+        return 1
+    if args.fleet and args.monitor:
+        logger.error("Option --fleet can not be used with --monitor")
+        return 1
+    rc=1
+    try:
+        with tracer.span(operation, "operation"):
+            if args.fleet:
+                rc=run_fleet(args, operation)
+            else:
+                rc=run_operation(args, obj)
+            return rc
+    finally:
+        if args.metrics_file and operation != "monitor" and not args.fleet and not dryrun:
+            write_metrics(args.metrics_file, operation, rc)
+        if args.profile:
+            tracer.write(args.trace_file or os.path.join(os.getcwd(), 'xcatha-trace.json'))
+            print "============================================================================================"
+            for line in tracer.summary():
+                print line
+
+def run_operation(args, obj):
+    """setup, activate or deactivate this node"""
+    global dryrun
+    interactive=False
     try:
         if args.activate:
             if args.nic and args.virtual_ip and args.path:
@@ -1153,7 +4524,7 @@ def main():
                 if not args.netmask:
                     args.netmask="255.255.255.0"
                 dbtype=obj.current_database_type("")
-                obj.activate_management_node(args.nic, args.virtual_ip, dbtype, args.path, args.netmask)
+                obj.activate_management_node(args.nic, args.virtual_ip, dbtype, args.path, args.netmask, args.verify)
             else:
                 if not args.virtual_ip:
                      args.virtual_ip = obj.get_ip_from_hostname()
@@ -1168,10 +4539,36 @@ def main():
             if args.nic and args.virtual_ip:
                 logger.info("Deactivating this node as xCAT standby MN")
                 obj.deactivate_management_node(args.nic, args.virtual_ip, dbtype)
+                if args.path and args.resync:
+                    try:
+                        obj.resync_local_data(args.path)
+                    except HaException:
+                        logger.warning("Local directories are not up to date with the shared data directory")
+                if args.path and args.verify:
+                    # Off the failover path unless the next activation checks the manifest
+                    try:
+                        obj.update_manifest(args.path)
+                    except HaException:
+                        logger.warning("Shared data manifest is not updated, activation with --verify will fail")
+                # The other node may only take over, and write to the shared data, once this
+                #     node is done reading it
+                stop_lease_renewer()
+                if args.path and dryrun:
+                    logger.debug("Release lease in "+args.path+" [Dryrun]")
+                elif args.path:
+                    try:
+                        Lease(args.path).release()
+                    except (IOError, OSError), e:
+                        logger.warning("Release lease [Failed]: "+str(e))
             else:
                 interactive=True
                 interactive_deactivate(obj,dbtype) 
             logger.info("This machine is set to standby management node successfully...") 
+        if args.monitor:
+            if not args.path:
+                logger.error("Option -p is required for monitoring")
+                return 1
+            obj.monitor_management_node(args)
         if args.setup:
             if not args.netmask:
                 args.netmask="255.255.255.0"
@@ -1196,4 +4593,4 @@ def main():
         return 1
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
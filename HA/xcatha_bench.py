@@ -0,0 +1,439 @@
+#!/usr/bin/env python
+###############################################################################
+# IBM(c) 2018 EPL license http://www.eclipse.org/legal/epl-v10.html
+###############################################################################
+#
+#  NAME:  xcatha_bench.py
+#
+#  SYNTAX: xcatha_bench.py [-s <scenario>]... [-r <repeat>] [-l <seconds>] [-f <files>] [-j <file>] [-k] [--verbose]
+#
+#  DESCRIPTION:  Time setup, activation and deactivation of xcatha.py on a single node,
+#                without touching the system. The xcat_ha_utils code runs against a
+#                temporary root holding the shared data directory, the shared_fs
+#                directories, /etc/hosts and the other files it edits, and against fake
+#                systemctl, ip, rpm, lsdef, chdef, makedns, makedhcp, ping and
+#                other commands, with configurable latency and failures.
+#
+#  FLAGS:
+#               -s       scenario to run, can be repeated, default is all scenarios
+#               -r       number of runs of each scenario, the median is reported, default is 1
+#               -l       seconds every fake command takes, default is 0.01
+#               -f       number of files in each synthetic shared_fs directory, default is 100
+#               -j       write the results as JSON into this file
+#               -k       keep the temporary root of each run
+#               --verbose show the log of xcatha.py on the console
+#               --list   list the scenarios
+#
+import argparse
+import json
+import logging
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import time
+
+# Fake command, installed under every name in fake_commands
+#     XCATHA_BENCH_CONFIG  JSON file, "commands" maps the start of a command line to
+#                          {"latency": seconds, "fail": first calls failing, "rc": exit code}
+#     XCATHA_BENCH_STATE   directory holding the addresses and stopped units
+fake_command='''#!/usr/bin/env python
+import fcntl, json, os, sys, time
+name=os.path.basename(sys.argv[0])
+line=" ".join([name]+sys.argv[1:])
+config=json.load(open(os.environ["XCATHA_BENCH_CONFIG"]))
+state=os.environ["XCATHA_BENCH_STATE"]
+rule=dict(config["commands"].get("", {}))
+for prefix in sorted(config["commands"], key=len):
+    if prefix and (line == prefix or line.startswith(prefix+" ")):
+        rule.update(config["commands"][prefix])
+
+def load(what, default):
+    try:
+        return json.load(open(os.path.join(state, what)))
+    except (IOError, ValueError):
+        return default
+
+def save(what, value):
+    with open(os.path.join(state, what), "w") as f:
+        json.dump(value, f)
+
+with open(os.path.join(state, "lock"), "a") as lock:
+    fcntl.flock(lock, fcntl.LOCK_EX)
+    calls=load("calls", {})
+    calls[line]=calls.get(line, 0)+1
+    save("calls", calls)
+    with open(os.path.join(state, "log"), "a") as log:
+        log.write("%.3f %s\\n" %(time.time(), line))
+time.sleep(rule.get("latency", 0))
+if calls[line] <= rule.get("fail", 0):
+    sys.stderr.write(line+": injected failure\\n")
+    sys.exit(1)
+if "rc" in rule:
+    sys.exit(rule["rc"])
+
+args=sys.argv[1:]
+# Held until the command exits, so concurrent commands do not lose each other's updates
+state_lock=open(os.path.join(state, "lock"), "a")
+fcntl.flock(state_lock, fcntl.LOCK_EX)
+addresses=load("addresses", [])
+stopped=load("stopped", [])
+if name == "ip":
+    if args[:2] == ["addr", "add"]:
+        save("addresses", addresses+[[args[2], args[args.index("dev")+1], args[-1]]])
+    elif args[:2] == ["addr", "del"]:
+        save("addresses", [a for a in addresses if a[0] != args[2]])
+    else:
+        device=config["nic"].split(":")[0]
+        for address, device, label in [[config["physical_ip"]+"/24", device, device]]+addresses:
+            print("2: %s    inet %s scope global %s\\\\       valid_lft forever" %(device, address, label))
+elif name == "systemctl":
+    if args[0] in ("stop", "kill"):
+        save("stopped", [u for u in stopped if u not in args[1:]]+args[1:])
+    elif args[0] in ("start", "restart"):
+        save("stopped", [u for u in stopped if u not in args[1:]])
+    elif args[0] == "is-active":
+        print("inactive" if args[1] in stopped else "active")
+    elif args[0] == "status" and args[1] in stopped:
+        sys.exit(3)
+    elif args[0] == "list-unit-files":
+        for unit in args[1:]:
+            if not unit.startswith("-") and unit != "goconserver.service":
+                print("%s enabled" %unit)
+elif name == "rpm":
+    if "-qa" in args:
+        print("xCAT-2.14-snap.noarch")
+    else:
+        for package in args[1:]:
+            print(package+"-1.0-1.noarch")
+elif name == "lsdef":
+    if args[1] == "site":
+        print("Object name: clustersite\\n    domain=cluster.bench")
+    else:
+        for index in ["1", "1.2", "1.3", "2"]:
+            print("Object name: %s\\n    name=host%s" %(index, index))
+elif name == "getent":
+    for hosts in open(config["hosts"]):
+        if hosts.split() and hosts.split()[0] == args[1]:
+            print(hosts.strip())
+            break
+    else:
+        sys.exit(2)
+elif name == "ping":
+    sys.exit(1)
+elif name == "tabdump":
+    print("#node,groups\\n\\"%s\\",\\"all\\"" %args[0])
+elif name in ("makedns", "makedhcp", "makeconservercf", "makegocons"):
+    generated=os.path.join(config["generated"], name)
+    if not os.path.isdir(generated):
+        os.makedirs(generated)
+    with open(os.path.join(generated, "-".join(args) or "all"), "w") as f:
+        f.write(line+"\\n")
+'''
+
+fake_commands=["systemctl", "ip", "rpm", "lsdef", "chdef", "tabdump", "makedns", "makedhcp",
+               "makeconservercf", "makegocons", "ping", "getent", "ps", "hostname", "mount", "umount",
+               "yum", "yumdownloader", "repoquery", "wget", "lsxcatd", "pgsqlsetup", "mysqlsetup"]
+
+# name: (operation, description, fake command rules, readiness delays, xcatha settings)
+scenarios=[
+    ("setup", "setup, copying shared_fs into the shared data directory",
+        {}, {}, {}),
+    ("activate", "activation after setup",
+        {}, {}, {}),
+    ("deactivate", "deactivation after activation",
+        {}, {}, {}),
+    ("activate-3-vips", "activation with a virtual ip on each of 3 networks",
+        {}, {}, {"extra_vips":[("10.251.0.10", "bench1:0", "255.255.255.0"), ("10.252.0.10", "bench2:0", "255.255.255.0")]}),
+    ("activate-slow-make", "first activation, makedns, makedhcp and makeconservercf take 1 second",
+        {"makedns":{"latency":1}, "makedhcp":{"latency":1}, "makeconservercf":{"latency":1}}, {}, {}),
+    ("reactivate-slow-make", "activation after a failover back and forth, with unchanged tables",
+        {"makedns":{"latency":1}, "makedhcp":{"latency":1}, "makeconservercf":{"latency":1}}, {}, {}),
+    ("failover-slow-make", "activation of the second node, with its own /etc/hosts, after the first one was active",
+        {"makedns":{"latency":1}, "makedhcp":{"latency":1}, "makeconservercf":{"latency":1}}, {}, {}),
+    ("activate-slow-xcatd", "xcatd takes 2 seconds to listen after it started",
+        {}, {"xcatd":2}, {}),
+    ("activate-flaky-ntpd", "starting ntpd fails twice",
+        {"systemctl start ntpd":{"fail":2}}, {}, {}),
+    ("deactivate-hung-conserver", "conserver does not stop and is killed after 2 seconds",
+        {"systemctl stop conserver":{"latency":30}}, {}, {"stop_timeout":2}),
+]
+
+class BenchRoot(object):
+    """temporary root with the files and directories xcatha.py works on
+
+       The root of a second management node, given the root of the first one as peer,
+       shares its shared data directory, shared_fs directories and generated service
+       configuration, and has its own /etc/hosts and fake command log.
+    """
+    def __init__(self, files, latency, rules, peer=None):
+        self.root=tempfile.mkdtemp(prefix="xcatha-bench.")
+        self.bin=os.path.join(self.root, "bin")
+        self.state=os.path.join(self.root, "state")
+        for directory in [self.bin, self.state, os.path.join(self.root, "etc", "xcat", "cert"),
+                          os.path.join(self.root, "var", "lib", "xcatha")]:
+            os.makedirs(directory)
+        if peer:
+            self.shared=peer.shared
+            self.shared_fs=peer.shared_fs
+            self.generated=peer.generated
+        else:
+            self.shared=os.path.join(self.root, "HA")
+            os.makedirs(self.shared)
+            os.chmod(self.shared, 0755)
+            self.shared_fs=[os.path.join(self.root, name) for name in ["install", "etc/xcat/conf", "tftpboot"]]
+            for number, directory in enumerate(self.shared_fs):
+                if not os.path.isdir(directory):
+                    os.makedirs(directory)
+                for i in range(files):
+                    with open(os.path.join(directory, "file%d" %i), "w") as f:
+                        f.write("%d %d\n" %(number, i)*64)
+            self.generated=os.path.join(self.root, "generated")
+        self.physical_ip=socket.gethostbyname(socket.gethostname())
+        self.hosts=os.path.join(self.root, "etc", "hosts")
+        node="mn2" if peer else "mn1"
+        with open(self.hosts, "w") as f:
+            f.write("127.0.0.1 localhost\n10.250.0.10 hamn.cluster.bench hamn\n%s %s.cluster.bench %s\n"
+                    %(self.physical_ip, node, node))
+        with open(os.path.join(self.root, "etc", "resolv.conf"), "w") as f:
+            f.write("search cluster.bench\n")
+        with open(os.path.join(self.root, "etc", "xcat", "cert", "server-cert.pem"), "w") as f:
+            f.write("        Subject: CN=hamn.cluster.bench\n")
+        # conserver is the console service in use
+        with open(os.path.join(self.root, "etc", "xcat", "console.lock"), "w") as f:
+            f.write("root 1 0 0 00:00 ? 00:00:00 /usr/sbin/conserver\n")
+        commands={"":{"latency":latency}}
+        commands.update(rules)
+        self.config=os.path.join(self.root, "config.json")
+        with open(self.config, "w") as f:
+            json.dump({"commands":commands, "physical_ip":self.physical_ip, "nic":"bench0",
+                       "hosts":self.hosts, "generated":self.generated}, f)
+        fake=os.path.join(self.bin, "fake")
+        with open(fake, "w") as f:
+            f.write(fake_command.replace("#!/usr/bin/env python", "#!"+sys.executable, 1))
+        os.chmod(fake, 0755)
+        for name in fake_commands:
+            os.symlink(fake, os.path.join(self.bin, name))
+
+    def calls(self):
+        """command lines of the fake commands run"""
+        try:
+            with open(os.path.join(self.state, "log")) as f:
+                return [line.split(" ", 1)[1].strip() for line in f]
+        except IOError:
+            return []
+
+    def commands(self):
+        """number of fake commands run"""
+        return len(self.calls())
+
+    def remove(self):
+        """remove the temporary root"""
+        shutil.rmtree(self.root)
+
+def patch(xcatha, bench, settings):
+    """point the globals of xcatha at the temporary root"""
+    os.environ["PATH"]=bench.bin+os.pathsep+os.environ["PATH"]
+    os.environ["XCATHA_BENCH_CONFIG"]=bench.config
+    os.environ["XCATHA_BENCH_STATE"]=bench.state
+    etc=os.path.join(bench.root, "etc")
+    xcatha.etc_hosts=bench.hosts
+    xcatha.hostfile=bench.hosts
+    xcatha.resolv_conf=os.path.join(etc, "resolv.conf")
+    xcatha.ha_mn_tmp=os.path.join(bench.root, "ha_mn")
+    xcatha.etc_ha_mn=os.path.join(etc, "xcat", "ha_mn")
+    xcatha.console_lock=os.path.join(etc, "xcat", "console.lock")
+    xcatha.server_cert=os.path.join(etc, "xcat", "cert", "server-cert.pem")
+    xcatha.journal_file=os.path.join(bench.root, "var", "lib", "xcatha", "journal.json")
+    xcatha.bind_file=os.path.join(bench.root, "var", "lib", "xcatha", "bind_mounts")
+    xcatha.lease_renewer_file=os.path.join(bench.root, "var", "lib", "xcatha", "lease_renewer.pid")
+    xcatha.shared_fs[:]=bench.shared_fs
+    xcatha.service_list[:]=['postgresql', 'mariadb', 'xcatd', 'named', 'dhcpd', 'ntpd', 'conserver', 'goconserver']
+    xcatha.cache_dir=None
+    xcatha.address_backend="command"
+    xcatha.extra_vips=[]
+    xcatha.generated_files=dict((name, [os.path.join(bench.generated, name, "*")])
+                                for name in ("makedns", "makedhcp", "makeconservercf", "makegocons"))
+    xcatha.dryrun=0
+    xcatha.retry_delay=0.1
+    xcatha.ready_timeout=30
+    xcatha.stop_timeout=60
+    xcatha.config_files.clear()
+    xcatha.ready_times.clear()
+    for name, value in settings.items():
+        setattr(xcatha, name, value)
+
+
+def fake_probes(xcatha, ready):
+    """readiness probes of the fake services, ready the given seconds after the first probe"""
+    def probe(service):
+        first=[]
+        def probe_ready(timeout):
+            if not first:
+                first.append(time.time())
+            return time.time()-first[0] >= ready.get(service, 0)
+        return probe_ready
+    for service in xcatha.readiness_probes.keys():
+        xcatha.readiness_probes[service]=probe(service)
+
+class Options(object):
+    """arguments of a setup"""
+    def __init__(self, bench):
+        self.path=bench.shared
+        self.nic="bench0"
+        self.virtual_ip="10.250.0.10"
+        self.netmask="255.255.255.0"
+        self.host_name="hamn.cluster.bench"
+        self.dbtype="sqlite"
+        self.resume=False
+        self.from_stage=None
+        self.verify=False
+
+def run_scenario(xcatha, scenario, options):
+    """run one scenario in a new temporary root, return its timing"""
+    name, description, rules, ready, settings=scenario
+    operation=name.split("-")[0]
+    bench=BenchRoot(options.files, options.latency, rules)
+    peer=None
+    try:
+        patch(xcatha, bench, settings)
+        args=Options(bench)
+        obj=xcatha.xcat_ha_utils()
+        steps=[("setup", lambda: obj.xcatha_setup_mn(args))]
+        activate=("activate", lambda: obj.activate_management_node(args.nic, args.virtual_ip,
+                                                                    args.dbtype, args.path, args.netmask))
+        deactivate=("deactivate", lambda: obj.deactivate_management_node(args.nic, args.virtual_ip, args.dbtype))
+        if operation in ("activate", "deactivate", "reactivate", "failover"):
+            steps.append(activate)
+        if operation in ("deactivate", "reactivate", "failover"):
+            steps.append(deactivate)
+        if operation == "failover":
+            # The second management node takes over the shared data directory
+            peer=BenchRoot(options.files, options.latency, rules, bench)
+            steps.append(("peer", lambda: patch(xcatha, peer, settings)))
+        if operation in ("reactivate", "failover"):
+            steps.append(activate)
+        # Only the last step is timed, the others prepare the node for it
+        stdout=sys.stdout
+        if not options.verbose:
+            # configure_vip prints the name server it adds
+            sys.stdout=open(os.devnull, "w")
+        fake_probes(xcatha, {})
+        for step, function in steps[:-1]:
+            function()
+        fake_probes(xcatha, ready)
+        xcatha.ready_times.clear()
+        xcatha.service_results.clear()
+        xcatha.tracer=xcatha.Tracer()
+        node=peer or bench
+        commands=node.commands()
+        start=time.time()
+        status="ok"
+        try:
+            with xcatha.tracer.span(operation, "operation"):
+                steps[-1][1]()
+        except xcatha.HaException, e:
+            status="failed: "+e.message
+        finally:
+            sys.stdout=stdout
+        wall=time.time()-start
+        if operation == "failover" and status == "ok":
+            # The configuration generated by the first node is reused, not generated again
+            generated=[line for line in node.calls()[commands:]
+                       if line.startswith("makedns") or line.startswith("makedhcp -n")]
+            if generated:
+                status="failed: "+", ".join(generated)+" run on the second node"
+        if options.metrics_file:
+            xcatha.write_metrics(options.metrics_file, name, status != "ok")
+        # Stages of the operation, one level below the xcat_ha_utils method running it
+        spans=[span for span in xcatha.tracer.spans if span['kind'] == "stage" and span['duration'] is not None]
+        top=[span['id'] for span in spans if span['parent'] == xcatha.tracer.spans[0]['id']]
+        stages={}
+        for span in spans:
+            if span['parent'] in top:
+                stages[span['name']]=stages.get(span['name'], 0)+span['duration']
+        return {'scenario':name, 'wall':wall, 'status':status, 'stages':stages,
+                'commands':node.commands()-commands, 'ready':dict(xcatha.ready_times)}
+    finally:
+        # Activation leaves a process renewing the lease in the shared data directory
+        xcatha.stop_lease_renewer()
+        if options.keep:
+            print "Kept "+bench.root
+            if peer:
+                print "Kept "+peer.root
+        else:
+            bench.remove()
+            if peer:
+                peer.remove()
+
+def median(values):
+    """median of a list of numbers"""
+    values=sorted(values)
+    middle=len(values)/2
+    if len(values)%2:
+        return values[middle]
+    return (values[middle-1]+values[middle])/2.0
+
+def report(results):
+    """print wall time per scenario and per stage"""
+    print "%-28s %9s %9s  %s" %("scenario", "wall", "commands", "status")
+    for result in results:
+        print "%-28s %8.2fs %9d  %s" %(result['scenario'], result['wall'], result['commands'], result['status'])
+        for stage, duration in sorted(result['stages'].items(), key=lambda item: -item[1]):
+            print "    %-40s %8.2fs" %(stage, duration)
+        for service, duration in sorted(result['ready'].items()):
+            print "    %-40s %8.2fs" %(service+" ready after start", duration)
+
+def parse_arguments():
+    """parse input arguments"""
+    parser=argparse.ArgumentParser(description="Benchmark xCAT HA setup, activation and deactivation against fake system commands")
+    parser.add_argument('-s', '--scenario', dest="scenarios", action="append", choices=[s[0] for s in scenarios], help="scenario to run, default is all")
+    parser.add_argument('-r', '--repeat', type=int, default=1, help="runs of each scenario, the median is reported")
+    parser.add_argument('-l', '--latency', type=float, default=0.01, help="seconds every fake command takes")
+    parser.add_argument('-f', '--files', type=int, default=100, help="files in each synthetic shared_fs directory")
+    parser.add_argument('-j', '--json', help="write the results as JSON into this file")
+    parser.add_argument('-m', '--metrics-file', dest="metrics_file", help="write the metrics of each scenario, as xcatha.py --metrics-file does, into this file")
+    parser.add_argument('-k', '--keep', action="store_true", help="keep the temporary root of each run")
+    parser.add_argument('--verbose', action="store_true", help="show the log of xcatha.py on the console")
+    parser.add_argument('--list', action="store_true", help="list the scenarios")
+    return parser.parse_args()
+
+def main():
+    options=parse_arguments()
+    if options.list:
+        for scenario in scenarios:
+            print "%-28s %s" %(scenario[0], scenario[1])
+        return 0
+    # xcatha.py logs into xcatha.log of the current directory
+    workdir=tempfile.mkdtemp(prefix="xcatha-bench-log.")
+    cwd=os.getcwd()
+    os.chdir(workdir)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import xcatha
+    os.chdir(cwd)
+    if not options.verbose:
+        xcatha.console_handler.setLevel(logging.CRITICAL)
+    selected=[s for s in scenarios if not options.scenarios or s[0] in options.scenarios]
+    results=[]
+    path=os.environ["PATH"]
+    for scenario in selected:
+        runs=[]
+        for i in range(options.repeat):
+            os.environ["PATH"]=path
+            runs.append(run_scenario(xcatha, scenario, options))
+        result=sorted(runs, key=lambda run: run['wall'])[len(runs)/2]
+        result['wall']=median([run['wall'] for run in runs])
+        results.append(result)
+    report(results)
+    print "Log of xcatha.py: "+os.path.join(workdir, "xcatha.log")
+    if options.json:
+        with open(options.json, "w") as f:
+            json.dump({'latency':options.latency, 'files':options.files, 'repeat':options.repeat,
+                       'results':results}, f, indent=1, sort_keys=True)
+    if [result for result in results if result['status'] != "ok"]:
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
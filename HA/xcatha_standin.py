@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+###############################################################################
+# IBM(c) 2018 EPL license http://www.eclipse.org/legal/epl-v10.html
+###############################################################################
+#
+#  NAME:  xcatha_standin.py
+#
+#  SYNTAX: xcatha_standin.py <xcatha.py arguments>
+#
+#  DESCRIPTION:  Stand-in for xcatha.py on the nodes of a fleet inventory with
+#                "transport": "local", so that xcatha.py --fleet can be tried on one
+#                machine without touching it. Each call appends a JSON line with the
+#                node it stands for, from XCATHA_FLEET_HOST, and its arguments to the
+#                record file, waits and exits with the configured return code.
+#
+#  ENVIRONMENT:
+#               XCATHA_STANDIN_RECORD file the calls are appended to, default is
+#                        xcatha_standin.json in the current directory
+#               XCATHA_STANDIN_DELAY seconds each call takes, default is 0
+#               XCATHA_STANDIN_FAIL comma separated host:action pairs which fail, such
+#                        as host1:deactivate
+#
+import fcntl
+import json
+import os
+import sys
+import time
+
+actions={"-s": "setup", "--setup": "setup", "-a": "activate", "--activate": "activate",
+         "-d": "deactivate", "--deactivate": "deactivate"}
+
+def main():
+    host=os.environ.get("XCATHA_FLEET_HOST", "")
+    action=([actions[arg] for arg in sys.argv[1:] if arg in actions] or [""])[0]
+    record=os.environ.get("XCATHA_STANDIN_RECORD", os.path.join(os.getcwd(), "xcatha_standin.json"))
+    with open(record, "a") as f:
+        # Concurrent calls append whole lines
+        fcntl.lockf(f, fcntl.LOCK_EX)
+        f.write(json.dumps({'host':host, 'action':action, 'args':sys.argv[1:], 'time':time.time()})+"\n")
+    time.sleep(float(os.environ.get("XCATHA_STANDIN_DELAY", 0)))
+    failing=[entry.strip() for entry in os.environ.get("XCATHA_STANDIN_FAIL", "").split(",")]
+    if "%s:%s" %(host, action) in failing:
+        sys.stderr.write("Error: %s failed on %s [Stand-in]\n" %(action, host))
+        return 1
+    print "%s on %s [Stand-in]" %(action, host)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())